@@ -17,49 +17,218 @@ A text file containing a JSON object containing these fields
 - "in_taxrolls": [path within dir_data to taxroll zip files]
 - "in_census": path within dir_data to census file
 - "in_geocoding": path with dir_data to geocoding file
-- "out_feature_vectors": path with dir_data to
+- "out_feature_vectors": optional path within dir_working to the directory of the feature vectors exported
+  from table transactions; default "feature_vectors"
+- "chunk_size": optional number of records converted to arrays at a time by the vectorized engines;
+  default 100000
+- "deeds_engine": optional; "scalar" (the default) accumulates each deed in turn, "vectorized" filters
+  chunks of deeds as NumPy arrays
+- "taxrolls_engine": optional; "scalar" (the default) extracts the features of each parcel in turn,
+  "vectorized" extracts them from chunks of parcels as NumPy arrays
+- "parse_cache": optional; if True, keep the parsed columns of each zip file in dir_working/parse_cache
+  and read them from there until the zip file changes; default False
+- "parse_cache_hash_content": optional; if True, the parse cache also checks the SHA-256 of each zip file,
+  not just its size and modification time; default False
+- "bulk_load_pragmas": optional dict of the SQLite pragmas set while the tables are written;
+  default {"journal_mode": "MEMORY", "synchronous": "OFF", "cache_size": -262144, "temp_store": "MEMORY"};
+  {} keeps the usual settings
+- "standardize_exact": optional; if True, create_standardize holds each column in memory to compute its exact
+  median; default False (the median is estimated with a bounded-memory sketch; the mean and standard deviation
+  are exact either way)
+- "split": optional; "random" (the default) marks each transaction as in training with a draw from the random
+  number generator, "hash" marks the first fraction_in_training of each month's transactions ranked by a seeded
+  hash of (apn, sale_date), so that the split does not depend on the order of the rows
+- "pipeline": optional; if True, a reader thread inflates and parses each zip file ahead of the accumulation;
+  default False
+- "pipeline_block_size": optional number of records the reader thread passes on at a time to the scalar engines;
+  default 10000 (the vectorized engines take chunk_size records at a time)
+- "pipeline_queue_depth": optional number of blocks or chunks the reader thread may get ahead; default 4
+- "deeds_prefilter": optional; if True (the default), reject most deeds before parsing all their fields
+- "checkpoint": optional; if True, save the partial results of each deeds and taxrolls zip file in
+  dir_working/checkpoints as soon as the file has been read; default False
+- "resume": optional; if True, reuse the checkpoints saved by an earlier run whose zip file, code tables,
+  config values, and checkpoint format version are unchanged, and read only the other zip files; other changes
+  to the code do not invalidate the checkpoints; implies "checkpoint"; default False
+- "incremental": optional; if True (the default), skip each stage whose inputs, config values, and code
+  are unchanged since it last completed
+- "parcels_sold_only": optional; if True, read_taxrolls runs after read_deeds and keeps the features of only
+  the parcels whose apn is in table deeds (every parcel still counts in the neighborhoods); default False
+- "join_engine": optional; "sql" (the default) has SQLite join the tables into table transactions, "merge"
+  joins them as NumPy arrays, reading the deeds chunk_size rows at a time, and inserts the result
+- "workers": optional number of processes that read the deeds and taxroll zip files;
+  default 1 (read serially)
+- "stage_workers": optional number of processes that run independent stages at the same time;
+  default 1 (run the stages in order in this process)
 
 
 Each deed and taxroll zip file contains one file. That file is a CSV
 file in tab-separated format.
 '''
 import collections
+import concurrent.futures
+import contextlib
 import csv
 import datetime
+import functools
+import hashlib
+import json
+import logging
+import multiprocessing
 import numpy as np
 import os
 import pdb
+import pickle
 import pprint
 import random
+import shutil
 import sqlite3
-import subprocess
 import sys
+import tempfile
+import time
 import typing
+import unittest
+import zipfile
 
 import utility as u
 
 
-def lookup_code(conn, table_name, code_table, description):
-    '''Return code as str or raise u.NotFoundError'''
-    stmt = 'SELECT value FROM %s where code_table == "%s" AND description == "%s"' % (
-        table_name,
-        code_table,
-        description,
+def connect(config):
+    '''Return a connection to the output data base'''
+    # for date and datetime fields, see https://docs.python.org/3/library/sqlite3.html#default-adapters-and-converters
+    conn = sqlite3.connect(
+        os.path.join(config['dir_working'], config['out_db']),
+        detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES,
+        timeout=600.0,  # seconds to wait while a concurrent stage holds the data base lock
         )
-    n_rows = 0
-    for row in conn.execute(stmt):
-        value = row['value']
-        n_rows += 1
-    if n_rows == 0:
-        raise u.NotFoundError((table_name, code_table, description))
-    elif n_rows == 1:
-        return value
-    else:
-        raise u.NotUnique((table_name, code_table, description))
+    conn.row_factory = sqlite3.Row
+    return conn
 
 
-def read_codes(conn, config, logger, table_name):
-    '''Create table codes_deeds from info in config['in_codes_deeds']'''
+writer_lock = None  # set by run_stages when stages run in concurrent processes
+stage_log_queue = None  # in a stage process, the queue of the logger in the main process, if it has one
+
+
+# the pragmas set while tables are written; the data base may be corrupted if the process dies meanwhile,
+# which is acceptable, as the stage is then run again
+BULK_LOAD_PRAGMAS = {
+    'journal_mode': 'MEMORY',
+    'synchronous': 'OFF',
+    'cache_size': -262144,  # KiB
+    'temp_store': 'MEMORY',
+    }
+
+BULK_INSERT_BATCH_SIZE = 50000
+
+
+def set_pragmas(conn, pragmas):
+    '''Set each pragma and return dict of their previous values'''
+    previous = {}
+    for name, value in pragmas.items():
+        previous[name] = conn.execute('PRAGMA %s' % name).fetchone()[0]
+        conn.execute('PRAGMA %s = %s' % (name, value))
+    return previous
+
+
+@contextlib.contextmanager
+def table_writer(conn, config):
+    '''Write tables in one transaction with the bulk-load pragmas, holding the writer lock
+
+    Concurrent stages write through their own connections; the lock lets one of them write at a time.
+    The pragmas are config['bulk_load_pragmas'] if supplied, else BULK_LOAD_PRAGMAS. They are restored
+    after the transaction is committed or rolled back.
+    '''
+    with contextlib.nullcontext() if writer_lock is None else writer_lock:
+        conn.commit()
+        previous = set_pragmas(conn, config.get('bulk_load_pragmas', BULK_LOAD_PRAGMAS))
+        try:
+            conn.execute('BEGIN')
+            yield conn
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            set_pragmas(conn, previous)
+
+
+def writes_tables(function):
+    '''Decorate a stage function that writes throughout, so that it runs in a table_writer'''
+    @functools.wraps(function)
+    def wrapped(conn, config, logger):
+        with table_writer(conn, config):
+            return function(conn, config, logger)
+    return wrapped
+
+
+def bulk_insert(conn, table_name, rows):
+    '''Insert each row, a sequence of values, into a table, BULK_INSERT_BATCH_SIZE rows per executemany'''
+    stmt = None
+    for batch in u.chunks(rows, BULK_INSERT_BATCH_SIZE):
+        if stmt is None:
+            stmt = 'INSERT INTO %s VALUES (%s)' % (table_name, ', '.join('?' * len(batch[0])))
+        conn.executemany(stmt, batch)
+
+
+class CodeBook:
+    '''The codes in a code table file, indexed by description and by value
+
+    A code that repeats an earlier one is counted as a duplicate and dropped. A code with the description
+    of an earlier code but another value, or the reverse, is a conflict; looking it up raises u.NotUnique.
+    A CodeBook holds only dicts and lists, so it is pickled to the worker processes with the config.
+    '''
+    def __init__(self, table_name):
+        self.table_name = table_name
+        self.codes = {}  # key = (code_table, value, description)  value = None; the distinct codes in file order
+        self.values = {}  # key = (code_table, description)  value = value
+        self.descriptions = {}  # key = (code_table, value)  value = description
+        self.conflicts = []  # (code_table, value, description) that conflict with an earlier code
+        self.ambiguous_descriptions = set()  # keys of self.values with more than one value
+        self.ambiguous_values = set()  # keys of self.descriptions with more than one description
+        self.n_duplicates = 0
+        self.skipped = []  # (code_table, value, description) skipped as incorrect for this application
+
+    def add(self, code_table, value, description):
+        '''Add a code from the code table file'''
+        code = (code_table, value, description)
+        if code in self.codes:
+            self.n_duplicates += 1
+            return
+        self.codes[code] = None
+        is_conflict = False
+        if (code_table, description) in self.values:
+            self.ambiguous_descriptions.add((code_table, description))
+            is_conflict = True
+        else:
+            self.values[(code_table, description)] = value
+        if (code_table, value) in self.descriptions:
+            self.ambiguous_values.add((code_table, value))
+            is_conflict = True
+        else:
+            self.descriptions[(code_table, value)] = description
+        if is_conflict:
+            self.conflicts.append(code)
+
+    def lookup(self, code_table, description):
+        '''Return the value of the code as str or raise u.NotFoundError or u.NotUnique'''
+        if (code_table, description) in self.ambiguous_descriptions:
+            raise u.NotUnique((self.table_name, code_table, description))
+        try:
+            return self.values[(code_table, description)]
+        except KeyError:
+            raise u.NotFoundError((self.table_name, code_table, description))
+
+    def describe(self, code_table, value):
+        '''Return the description of the code as str or raise u.NotFoundError or u.NotUnique'''
+        if (code_table, value) in self.ambiguous_values:
+            raise u.NotUnique((self.table_name, code_table, value))
+        try:
+            return self.descriptions[(code_table, value)]
+        except KeyError:
+            raise u.NotFoundError((self.table_name, code_table, value))
+
+
+def read_code_book(config, table_name):
+    '''Return CodeBook with the codes in config['in_' + table_name]'''
     debug = False
 
     def skip_code(table_name, row):
@@ -78,6 +247,31 @@ def read_codes(conn, config, logger, table_name):
             raise ValueError('bad table_name: %s' % table_name)
         return False
 
+    code_book = CodeBook(table_name)
+    path = os.path.join(config['dir_data'], config['in_' + table_name])
+    with open(path, encoding='latin-1') as csvfile:
+        reader = csv.DictReader(csvfile, delimiter=',')
+        for row_index, row in enumerate(reader):
+            if debug:
+                pprint.pprint(row)
+            code = (row['CODE TABLE'], row['VALUE'], row['DESCRIPTION'])
+            if skip_code(table_name, row):
+                code_book.skipped.append(code)
+                continue
+            # Some rows are duplicated in the taxrolls code table
+            code_book.add(*code)
+    return code_book
+
+
+def read_codes(conn, config, logger, table_name):
+    '''Create table table_name from info in config['in_' + table_name]'''
+    code_book = read_code_book(config, table_name)
+    for code in code_book.skipped:
+        logger.warning('skipping code: %s %s' % (table_name, str(code)))
+    logger.info('%s: %d codes, %d duplicates dropped' % (table_name, len(code_book.codes), code_book.n_duplicates))
+    for code in code_book.conflicts:
+        logger.warning('conflicting code: %s %s' % (table_name, str(code)))
+
     stmt_drop = 'DROP TABLE IF EXISTS %s' % table_name
     conn.execute(stmt_drop)
 
@@ -89,56 +283,488 @@ def read_codes(conn, config, logger, table_name):
     )
     ''' % table_name
     conn.execute(stmt_create)
-
-    path = os.path.join(config['dir_data'], config['in_' + table_name])
-    with open(path, encoding='latin-1') as csvfile:
-        reader = csv.DictReader(csvfile, delimiter=',')
-        for row_index, row in enumerate(reader):
-            if debug:
-                pprint.pprint(row)
-            if skip_code(table_name, row):
-                logger.warning('skipping code: %s %s' % (table_name, str(row)))
-                continue
-
-            # Some rows are duplicated in the taxrolls code table
-            # This code handles that by skipping code-description values already in the code table
-            try:
-                stmt = 'INSERT INTO %s VALUES("%s", "%s", "%s")' % (
-                    table_name,
-                    row['CODE TABLE'],
-                    row['VALUE'],
-                    row['DESCRIPTION'],
-                )
-                conn.execute(stmt)
-            except sqlite3.IntegrityError as err:
-                if str(err).startswith('UNIQUE constraint failed:'):
-                    existing_code = lookup_code(conn, table_name, row['CODE TABLE'], row['DESCRIPTION'])
-                    if existing_code == row['VALUE']:
-                        # there is a duplicate record in the csv file
-                        pass
-                    else:
-                        print('fix this problem')
-                        pdb.set_trace()
-                else:
-                    # unexpected error
-                    raise err
+    bulk_insert(conn, table_name, code_book.codes)
     return
 
 
+@writes_tables
 def read_codes_deeds(conn, config, logger):
     '''Create table codes_deeds'''
     return read_codes(conn, config, logger, 'codes_deeds')
 
 
+@writes_tables
 def read_codes_taxrolls(conn, config, logger):
     '''Create table codes_deeds'''
     return read_codes(conn, config, logger, 'codes_taxrolls')
 
 
-class Deed:
-    def __init__(self, conn, config, logger):
+def map_zipfiles(worker, config, code_book, zipfilenames):
+    '''Yield worker(config, code_book, zipfilename) for each zip file, in order
+
+    The results are computed in config['workers'] processes.
+    '''
+    workers = min(config.get('workers', 1), len(zipfilenames))
+    if workers <= 1:
+        yield from map(functools.partial(worker, config, code_book), zipfilenames)
+        return
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        yield from executor.map(functools.partial(worker, dict(config), code_book), zipfilenames)
+
+
+def checkpoint_path(config, stage_name, zipfilename):
+    '''Return path to the checkpoint of a zip file read by a stage'''
+    return os.path.join(
+        config['dir_working'],
+        'checkpoints',
+        stage_name,
+        os.path.basename(zipfilename) + '.pickle',
+        )
+
+
+# the version of the partial results of each stage that checkpoints them; bump it when the form of the
+# partial results changes or when a change to the code changes which records they accept
+CHECKPOINT_FORMAT_VERSIONS = {
+    'read_deeds': 1,
+    'read_taxrolls': 1,
+    }
+
+
+def checkpoint_key(config, stage_name, zipfilename):
+    '''Return dict of everything that determines the partial result of a zip file
+
+    The code is represented by CHECKPOINT_FORMAT_VERSIONS, not by its hash, so that a run stopped by an error
+    can be resumed after the error is fixed without reading the zip files that were read before.
+    '''
+    stage = {stage.name: stage for stage in configured_stages(config)}[stage_name]
+    format_version = 'checkpoint format %d' % CHECKPOINT_FORMAT_VERSIONS[stage_name]
+    fingerprints = stage_fingerprints(config, format_version)
+    path_zip = os.path.join(config['dir_data'], zipfilename)
+    stat = os.stat(path_zip)
+    return {
+        'archive': [os.path.abspath(path_zip), stat.st_size, stat.st_mtime_ns],
+        'format': format_version,
+        # the engines accumulate their partial results in different forms
+        'config': {
+            config_key: config.get(config_key)
+            for config_key in stage.config_keys + ('deeds_engine', 'taxrolls_engine')
+            },
+        'upstream': [fingerprints[name] for name in stage.upstream],
+        }
+
+
+def read_checkpoint(config, stage_name, zipfilename):
+    '''Return the partial result saved for a zip file or None if there is none or it is out of date'''
+    path = checkpoint_path(config, stage_name, zipfilename)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        key, partial = pickle.load(f)
+    if key != checkpoint_key(config, stage_name, zipfilename):
+        return None
+    return partial
+
+
+def write_checkpoint(config, stage_name, zipfilename, partial):
+    '''Save the partial result of a zip file, replacing any earlier checkpoint'''
+    path = checkpoint_path(config, stage_name, zipfilename)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    path_tmp = path + '.tmp-%d' % os.getpid()
+    with open(path_tmp, 'wb') as f:
+        pickle.dump((checkpoint_key(config, stage_name, zipfilename), partial), f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(path_tmp, path)
+
+
+def map_zipfiles_checkpointed(stage_name, worker, config, code_book, logger, zipfilenames):
+    '''Yield worker(config, code_book, zipfilename) for each zip file, in order, saving each as a checkpoint
+
+    If config['resume'], the zip files with a checkpoint that is up to date are not read again.
+    '''
+    resumed = {}
+    if config.get('resume', False):
+        for zipfilename in zipfilenames:
+            partial = read_checkpoint(config, stage_name, zipfilename)
+            if partial is not None:
+                resumed[zipfilename] = partial
+        logger.info('resuming %s from checkpoints of %d of %d zip files' % (
+            stage_name, len(resumed), len(zipfilenames)))
+    remaining = [zipfilename for zipfilename in zipfilenames if zipfilename not in resumed]
+    partials = map_zipfiles(worker, config, code_book, remaining)
+    for zipfilename in zipfilenames:
+        if zipfilename in resumed:
+            yield resumed[zipfilename]
+        else:
+            partial = next(partials)
+            write_checkpoint(config, stage_name, zipfilename, partial)
+            yield partial
+
+
+class Accumulator:
+    '''Base class for the objects that accumulate the records in the zip files
+
+    The partial results accumulated in a worker process are pickled without the connection and logger.
+    '''
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['conn'] = None
+        state['logger'] = None
+        return state
+
+
+def read_archive(path_zip, column_names, screen=None):
+    '''Yield each record in a deeds or taxroll zip file as a tuple of the values in the named columns
+
+    The records are decoded as the archive member is inflated, so nothing is written to disk.
+    If supplied, screen(lines) yields the header line and the lines that are worth parsing.
+    '''
+    with u.open_zip_member(path_zip) as csvfile:
+        lines = csvfile if screen is None else screen(csvfile)
+        # NOTE: When reading ... F3.txt, error raised: _csv.Error: field larger than field limit (131072)
+        # ref: https://stackoverflow.com/questions/15063936/csv-error-field-larger-than-field-limit-131072
+        # Hyp: the problem is that the file contains a quoting char in one of the tab-delimited fields
+        # Hence QUOTE_NONE: quote characters are data, not field delimiters
+        reader = csv.reader(lines, delimiter='\t', quoting=csv.QUOTE_NONE)
+        yield from u.project(reader, column_names)
+
+
+def to_int_array(values):
+    '''Return (ints, is_valid) for an array of str, with the values int() would convert them to'''
+    ints = np.zeros(len(values), dtype=np.int64)
+    is_valid = values != ''
+    try:
+        ints[is_valid] = values[is_valid].astype(np.int64)
+    except (ValueError, TypeError, OverflowError):
+        # convert one by one to find the invalid values; an int beyond int64 is invalid
+        for i in np.flatnonzero(is_valid):
+            try:
+                ints[i] = int(values[i])
+            except (ValueError, TypeError, OverflowError):
+                is_valid[i] = False
+    return ints, is_valid
+
+
+def to_int_as_float_array(values):
+    '''Return (floats, is_valid) for an array of str, with the floats of the values int() would convert them to
+
+    Unlike to_int_array, an int beyond int64 is valid, as it is for int().
+    '''
+    ints, is_valid = to_int_array(values)
+    floats = ints.astype(np.float64)
+    for i in np.flatnonzero(~is_valid & (values != '')):
+        try:
+            floats[i] = float(int(values[i]))
+            is_valid[i] = True
+        except (ValueError, TypeError):
+            pass
+    return floats, is_valid
+
+
+def to_float_array(values):
+    '''Return (floats, is_valid) for an array of str, with the values float() would convert them to'''
+    floats = np.zeros(len(values), dtype=np.float64)
+    is_valid = values != ''
+    try:
+        floats[is_valid] = values[is_valid].astype(np.float64)
+    except (ValueError, TypeError, OverflowError):
+        # convert one by one to find the invalid values
+        for i in np.flatnonzero(is_valid):
+            try:
+                floats[i] = float(values[i])
+            except (ValueError, TypeError, OverflowError):
+                is_valid[i] = False
+    return floats, is_valid
+
+
+def to_date_array(values):
+    '''Return (dates, is_valid, is_day_0) for an array of str, with the dates u.as_date would convert them to
+
+    is_day_0 is True only for the valid dates whose day 0 was converted to 1.
+    '''
+    n = len(values)
+    dates = np.zeros(n, dtype='datetime64[D]')
+    is_valid = np.zeros(n, dtype=bool)
+    is_day_0 = np.zeros(n, dtype=bool)
+    values = values.astype(str)
+
+    # convert the values in the common YYYYMMDD format as arrays
+    is_yyyymmdd = (np.char.str_len(values) == 8) & np.char.isdigit(values)
+    try:
+        yyyymmdd = values[is_yyyymmdd].astype(np.int64)
+    except ValueError:
+        # some unicode digits are not decimal digits
+        is_yyyymmdd[:] = False
+        yyyymmdd = np.zeros(0, dtype=np.int64)
+    year = yyyymmdd // 10000
+    month = yyyymmdd // 100 % 100
+    day = yyyymmdd % 100
+    day_0 = day == 0
+    day[day_0] = 1
+    first_of_month = ((year - 1970) * 12 + np.clip(month, 1, 12) - 1).astype('datetime64[M]')
+    days_in_month = (
+        (first_of_month + 1).astype('datetime64[D]') - first_of_month.astype('datetime64[D]')
+        ).astype(int)
+    dates[is_yyyymmdd] = first_of_month.astype('datetime64[D]') + (day - 1)
+    is_valid_yyyymmdd = (year >= 1) & (month >= 1) & (month <= 12) & (day <= days_in_month)
+    is_valid[is_yyyymmdd] = is_valid_yyyymmdd
+    is_day_0[is_yyyymmdd] = day_0 & is_valid_yyyymmdd  # as u.as_date, which raises before it converts
+
+    # convert the other values one by one
+    for i in np.flatnonzero(~is_yyyymmdd):
+        try:
+            date, e = u.as_date(values[i])
+        except Exception:
+            continue
+        dates[i] = date
+        is_valid[i] = True
+        is_day_0[i] = e is not None
+    return dates, is_valid, is_day_0
+
+
+def rows_to_columns(rows):
+    '''Return a list with an array of str for each column in a non-empty list of rows'''
+    return [np.array(column) for column in zip(*rows)]
+
+
+def encode_latin_1(values):
+    '''Return an array of str, all of whose characters are latin-1, as an array of bytes'''
+    if values.dtype == object:
+        values = np.array(['' if value is None else value for value in values.tolist()])
+    width = values.dtype.itemsize // 4
+    return values.view(np.uint32).astype(np.uint8).view('S%d' % width)
+
+
+def decode_latin_1(values):
+    '''Return an array of latin-1 bytes as an array of str'''
+    width = values.dtype.itemsize
+    return values.view(np.uint8).astype(np.uint32).view('U%d' % width)
+
+
+def parse_cache_dir(config, path_zip, column_names):
+    '''Return (path to the parse cache directory, key) for the named columns of a zip file
+
+    The directory is specific to the zip file and the columns. The key identifies the content of the zip file.
+    '''
+    stat = os.stat(path_zip)
+    key = {
+        'version': 1,
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+        }
+    if config.get('parse_cache_hash_content', False):
+        sha256 = hashlib.sha256()
+        with open(path_zip, 'rb') as f:
+            for block in iter(functools.partial(f.read, 1 << 20), b''):
+                sha256.update(block)
+        key['sha256'] = sha256.hexdigest()
+    projection = hashlib.sha256(json.dumps([os.path.abspath(path_zip), list(column_names)]).encode()).hexdigest()
+    name = '%s-%s' % (os.path.basename(path_zip).split('.')[0], projection[:16])
+    return os.path.join(config['dir_working'], 'parse_cache', name), key
+
+
+def read_parse_cache(cache_dir):
+    '''Yield a list of arrays of str, one per column, for each chunk in a parse cache directory'''
+    with open(os.path.join(cache_dir, 'manifest.json')) as f:
+        manifest = json.load(f)
+    for chunk_index in range(len(manifest['chunks'])):
+        yield [
+            decode_latin_1(np.load(os.path.join(cache_dir, file_name), mmap_mode='r'))
+            for file_name in manifest['chunks'][chunk_index]['files']
+            ]
+
+
+def write_parse_cache(cache_dir, key, column_names, chunks):
+    '''Yield each chunk, a list of arrays of str, while saving them in a parse cache directory
+
+    Each column of each chunk is saved as a .npy file of fixed-width latin-1 bytes.
+    The manifest is written and the directory put in place only after the last chunk.
+    '''
+    dir_tmp = cache_dir + '.tmp-%d' % os.getpid()
+    shutil.rmtree(dir_tmp, ignore_errors=True)
+    os.makedirs(dir_tmp)
+    manifest = {
+        'key': key,
+        'columns': list(column_names),
+        'chunks': [],
+        }
+    for chunk_index, columns in enumerate(chunks):
+        file_names = []
+        for column_index, column in enumerate(columns):
+            file_name = 'chunk-%05d-column-%02d.npy' % (chunk_index, column_index)
+            np.save(os.path.join(dir_tmp, file_name), encode_latin_1(column))
+            file_names.append(file_name)
+        manifest['chunks'].append({'n_rows': len(columns[0]), 'files': file_names})
+        yield columns
+    with open(os.path.join(dir_tmp, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=1)
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    os.rename(dir_tmp, cache_dir)
+
+
+def pipelined(blocks, config, stalls):
+    '''Return blocks or, if config['pipeline'], an iterator over blocks that a reader thread produces ahead'''
+    if not config.get('pipeline', False):
+        return blocks
+    return u.prefetch(blocks, config.get('pipeline_queue_depth', 4), stalls)
+
+
+def read_archive_chunks(path_zip, column_names, config, screen=None, stalls=None):
+    '''Yield a list of arrays of str, one per named column, for each chunk of records in a zip file
+
+    If config['parse_cache'], the chunks come from the parse cache, which is built on first use.
+    The screen is not applied when the cache is in use, as the cache holds every record.
+    If config['pipeline'], stalls accumulates the seconds the reader thread and the caller waited.
+    '''
+    if not config.get('parse_cache', False):
+        chunks = (
+            rows_to_columns(rows)
+            for rows in u.chunks(read_archive(path_zip, column_names, screen), config.get('chunk_size', 100000))
+            )
+        yield from pipelined(chunks, config, stalls)
+        return
+
+    cache_dir, key = parse_cache_dir(config, path_zip, column_names)
+    path_manifest = os.path.join(cache_dir, 'manifest.json')
+    if os.path.exists(path_manifest):
+        with open(path_manifest) as f:
+            if json.load(f)['key'] == key:
+                yield from pipelined(read_parse_cache(cache_dir), config, stalls)
+                return
+    chunks = (
+        rows_to_columns(rows)
+        for rows in u.chunks(read_archive(path_zip, column_names), config.get('chunk_size', 100000))
+        )
+    yield from pipelined(write_parse_cache(cache_dir, key, column_names, chunks), config, stalls)
+
+
+def read_archive_rows(path_zip, column_names, config, screen=None, stalls=None):
+    '''Yield each record in a zip file as a tuple of the values in the named columns
+
+    The parse cache is used if configured.
+    '''
+    if config.get('parse_cache', False):
+        for columns in read_archive_chunks(path_zip, column_names, config, stalls=stalls):
+            yield from zip(*[column.tolist() for column in columns])
+    elif config.get('pipeline', False):
+        blocks = u.chunks(read_archive(path_zip, column_names, screen), config.get('pipeline_block_size', 10000))
+        for rows in pipelined(blocks, config, stalls):
+            yield from rows
+    else:
+        yield from read_archive(path_zip, column_names, screen)
+
+
+class ChunkFilter:
+    '''Apply the checks in an accumulate() method to a chunk of records held as NumPy arrays
+
+    The records that pass each check stay alive. Each record is rejected for the first check it fails,
+    so the counts of the reasons are those that accumulate() would make.
+    '''
+    def __init__(self, n_rows, counter, error_reasons):
+        self.n_rows = n_rows
+        self.counter = counter
+        self.error_reasons = error_reasons
+        self.is_alive = np.ones(n_rows, dtype=bool)
+
+    def reject(self, is_ok, reason):
+        '''Reject the live records that are not ok'''
+        n_rejected = int(np.count_nonzero(self.is_alive & ~is_ok))
+        if n_rejected > 0:
+            self.counter['skipped'] += n_rejected
+            self.error_reasons[reason] += n_rejected
+            self.is_alive &= is_ok
+
+    def convert(self, converter, values):
+        '''Return (converted, is_valid) from converter(values) applied to the live records only'''
+        converted, is_valid = converter(values[self.is_alive])
+        result = np.zeros(self.n_rows, dtype=converted.dtype)
+        result[self.is_alive] = converted
+        is_valid_all = np.zeros(self.n_rows, dtype=bool)
+        is_valid_all[self.is_alive] = is_valid
+        return result, is_valid_all
+
+    def convert_each(self, function, *columns):
+        '''Return (int64 values, is_valid) from function(*values) for each live record
+
+        A record is valid if function raised no exception.
+        '''
+        result = np.zeros(self.n_rows, dtype=np.int64)
+        is_valid = np.zeros(self.n_rows, dtype=bool)
+        for i in np.flatnonzero(self.is_alive):
+            try:
+                result[i] = function(*[column[i] for column in columns])
+                is_valid[i] = True
+            except Exception:
+                pass
+        return result, is_valid
+
+
+# a sale is keyed by an int64 that packs the apn above the sale date as days since 1970-01-01
+SALE_DATE_BITS = 20  # enough days to reach the year 4840; later sale dates are rejected as invalid
+MAX_APN = 2 ** (63 - SALE_DATE_BITS)
+EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+
+
+def is_packable_sale_date(days):
+    '''Return True where the sale date, as days since 1970-01-01, fits in the SALE_DATE_BITS of a sale key'''
+    return (0 <= days) & (days < 2 ** SALE_DATE_BITS)
+
+
+def sale_key(apn, sale_date):
+    '''Return the int64 key for the sale of apn on datetime.date sale_date, or raise u.InputError'''
+    if not 0 <= apn < MAX_APN:
+        raise u.InputError('invalid APN', apn)
+    return (apn << SALE_DATE_BITS) | (sale_date.toordinal() - EPOCH_ORDINAL)
+
+
+def sale_key_array(apns, sale_dates):
+    '''Return the int64 keys for int64 apns and datetime64[D] sale_dates, as sale_key does'''
+    return (apns << SALE_DATE_BITS) | sale_dates.astype(np.int64)
+
+
+def unpack_sale_keys(keys):
+    '''Return (apns, sale_dates) as int64 and datetime64[D] arrays, from the keys built by sale_key'''
+    return keys >> SALE_DATE_BITS, (keys & (2 ** SALE_DATE_BITS - 1)).astype('datetime64[D]')
+
+
+def first_sale_amounts(keys, sale_amounts):
+    '''Return (indexes, n_rejected) for deeds in the order they were accumulated
+
+    indexes are the positions of the first deed for each sale key. A later deed with the same key
+    is rejected when its sale amount differs from the first one.
+    '''
+    n = len(keys)
+    if n == 0:
+        return np.zeros(0, dtype=np.int64), 0
+    # a stable sort keeps the deeds with the same key in order, so that each group starts with the first deed
+    order = np.argsort(keys, kind='stable')
+    keys_sorted = keys[order]
+    sale_amounts_sorted = sale_amounts[order]
+    is_first = np.ones(n, dtype=bool)
+    is_first[1:] = keys_sorted[1:] != keys_sorted[:-1]
+    group = np.cumsum(is_first) - 1
+    first_sale_amount = sale_amounts_sorted[is_first][group]
+    n_rejected = int(np.count_nonzero(sale_amounts_sorted != first_sale_amount))
+    return np.sort(order[is_first]), n_rejected
+
+
+class Deed(Accumulator):
+    # the columns in the deeds files that accumulate() reads, in the order it receives them
+    columns = (
+        'PROPERTY INDICATOR CODE',
+        'DOCUMENT TYPE CODE',
+        'PRI CAT CODE',
+        'MULTI APN FLAG CODE',
+        'MULTI APN COUNT',
+        'TRANSACTION TYPE CODE',
+        'SALE CODE',
+        'SALE DATE',
+        'APN FORMATTED',
+        'APN UNFORMATTED',
+        'SALE AMOUNT',
+        )
+
+    def __init__(self, conn, config, logger, code_book):
         def get_code(table_name, description):
-            return lookup_code(conn, 'codes_deeds', table_name, description)
+            return code_book.lookup(table_name, description)
 
         self.conn = conn
         self.config = config
@@ -156,80 +782,252 @@ class Deed:
         self.code_new_construction = get_code('TRNTP', 'SUBDIVISION/NEW CONSTRUCTION')
         self.code_sale_full_price = get_code('SCODE', 'SALE PRICE (FULL)')
 
-        self.sale_amounts = {}  # key = (apn, sale_date)  value = sale_amount
+        # the accepted deeds, in the order accumulated; dedupe() keeps the first deed for each sale key
+        self.sale_keys = u.GrowableArray(np.int64)  # from sale_key(apn, sale_date)
+        self.sale_amounts = u.GrowableArray(np.float64)
         self.sale_date_day_0_converted_to_1 = 0
+        self.prefilter = config.get('deeds_prefilter', True)
+        self.engine = config.get('deeds_engine', 'scalar')
+        self.stalls = collections.Counter()  # seconds the reader thread and the accumulation waited
+
+    def screen(self, lines, counter, error_reasons):
+        '''Yield the header line and each line that could be accumulated
+
+        The first checks in accumulate() reject most deeds. They are applied here to the raw tab-delimited
+        lines, splitting only up to the last column they need. The rejected lines are counted as accumulate()
+        would count them. Lines that cannot be checked this way are passed on to be parsed in full.
+        '''
+        header_line = next(lines)
+        yield header_line
+        header = header_line.rstrip('\r\n').split('\t')
+        (index_property_indicator_code,
+         index_document_type_code,
+         index_pri_cat_code,
+         index_multi_apn_flag_code,
+         index_multi_apn_count,
+         ) = [header.index(column_name) for column_name in (
+             'PROPERTY INDICATOR CODE',
+             'DOCUMENT TYPE CODE',
+             'PRI CAT CODE',
+             'MULTI APN FLAG CODE',
+             'MULTI APN COUNT',
+             )]
+        index_max = max(
+            index_property_indicator_code,
+            index_document_type_code,
+            index_pri_cat_code,
+            index_multi_apn_flag_code,
+            index_multi_apn_count,
+            )
+        for line in lines:
+            fields = line.split('\t', index_max + 1)
+            if len(fields) <= index_max:
+                yield line  # a short line
+                continue
+            # the field in the last column would include the line terminator
+            if not fields[index_property_indicator_code].rstrip('\r\n') == self.code_single_family_residence:
+                reason = 'not a single family residence'
+            elif not fields[index_document_type_code].rstrip('\r\n') == self.code_grant_deed:
+                reason = 'deed not a grant deed'
+            elif not fields[index_pri_cat_code].rstrip('\r\n') == self.code_arms_length:
+                reason = 'deed not an arms-length transaction'
+            elif not fields[index_multi_apn_flag_code].rstrip('\r\n') == '':
+                reason = 'deed has multipe APNs'
+            else:
+                try:
+                    if int(fields[index_multi_apn_count]) > 1:
+                        reason = 'deed has multipe APNs'
+                    else:
+                        yield line
+                        continue
+                except ValueError:
+                    yield line  # let accumulate() fail as it always has
+                    continue
+            counter['skipped'] += 1
+            error_reasons[reason] += 1
 
     def accumulate(self, row):
-        '''Mutate self.features or raise u.InputError'''
+        '''Mutate self.sale_keys and self.sale_amounts or raise u.InputError
+
+        row is a tuple with the values of the columns in Deed.columns
+        '''
+        (property_indicator_code,
+         document_type_code,
+         pri_cat_code,
+         multi_apn_flag_code,
+         multi_apn_count,
+         transaction_type_code,
+         sale_code,
+         sale_date_str,
+         apn_formatted,
+         apn_unformatted,
+         sale_amount_str,
+         ) = row
 
         # make sure deed is one that we want
-        if not row['PROPERTY INDICATOR CODE'] == self.code_single_family_residence:
-            raise u.InputError('not a single family residence', row['PROPERTY INDICATOR CODE'])
+        if not property_indicator_code == self.code_single_family_residence:
+            raise u.InputError('not a single family residence', property_indicator_code)
 
-        if not row['DOCUMENT TYPE CODE'] == self.code_grant_deed:
-            raise u.InputError('deed not a grant deed', row['DOCUMENT TYPE CODE'])
+        if not document_type_code == self.code_grant_deed:
+            raise u.InputError('deed not a grant deed', document_type_code)
 
-        if not row['PRI CAT CODE'] == self.code_arms_length:
-            raise u.InputError('deed not an arms-length transaction', row['PRI CAT CODE'])
+        if not pri_cat_code == self.code_arms_length:
+            raise u.InputError('deed not an arms-length transaction', pri_cat_code)
 
         # Assume that if the MULTI APLN FLAG CODE is missing, then one APN was sold
-        if (not row['MULTI APN FLAG CODE'] == '') or int(row['MULTI APN COUNT']) > 1:
-            raise u.InputError('deed has multipe APNs', (row['MULTI APN FLAG CODE'], row['MULTI APN COUNT']))
+        if (not multi_apn_flag_code == '') or int(multi_apn_count) > 1:
+            raise u.InputError('deed has multipe APNs', (multi_apn_flag_code, multi_apn_count))
 
         try:
-            ttc = int(row['TRANSACTION TYPE CODE'])  # convert to int, since leading zeroes are omitted in file
+            ttc = int(transaction_type_code)  # convert to int, since leading zeroes are omitted in file
         except ValueError:
-            raise u.InputError('TRANSACTION TYPE CODE not an int', row['TRANSACTION TYPE CODE'])
+            raise u.InputError('TRANSACTION TYPE CODE not an int', transaction_type_code)
 
         if ttc in (int(self.code_resale), int(self.code_new_construction)):
             pass
         else:
-            raise u.InputError('deed not resale nor new construction', row['TRANSACTION TYPE CODE'])
+            raise u.InputError('deed not resale nor new construction', transaction_type_code)
 
         # Version 1 accepted sale_code_confirmed and sale_code_verified as well
         # However, we don't know that the confirmations and verifications were for a transaction with full price
         # So this version accepts fewer deeds with the hope that those accepted are more accurate.
-        if row['SALE CODE'] == self.code_sale_full_price:
+        if sale_code == self.code_sale_full_price:
             pass  # full price
         else:
-            raise u.InputError('deed not full price', row['SALE CODE'])
+            raise u.InputError('deed not full price', sale_code)
 
         # attempt to extract the feature values
         try:
-            sale_date, e = u.as_date(row['SALE DATE'])
-            if e == '0 to 1':
+            sale_date, e = u.as_date(sale_date_str)
+            if e == 'day 0 to 1':
                 self.sale_date_day_0_converted_to_1 += 1
         except Exception:
             # Earlier versions of this program imputed the sale date from the recording date
             # This version prefers more accurate sales dates rather than more sale amounts
-            raise u.InputError('invalid SALE DATE', row['SALE DATE'])
+            raise u.InputError('invalid SALE DATE', sale_date_str)
 
         if sale_date < self.date_census_became_known:
-            raise u.InputError('sale date before date census became known', row['SALE DATE'])
+            raise u.InputError('sale date before date census became known', sale_date_str)
+
+        # checked after the census date, so that only sale dates beyond the sale key are invalid here
+        if not is_packable_sale_date(sale_date.toordinal() - EPOCH_ORDINAL):
+            raise u.InputError('invalid SALE DATE', sale_date_str)
 
         try:
-            apn = u.best_apn(row['APN FORMATTED'], row['APN UNFORMATTED'])
+            apn = u.best_apn(apn_formatted, apn_unformatted)
         except Exception:
-            raise u.InputError('invalid APN', (row['APN FORMATTED'], row['APN UNFORMATTED']))
+            raise u.InputError('invalid APN', (apn_formatted, apn_unformatted))
+        key = sale_key(apn, sale_date)
 
         try:
-            sale_amount = float(row['SALE AMOUNT'])
+            sale_amount = float(sale_amount_str)
         except Exception:
-            raise u.InputError('invalid SALE AMOUNT', row['SALE AMOUNT'])
+            raise u.InputError('invalid SALE AMOUNT', sale_amount_str)
 
         if sale_amount <= 0:
             raise u.InputError('SALE AMOUNT not positive', sale_amount)
         if sale_amount > self.max_sale_amount:
             raise u.InputError('SALE AMOUNT exceed maximum sale amount', sale_amount)
 
-        key = (apn, sale_date)
-        if key in self.sale_amounts:
-            if self.sale_amounts[key] != sale_amount:
-                # possible one of the extra sale amounts is a correction
-                # but this program doesn't try to handle that condidtion
-                raise u.InputError('multiple deed sale amounts', str((key, sale_amount, self.sale_amounts[key])))
-        else:
-            self.sale_amounts[key] = sale_amount
+        # dedupe() rejects the later deeds for the same sale that have a different sale amount
+        self.sale_keys.append(key)
+        self.sale_amounts.append(sale_amount)
+
+    def accumulate_chunk(self, columns, counter, error_reasons):
+        '''Accumulate a chunk of deeds, as accumulate() would, by evaluating its checks on NumPy arrays
+
+        columns is a list with an array of str for each column in Deed.columns.
+        The accepted deeds are appended to self.sale_keys and self.sale_amounts.
+        '''
+        (property_indicator_code,
+         document_type_code,
+         pri_cat_code,
+         multi_apn_flag_code,
+         multi_apn_count,
+         transaction_type_code,
+         sale_code,
+         sale_date_str,
+         apn_formatted,
+         apn_unformatted,
+         sale_amount_str,
+         ) = columns
+        n_rows = len(property_indicator_code)
+        chunk_filter = ChunkFilter(n_rows, counter, error_reasons)
+        reject = chunk_filter.reject
+        is_alive = chunk_filter.is_alive
+
+        # make sure deed is one that we want
+        reject(property_indicator_code == self.code_single_family_residence, 'not a single family residence')
+        reject(document_type_code == self.code_grant_deed, 'deed not a grant deed')
+        reject(pri_cat_code == self.code_arms_length, 'deed not an arms-length transaction')
+
+        # as in accumulate(), an invalid MULTI APN COUNT raises ValueError
+        has_flag = multi_apn_flag_code != ''
+        needs_count = is_alive & ~has_flag
+        is_multi = has_flag.copy()
+        is_multi[needs_count] = np.array([int(count) > 1 for count in multi_apn_count[needs_count]], dtype=bool)
+        reject(~is_multi, 'deed has multipe APNs')
+
+        # as in accumulate(), an int beyond int64 is not a resale nor a new construction code
+        ttc, is_int = chunk_filter.convert(to_int_as_float_array, transaction_type_code)
+        reject(is_int, 'TRANSACTION TYPE CODE not an int')
+        reject(
+            (ttc == int(self.code_resale)) | (ttc == int(self.code_new_construction)),
+            'deed not resale nor new construction',
+            )
+
+        reject(sale_code == self.code_sale_full_price, 'deed not full price')
+
+        sale_dates = np.zeros(n_rows, dtype='datetime64[D]')
+        is_valid_date = np.zeros(n_rows, dtype=bool)
+        sale_dates[is_alive], is_valid_date[is_alive], is_day_0 = to_date_array(sale_date_str[is_alive])
+        self.sale_date_day_0_converted_to_1 += int(np.count_nonzero(is_day_0))
+        reject(is_valid_date, 'invalid SALE DATE')
+        reject(
+            sale_dates >= np.datetime64(self.date_census_became_known),
+            'sale date before date census became known',
+            )
+        reject(is_packable_sale_date(sale_dates.astype(np.int64)), 'invalid SALE DATE')
+
+        apns, is_valid_apn = chunk_filter.convert_each(u.best_apn, apn_formatted, apn_unformatted)
+        reject(is_valid_apn, 'invalid APN')
+        reject((apns >= 0) & (apns < MAX_APN), 'invalid APN')
+
+        sale_amounts, is_valid_amount = chunk_filter.convert(to_float_array, sale_amount_str)
+        reject(is_valid_amount, 'invalid SALE AMOUNT')
+        reject(sale_amounts > 0, 'SALE AMOUNT not positive')
+        reject(sale_amounts <= self.max_sale_amount, 'SALE AMOUNT exceed maximum sale amount')
+
+        counter['accumulated'] += int(np.count_nonzero(is_alive))
+        self.sale_keys.extend(sale_key_array(apns[is_alive], sale_dates[is_alive]))
+        self.sale_amounts.extend(sale_amounts[is_alive])
+
+    def dedupe(self):
+        '''Mutate self to keep only the first deed accumulated for each sale key
+
+        Return the number of the other deeds that are rejected as multiple deed sale amounts.
+        A later deed with the same sale amount as the first one is a duplicate, not an error.
+        '''
+        # possibly one of the extra sale amounts is a correction
+        # but this program doesn't try to handle that condition
+        indexes, n_rejected = first_sale_amounts(self.sale_keys.values, self.sale_amounts.values)
+        sale_keys = u.GrowableArray(np.int64, len(indexes))
+        sale_keys.extend(self.sale_keys.values[indexes])
+        sale_amounts = u.GrowableArray(np.float64, len(indexes))
+        sale_amounts.extend(self.sale_amounts.values[indexes])
+        self.sale_keys, self.sale_amounts = sale_keys, sale_amounts
+        return n_rejected
+
+    def merge(self, other):
+        '''Mutate self to include the deeds accumulated by other from later files
+
+        The deeds are appended after self's, so that dedupe() treats them exactly as if self
+        had accumulated them itself.
+        '''
+        self.sale_keys.extend(other.sale_keys.values)
+        self.sale_amounts.extend(other.sale_amounts.values)
+        self.sale_date_day_0_converted_to_1 += other.sale_date_day_0_converted_to_1
+        self.stalls.update(other.stalls)
 
     def log_summary(self):
         self.logger.info('%d sale dates with day 0 converted to day 1' % self.sale_date_day_0_converted_to_1)
@@ -251,17 +1049,18 @@ class Deed:
             '''
         )
 
-        for key, sale_amount in self.sale_amounts.items():
-            apn, sale_date = key
-            self.conn.execute(
-                'INSERT INTO deeds VALUES (?, ?, ?, ?, ?, ?)',
-                (apn,
-                 sale_date,
-                 sale_date.year,
-                 sale_date.month,
-                 sale_date.day,
-                 sale_amount,
-                ))
+        # insert each row, a chunk of rows at a time
+        def rows():
+            for start in range(0, len(self.sale_keys), BULK_INSERT_BATCH_SIZE):
+                stop = start + BULK_INSERT_BATCH_SIZE
+                apns, sale_dates = unpack_sale_keys(self.sale_keys.values[start:stop])
+                for apn, sale_date, sale_amount in zip(
+                        apns.tolist(),
+                        sale_dates.tolist(),  # datetime.date values
+                        self.sale_amounts.values[start:stop].tolist()):
+                    yield apn, sale_date, sale_date.year, sale_date.month, sale_date.day, sale_amount
+
+        bulk_insert(self.conn, 'deeds', rows())
         if debug:
             print('first 10 rows in table deeds')
             pdb.set_trace()
@@ -270,77 +1069,191 @@ class Deed:
             pdb.set_trace()
 
 
+def accumulate_deeds(deed, path_zip, counter, error_reasons):
+    '''Accumulate the deeds in one zip file'''
+    debug = False
+    # the screen counts separately, as it may run in the reader thread
+    screen_counter = collections.Counter()
+    screen_error_reasons = collections.Counter()
+    screen = functools.partial(
+        deed.screen,
+        counter=screen_counter,
+        error_reasons=screen_error_reasons,
+        ) if deed.prefilter else None
+    if deed.engine == 'vectorized':
+        for columns in read_archive_chunks(path_zip, Deed.columns, deed.config, screen, deed.stalls):
+            deed.accumulate_chunk(columns, counter, error_reasons)
+        counter.update(screen_counter)
+        error_reasons.update(screen_error_reasons)
+        return
+    for row_index, row in enumerate(read_archive_rows(path_zip, Deed.columns, deed.config, screen, deed.stalls)):
+        if debug:
+            print(row_index)
+            pprint.pprint(row)
+        try:
+            deed.accumulate(row)
+            counter['accumulated'] += 1
+        except u.InputError as err:
+            # logger.warning('deed file %s record %d InputError %s' % (path_zip, row_index + 1, err))
+            counter['skipped'] += 1
+            error_reasons[err.reason] += 1
+    counter.update(screen_counter)
+    error_reasons.update(screen_error_reasons)
+
+
+def log_stalls(config, logger, stalls):
+    '''Log the seconds the reader threads and the accumulation waited for each other, if pipelined'''
+    if config.get('pipeline', False):
+        logger.info('pipeline stalls: reader waited %.1f seconds, accumulation waited %.1f seconds' % (
+            stalls['producer'],
+            stalls['consumer'],
+            ))
+
+
+def read_deeds_worker(config, code_book, zipfilename):
+    '''Return (Deed, counter, error_reasons) for one zip file; run in a worker process'''
+    deed = Deed(None, config, None, code_book)
+    counter = collections.Counter()
+    error_reasons = collections.Counter()
+    accumulate_deeds(deed, os.path.join(config['dir_data'], zipfilename), counter, error_reasons)
+    return deed, counter, error_reasons
+
+
 def read_deeds(conn, config, logger):
     '''Create table deeds from data in deeds zip files'''
     debug = False
 
     counter = collections.Counter()
     error_reasons = collections.Counter()
-    deed = Deed(conn, config, logger)
-    for zipfilename in config['in_deeds']:
-        # inflate the zip files directly because reading the archive members led to unicode issues
-        # and to having to read the entire file into memory
-        if debug:
-            if not zipfilename.endswith('F7.zip'):
-                print('DEBUG: skipping', zipfilename)
-                continue
-        path_zip = os.path.join(config['dir_data'], zipfilename)
-        cp_unzip = subprocess.run([
-            'unzip',
-            '-o',       # overwrite existing inflated file
-            '-dtmp',   # unzip into /tmp in the current directory (which holds the source code)
-            path_zip,
-            ])
+    code_book = read_code_book(config, 'codes_deeds')
+    deed = Deed(conn, config, logger, code_book)
 
-        assert cp_unzip.returncode == 0
-        filename = path_zip.split('/')[-1].split('.')[0]
-        path_txt = os.path.join(os.getcwd(), 'tmp', filename + '.txt')
-        # path_txt = os.path.join('tmp', filename + '.txt')
-        with open(path_txt, encoding='latin-1') as csvfile:
-            # NOTE: When reading ... F3.txt, error raised: _csv.Error: field larger than field limit (131072)
-            # ref: https://stackoverflow.com/questions/15063936/csv-error-field-larger-than-field-limit-131072
-            # Hyp: the problem is that the file contains a quoting char in one of the tab-delimited fields
-            reader = csv.DictReader(csvfile, delimiter='\t', quoting=csv.QUOTE_NONE)
-            for row_index, row in enumerate(reader):
-                if debug and False:
-                    print(row_index)
-                    pprint.pprint(row)
-                try:
-                    deed.accumulate(row)
-                    counter['accumulated'] += 1
-                except u.InputError as err:
-                    # logger.warning('deed file %s record %d InputError %s' % (path_zip, row_index + 1, err))
-                    counter['skipped'] += 1
-                    error_reasons[err.reason] += 1
-                if debug:
-                    if counter['accumulate'] > 100:
-                        break
-        logger.info('read all deeds from %s' % path_zip)
-        cp_rm = subprocess.run(['rm', path_txt])
-        assert cp_rm.returncode == 0
+    zipfilenames = config['in_deeds']
+    if debug:
+        zipfilenames = [zipfilename for zipfilename in zipfilenames if zipfilename.endswith('F7.zip')]
+    checkpoint = config.get('checkpoint', False) or config.get('resume', False)
+    if config.get('workers', 1) > 1 or checkpoint:
+        # each worker accumulates one zip file; the partial results are merged in file order,
+        # so that the table is identical to the one built serially
+        if checkpoint:
+            partials = map_zipfiles_checkpointed(
+                'read_deeds', read_deeds_worker, config, code_book, logger, zipfilenames)
+        else:
+            partials = map_zipfiles(read_deeds_worker, config, code_book, zipfilenames)
+        for zipfilename, (deed_file, counter_file, error_reasons_file) in zip(zipfilenames, partials):
+            deed.merge(deed_file)
+            counter.update(counter_file)
+            error_reasons.update(error_reasons_file)
+            logger.info('read all deeds from %s' % os.path.join(config['dir_data'], zipfilename))
+    else:
+        for zipfilename in zipfilenames:
+            path_zip = os.path.join(config['dir_data'], zipfilename)
+            accumulate_deeds(deed, path_zip, counter, error_reasons)
+            logger.info('read all deeds from %s' % path_zip)
+    # count the accumulated deeds that are rejected for having multiple sale amounts
+    n_rejected = deed.dedupe()
+    if n_rejected != 0:
+        counter['accumulated'] -= n_rejected
+        counter['skipped'] += n_rejected
+        error_reasons['multiple deed sale amounts'] += n_rejected
     logger.info('read all deeds zipfiles')
+    log_stalls(config, logger, deed.stalls)
     deed.log_summary()
     for k, v in counter.items():
         logger.info(' %s occured %d times' % (k, v))
     logger.info('reasons taxroll records were skipped')
     for k, v in error_reasons.items():
         logger.info(' %50s: %d times' % (k, v))
-    deed.create_table()
+    with table_writer(conn, config):
+        deed.create_table()
     pass
 
 
-class Neighborhood:
+def read_sold_apns(conn):
+    '''Return sorted int64 array of the distinct apns in table deeds'''
+    return np.fromiter(
+        (row[0] for row in conn.execute('SELECT DISTINCT apn FROM deeds ORDER BY apn')),
+        dtype=np.int64,
+        )
+
+
+def sorted_lookup(sorted_values, values):
+    '''Return (indexes, is_found) such that sorted_values[indexes] == values where is_found
+
+    sorted_values is a sorted int64 array with distinct values. Where not is_found, the index is 0.
+    '''
+    if len(sorted_values) == 0:
+        return np.zeros(len(values), dtype=np.int64), np.zeros(len(values), dtype=bool)
+    indexes = np.minimum(np.searchsorted(sorted_values, values), len(sorted_values) - 1)
+    is_found = sorted_values[indexes] == values
+    indexes[~is_found] = 0
+    return indexes, is_found
+
+
+def is_member(sorted_values, values):
+    '''Return bool array, True where an int64 in values is also in the sorted int64 array sorted_values'''
+    return sorted_lookup(sorted_values, values)[1]
+
+
+def census_tract_id(spelling):
+    '''Return the int that identifies a census tract in every table, given its spelling in a file
+
+    Raise u.InputError if the spelling is not an int64.
+    '''
+    try:
+        census_tract = int(spelling)
+    except (TypeError, ValueError):
+        raise u.InputError('invalid census tract', spelling)
+    if not -2 ** 63 <= census_tract < 2 ** 63:
+        raise u.InputError('invalid census tract', spelling)
+    return census_tract
+
+
+def create_census_tracts(conn, source, tract_spellings):
+    '''Replace the rows of table census_tracts from a source with those in dict spelling -> census tract id
+
+    Table census_tracts maps each census tract id to its spellings in the taxroll files and in the census file.
+    '''
+    conn.execute(
+        '''CREATE TABLE IF NOT EXISTS census_tracts
+        ( census_tract integer NOT NULL
+        , source       text    NOT NULL
+        , spelling     text    NOT NULL
+        , PRIMARY KEY (source, spelling)
+        )
+        '''
+        )
+    conn.execute('CREATE INDEX IF NOT EXISTS census_tracts_census_tract ON census_tracts (census_tract)')
+    conn.execute('DELETE FROM census_tracts WHERE source = ?', (source,))
+    bulk_insert(
+        conn,
+        'census_tracts',
+        ((census_tract, source, spelling) for spelling, census_tract in sorted(tract_spellings.items())),
+        )
+
+
+class Neighborhood(Accumulator):
     'singleton class, to group together computation and data around neighborhood features'
-    def __init__(self, conn, logger, table_name):
+    # the columns in the taxroll files that accumulate() reads, in the order it receives them
+    columns = (
+        'CENSUS TRACT',
+        'PROPERTY INDICATOR CODE',
+        'UNIVERSAL LAND USE CODE',
+        'LAND SQUARE FOOTAGE',
+        )
+
+    # the kinds of parcels, in the order of the fraction columns in table neighborhoods
+    kinds = ('residential', 'commercial', 'industrial', 'schools', 'parks', 'other')
+
+    def __init__(self, conn, logger, code_book):
         def code_lusei(description):
-            return int(lookup_code(self.conn, self.table_name, 'LUSEI', description))
+            return int(code_book.lookup('LUSEI', description))
 
         def code_propn(description):
-            return int(lookup_code(self.conn, self.table_name, 'PROPN', description))
+            return int(code_book.lookup('PROPN', description))
 
         self.conn = conn
         self.logger = logger
-        self.table_name = table_name
 
         self.propn_skip = set([0])
         self.lusei_skip = set([999])
@@ -393,103 +1306,187 @@ class Neighborhood:
         for k, v in lusei_kind_description.items():
             self.lusei_kinds[code_lusei(k)] = v
 
-        self.parcel_count = collections.defaultdict(collections.Counter)
-        self.parcel_land_square_footage = collections.defaultdict(collections.Counter)
+        self.kind_lookup = self.compile_kind_lookup()
+
+        # the accumulators have a row for each census tract, in the order first seen, and a column for each kind
+        self.tract_rows = {}  # key = census tract id  value = row
+        self.census_tracts = u.GrowableArray(np.int64)  # the census tract id in each row
+        self.parcel_count = np.zeros((0, len(self.kinds)), dtype=np.int64)
+        self.parcel_land_square_footage = np.zeros((0, len(self.kinds)), dtype=np.float64)
+        self.tract_spellings = {}  # key = census tract in the taxroll files  value = census tract id
+
+    def compile_kind_lookup(self):
+        '''Return an int8 array such that [propn_code, lusei_code] is the index of the parcel's kind in self.kinds
+
+        A PROPN code without a kind has -1. The last column is for the LUSEI codes beyond the others,
+        none of which is special.
+        '''
+        def kind(propn_kind, lusei_kind):
+            if propn_kind == 'residential':
+                return 'residential'
+            elif propn_kind == 'commercial':
+                return 'commercial'
+            elif propn_kind == 'Service (general public)':
+                return 'schools' if lusei_kind == 'school' else 'other'
+            elif propn_kind == 'industrial':
+                return 'industrial'
+            elif propn_kind == 'Amusement-Recreation':
+                return 'parks' if lusei_kind == 'park' else 'other'
+            elif propn_kind == 'Exempt':
+                return 'schools' if lusei_kind == 'school' else 'other'
+            elif propn_kind == 'other':
+                return 'other'
+            else:
+                print('cannot happen', propn_kind, lusei_kind)
+                pdb.set_trace()
+
+        n_lusei_codes = max(self.lusei_kinds) + 2
+        kind_lookup = np.full((max(self.propn_kinds) + 1, n_lusei_codes), -1, dtype=np.int8)
+        for propn_code, propn_kind in self.propn_kinds.items():
+            kind_lookup[propn_code, :] = self.kinds.index(kind(propn_kind, 'not special'))
+            for lusei_code, lusei_kind in self.lusei_kinds.items():
+                kind_lookup[propn_code, lusei_code] = self.kinds.index(kind(propn_kind, lusei_kind))
+        return kind_lookup
+
+    def lookup_kinds(self, propn_codes, lusei_codes):
+        '''Return the index in self.kinds for each parcel with the int64 codes, or raise KeyError'''
+        n_propn_codes, n_lusei_codes = self.kind_lookup.shape
+        is_known = (propn_codes >= 0) & (propn_codes < n_propn_codes)
+        if not np.all(is_known):
+            raise KeyError(int(propn_codes[~is_known][0]))
+        lusei_columns = np.where((lusei_codes >= 0) & (lusei_codes < n_lusei_codes), lusei_codes, n_lusei_codes - 1)
+        kinds = self.kind_lookup[propn_codes, lusei_columns]
+        if np.any(kinds < 0):
+            raise KeyError(int(propn_codes[kinds < 0][0]))
+        return kinds
+
+    def tract_row(self, census_tract):
+        '''Return the row of the accumulators for the census tract id, adding a row if needed'''
+        row = self.tract_rows.get(census_tract)
+        if row is None:
+            row = len(self.census_tracts)
+            self.tract_rows[census_tract] = row
+            self.census_tracts.append(census_tract)
+            if row == len(self.parcel_count):
+                # double the capacity
+                n_rows = max(2 * row, 16)
+                parcel_count = np.zeros((n_rows, len(self.kinds)), dtype=np.int64)
+                parcel_count[:row] = self.parcel_count
+                parcel_land_square_footage = np.zeros((n_rows, len(self.kinds)), dtype=np.float64)
+                parcel_land_square_footage[:row] = self.parcel_land_square_footage
+                self.parcel_count = parcel_count
+                self.parcel_land_square_footage = parcel_land_square_footage
+        return row
 
     def accumulate(self, row) -> bool:
         '''Accumulate lot size of the parcel or raise u.InputError'''
-        '''Return True iff neighborhood features were set'''
-
-        def count(census_tract, kind, land_square_footage):
-            self.parcel_count[census_tract][kind] += 1
-            self.parcel_land_square_footage[census_tract][kind] += land_square_footage
-
-        census_tract = row['CENSUS TRACT']
-        propn_code = int(row['PROPERTY INDICATOR CODE'])
-        lusei_code = int(row['UNIVERSAL LAND USE CODE'])
-        land_square_footage_str = row['LAND SQUARE FOOTAGE']
-
-        if census_tract not in self.parcel_count:
-            self.parcel_count[census_tract] = {
-                'residential': 0,  # count of parcels that are residential
-                'commercial': 0,   # count of parcels that are commercial
-                'industrial': 0,   # ...
-                'other': 0,
-                'total': 0,
-                'school': 0,
-                'park': 0,
-                }
-
-        if census_tract == '':
-            raise u.InputError('missing census_tract', census_tract)
+        '''row is a tuple with the values of the columns in Neighborhood.columns'''
+
+        census_tract_str, propn_code_str, lusei_code_str, land_square_footage_str = row
+        propn_code = int(propn_code_str)
+        lusei_code = int(lusei_code_str)
+
+        if census_tract_str == '':
+            raise u.InputError('missing census_tract', census_tract_str)
+        census_tract = census_tract_id(census_tract_str)
+        self.tract_spellings[census_tract_str] = census_tract
+        tract_row = self.tract_row(census_tract)
+
         if propn_code in self.propn_skip:
             raise u.InputError('PROPN code is to be skipped', propn_code)
         if lusei_code in self.lusei_skip:
             raise u.InputError('LUSEI code is to be skipped', lusei_code)
-        if census_tract == '' or propn_code in self.propn_skip or lusei_code in self.lusei_skip:
-            return False
         try:
             land_square_footage = int(land_square_footage_str)
         except ValueError:
             pdb.set_trace()
             raise u.InputError('LAND SQUARE FOOTAGE not an int', land_square_footage_str)
 
-        propn_kind = self.propn_kinds[propn_code]
-        lusei_kind = self.lusei_kinds.get(lusei_code, 'not special')
-        if propn_kind == 'residential':
-            count(census_tract, 'residential', land_square_footage)
-        elif propn_kind == 'commercial':
-            count(census_tract, 'commercial', land_square_footage)
-        elif propn_kind == 'Service (general public)':
-            if lusei_kind == 'school':
-                count(census_tract, 'school', land_square_footage)
-            else:
-                count(census_tract, 'other', land_square_footage)
-        elif propn_kind == 'industrial':
-            count(census_tract, 'industrial', land_square_footage)
-        elif propn_kind == 'Amusement-Recreation':
-            if lusei_kind == 'park':
-                count(census_tract, 'park', land_square_footage)
-            else:
-                count(census_tract, 'other', land_square_footage)
-        elif propn_kind == 'Exempt':
-            if lusei_kind == 'school':
-                count(census_tract, 'school', land_square_footage)
-            else:
-                count(census_tract, 'other', land_square_footage)
-        elif propn_kind == 'other':
-            count(census_tract, 'other', land_square_footage)
-        else:
-            print('cannot happen', propn_kind, lusei_kind)
-            pdb.set_trace()
+        n_propn_codes, n_lusei_codes = self.kind_lookup.shape
+        if not 0 <= propn_code < n_propn_codes or self.kind_lookup[propn_code, 0] < 0:
+            raise KeyError(propn_code)
+        kind = self.kind_lookup[propn_code, lusei_code if 0 <= lusei_code < n_lusei_codes else -1]
+        self.parcel_count[tract_row, kind] += 1
+        self.parcel_land_square_footage[tract_row, kind] += land_square_footage
+
+    def accumulate_chunk(self, columns, counter, error_reasons):
+        '''Accumulate a chunk of parcels, as accumulate() would, and return the bool array of those accepted
+
+        columns is a list with an array of str for each column in Neighborhood.columns.
+        '''
+        census_tract_str, propn_code_str, lusei_code_str, land_square_footage_str = columns
+        n_rows = len(census_tract_str)
+        chunk_filter = ChunkFilter(n_rows, counter, error_reasons)
+        reject = chunk_filter.reject
+        is_alive = chunk_filter.is_alive
+
+        # as in accumulate(), codes that are not ints raise ValueError
+        # and a PROPN code beyond int64 raises KeyError, while a LUSEI code beyond int64 is not special
+        propn_codes, is_int = to_int_array(propn_code_str)
+        if not np.all(is_int):
+            raise KeyError(int(propn_code_str[~is_int][0]))
+        lusei_codes, is_int = to_int_array(lusei_code_str)
+        if not np.all(is_int):
+            for lusei_code_str_invalid in lusei_code_str[~is_int].tolist():
+                int(lusei_code_str_invalid)
+            lusei_codes[~is_int] = -1
+
+        reject(census_tract_str != '', 'missing census_tract')
+        spellings, spelling_indexes = np.unique(census_tract_str, return_inverse=True)
+        tract_rows_spellings = np.full(len(spellings), -1, dtype=np.int64)
+        for i, spelling in enumerate(spellings.tolist()):
+            if spelling == '':
+                continue
+            try:
+                census_tract = census_tract_id(spelling)
+            except u.InputError:
+                continue
+            self.tract_spellings[spelling] = census_tract
+            tract_rows_spellings[i] = self.tract_row(census_tract)
+        tract_rows = tract_rows_spellings[spelling_indexes]
+        reject(tract_rows >= 0, 'invalid census tract')
+
+        reject(~np.isin(propn_codes, list(self.propn_skip)), 'PROPN code is to be skipped')
+        reject(~np.isin(lusei_codes, list(self.lusei_skip)), 'LUSEI code is to be skipped')
+        land_square_footage, is_valid = chunk_filter.convert(to_int_as_float_array, land_square_footage_str)
+        reject(is_valid, 'LAND SQUARE FOOTAGE not an int')
+
+        kinds = self.lookup_kinds(propn_codes[is_alive], lusei_codes[is_alive])
+        np.add.at(self.parcel_count, (tract_rows[is_alive], kinds), 1)
+        np.add.at(self.parcel_land_square_footage, (tract_rows[is_alive], kinds), land_square_footage[is_alive])
+        return is_alive
+
+    def merge(self, other):
+        '''Mutate self to include the parcels counted by other'''
+        n_other = len(other.census_tracts)
+        rows = np.array([self.tract_row(census_tract) for census_tract in other.census_tracts.values.tolist()],
+                        dtype=np.int64)
+        self.parcel_count[rows] += other.parcel_count[:n_other]
+        self.parcel_land_square_footage[rows] += other.parcel_land_square_footage[:n_other]
+        self.tract_spellings.update(other.tract_spellings)
 
     def log_summary(self):
         self.logger.info('neighborhood summary')
-        parcel_count = self.parcel_count
-        parcel_land_square_footage = self.parcel_land_square_footage
-        self.logger.info('found %d census tracts' % len(parcel_count))
-        for census_tract, census_tract_counts in parcel_count.items():
-            # determine totals across kinds
-            total_count = 0
-            for kind, count in census_tract_counts.items():
-                total_count += count
-            total_land_square_footage = 0
-            for kind, land_square_footage in parcel_land_square_footage[census_tract].items():
-                total_land_square_footage += land_square_footage
-
+        n_tracts = len(self.census_tracts)
+        parcel_count = self.parcel_count[:n_tracts]
+        parcel_land_square_footage = self.parcel_land_square_footage[:n_tracts]
+        self.logger.info('found %d census tracts' % n_tracts)
+        total_land_square_footage = parcel_land_square_footage.sum(axis=1)
+        for row, census_tract in enumerate(self.census_tracts.values.tolist()):
             # print counts and fractions by kind
             line_counts = 'census_tract %s counts: ' % census_tract
-            for kind, count in census_tract_counts.items():
+            for kind, count in zip(self.kinds, parcel_count[row].tolist()):
                 if count > 0:
                     line_counts += '%s %d ' % (kind, count)
-            self.logger.info(line_counts)
+            # a high-volume summary, limited if config['logging_rate_limit']
+            self.logger.info(line_counts, extra={'rate_limit': True})
 
             line_land = 'census_tract %s land area: ' % census_tract
-            for kind, land_square_footage in parcel_land_square_footage[census_tract].items():
+            for kind, land_square_footage in zip(self.kinds, parcel_land_square_footage[row].tolist()):
                 if land_square_footage > 0:
-                    line_land += '%s %4.2f ' % (kind, land_square_footage / total_land_square_footage)
-            self.logger.info(line_land)
-            self.logger.info('')
+                    line_land += '%s %4.2f ' % (kind, land_square_footage / total_land_square_footage[row])
+            self.logger.info(line_land, extra={'rate_limit': True})
+            self.logger.info('', extra={'rate_limit': True})
 
     def create_table(self):
         '''insert table into the data base'''
@@ -498,7 +1495,7 @@ class Neighborhood:
         self.conn.execute(drop_stmt)
 
         create_stmt = '''CREATE TABLE neighborhoods
-        ( census_tract                             text    NOT NULL
+        ( census_tract                             integer NOT NULL
         , fraction_land_square_footage_residential real    NOT NULL
         , fraction_land_square_footage_commercial  real    NOT NULL
         , fraction_land_square_footage_industrial  real    NOT NULL
@@ -510,63 +1507,162 @@ class Neighborhood:
         '''
         self.conn.execute(create_stmt)
 
+        # determine the fractions for the census tracts with at least one parcel counted
+        n_tracts = len(self.census_tracts)
+        is_counted = self.parcel_count[:n_tracts].sum(axis=1) > 0
+        census_tracts = self.census_tracts.values[is_counted]
+        land_square_footage = self.parcel_land_square_footage[:n_tracts][is_counted]
+        total = land_square_footage.sum(axis=1)
+        has_land = total > 0.0
+        # skip census tracts with no land
+        for census_tract in census_tracts[~has_land].tolist():
+            print(census_tract, 'has no land')
+        fractions = land_square_footage[has_land] / total[has_land, np.newaxis]
+
         # insert each row
+        bulk_insert(
+            self.conn,
+            'neighborhoods',
+            (((census_tract,) + tuple(fractions_row))
+             for census_tract, fractions_row in zip(census_tracts[has_land].tolist(), fractions.tolist())),
+            )
         counter = collections.Counter()
-        for census_tract, fractions_land_square_footage in self.parcel_land_square_footage.items():
-            total = 0.0
-            for k, v in fractions_land_square_footage.items():
-                total += v
-            if total == 0.0:
-                # skip census tracts with no land
-                print(census_tract, fractions_land_square_footage)
-                counter['skipped no land'] += 1
-                continue
-            self.conn.execute(
-                'INSERT INTO neighborhoods VALUES (?, ?, ?, ?, ?, ?, ?)',
-                ((census_tract,
-                  fractions_land_square_footage.get('residential', 0.0) / total,
-                  fractions_land_square_footage.get('commercial', 0.0) / total,
-                  fractions_land_square_footage.get('industrial', 0.0) / total,
-                  fractions_land_square_footage.get('schools', 0.0) / total,
-                  fractions_land_square_footage.get('parks', 0.0) / total,
-                  fractions_land_square_footage.get('other', 0.0) / total,
-                  )))
-            counter['inserted'] += 1
+        counter['inserted'] = int(np.count_nonzero(has_land))
+        counter['skipped no land'] = int(np.count_nonzero(~has_land))
         for k, v in counter.items():
-            self.logger.info('neighborhoods %s: %d' % (k, v))
-
+            if v > 0:
+                self.logger.info('neighborhoods %s: %d' % (k, v))
+
+
+class Parcel(Accumulator):
+    # the features after the property city; True if the value must be positive, False if it must be nonnegative
+    numeric_features = (
+        ('total_value_calculated', 'TOTAL VALUE CALCULATED', True),
+        ('land_square_footage', 'LAND SQUARE FOOTAGE', True),
+        ('living_square_feet', 'LIVING SQUARE FEET', True),
+        ('effective_year_built', 'EFFECTIVE YEAR BUILT', True),
+        ('bedrooms', 'BEDROOMS', True),
+        ('total_rooms', 'TOTAL ROOMS', True),
+        ('total_baths', 'TOTAL BATHS', True),
+        ('fireplace_number', 'FIREPLACE NUMBER', False),
+        ('parking_spaces', 'PARKING SPACES', False),
+        ('units_number', 'UNITS NUMBER', True),
+        )
 
-class Parcel:
-    def __init__(self, conn, logger):
-        self.conn = conn
-        self.logger = logger
+    # the columns in the taxroll files that accumulate() reads, in the order it receives them
+    columns = (
+        'PROPERTY INDICATOR CODE',
+        'APN FORMATTED',
+        'APN UNFORMATTED',
+        'CENSUS TRACT',
+        'PROPERTY CITY',
+        'TOTAL VALUE CALCULATED',
+        'LAND SQUARE FOOTAGE',
+        'LIVING SQUARE FEET',
+        'EFFECTIVE YEAR BUILT',
+        'BEDROOMS',
+        'TOTAL ROOMS',
+        'TOTAL BATHS',
+        'FIREPLACE NUMBER',
+        'PARKING SPACES',
+        'POOL FLAG',
+        'UNITS NUMBER',
+        )
 
-        self.propn_code_single_family_residential = lookup_code(
-            conn,
-            'codes_taxrolls',
-            'PROPN',
-            'Single Family Residence / Townhouse',
+    # the features of each parcel, in the order of the columns in table parcels, and the dtypes of their arrays
+    feature_dtypes = (
+        ('census_tract', np.int64),
+        ('property_city', np.int32),  # index in self.property_cities
+        ('total_value_calculated', np.float64),
+        ('land_square_footage', np.float64),
+        ('living_square_feet', np.float64),
+        ('effective_year_built', np.float64),
+        ('bedrooms', np.float64),
+        ('total_rooms', np.float64),
+        ('total_baths', np.float64),
+        ('fireplace_number', np.float64),
+        ('parking_spaces', np.float64),
+        ('has_pool', np.float64),
+        ('units_number', np.float64),
         )
 
-        self.features = {}
+    def __init__(self, conn, config, logger, code_book, sold_apns=None):
+        self.conn = conn
+        self.logger = logger
+        self.config = config
+        self.engine = config.get('taxrolls_engine', 'scalar')
+        self.sold_apns = sold_apns  # if not None, the sorted int64 apns of the only parcels to accumulate
+        # accumulate() looks up each apn in a set; accumulate_chunk() uses is_member
+        self.sold_apn_set = None
+        if sold_apns is not None and self.engine != 'vectorized':
+            self.sold_apn_set = set(sold_apns.tolist())
+        self.stalls = collections.Counter()  # seconds the reader thread and the accumulation waited
+
+        self.propn_code_single_family_residential = code_book.lookup('PROPN', 'Single Family Residence / Townhouse')
+
+        # the features are stored by column: row i of each array holds a feature of the i-th apn accumulated
+        self.rows = {}  # key = apn  value = row
+        self.apns = u.GrowableArray(np.int64)
+        self.features = {feature_name: u.GrowableArray(dtype) for feature_name, dtype in self.feature_dtypes}
+        self.property_cities = []  # the distinct property cities
+        self.property_city_codes = {}  # key = property city  value = index in self.property_cities
         self.accumulated = 0
+        self.duplicate_apns = 0
+
+    def encode_property_city(self, property_city):
+        '''Return the index of property_city in self.property_cities, adding it if needed'''
+        code = self.property_city_codes.get(property_city)
+        if code is None:
+            code = len(self.property_cities)
+            self.property_cities.append(property_city)
+            self.property_city_codes[property_city] = code
+        return code
+
+    def store(self, apns, features):
+        '''Store the features of the parcels with the apns in list apns
+
+        features is a dict of arrays or sequences with a value for each apn. As in a dict, a parcel whose apn
+        was already stored replaces the earlier one in its row. Return the number of parcels replaced.
+        '''
+        rows = np.empty(len(apns), dtype=np.int64)
+        n_rows = len(self.rows)
+        n_replaced = 0
+        for i, apn in enumerate(apns):
+            row = self.rows.get(apn)
+            if row is None:
+                row = n_rows
+                self.rows[apn] = row
+                n_rows += 1
+                self.apns.append(apn)
+            else:
+                n_replaced += 1
+            rows[i] = row
+        # when an apn occurs more than once, the last one wins
+        unique_rows, last_reversed = np.unique(rows[::-1], return_index=True)
+        last = len(rows) - 1 - last_reversed
+        for feature_name, _ in self.feature_dtypes:
+            array = self.features[feature_name]
+            array.extend(np.zeros(n_rows - len(array), dtype=array.values.dtype))
+            array.values[unique_rows] = np.asarray(features[feature_name])[last]
+        return n_replaced
 
     def accumulate(self, row):
-        'accumulate features of the parcel into self.features'''
+        '''accumulate features of the parcel into self.features
+
+        row is a tuple with the values of the columns in Parcel.columns
+        '''
         debug = False
 
-        def extract_nonnegative_float(field_name):
+        def extract_nonnegative_float(field_name, value_str):
             try:
-                value_str = row[field_name]
                 value = float(value_str)
                 assert value >= 0.0
                 return value
             except Exception:
                 raise u.InputError('invalid %s' % field_name, value_str)
 
-        def extract_positive_float(field_name):
+        def extract_positive_float(field_name, value_str):
             try:
-                value_str = row[field_name]
                 value = float(value_str)
                 assert value > 0.0
                 return value
@@ -576,80 +1672,173 @@ class Parcel:
         if debug:
             pprint.pprint(row)
 
+        (propn_code,
+         apn_formatted,
+         apn_unformatted,
+         census_tract_str,
+         property_city,
+         total_value_calculated_str,
+         land_square_footage_str,
+         living_square_feet_str,
+         effective_year_built_str,
+         bedrooms_str,
+         total_rooms_str,
+         total_baths_str,
+         fireplace_number_str,
+         parking_spaces_str,
+         pool_flag,
+         units_number_str,
+         ) = row
+
         try:
-            propn_code = row['PROPERTY INDICATOR CODE']
             assert propn_code == self.propn_code_single_family_residential
         except AssertionError:
             raise u.InputError('not single family residence', propn_code)
 
         try:
-            apn = u.best_apn(row['APN FORMATTED'], row['APN UNFORMATTED'])
+            apn = u.best_apn(apn_formatted, apn_unformatted)
         except Exception:
             pdb.set_trace()
-            raise u.InputError('invalid APN', (row['APN UNFORMATTED'], row['APN FORMATTED']))
+            raise u.InputError('invalid APN', (apn_unformatted, apn_formatted))
 
-        try:
-            census_tract = int(row['CENSUS TRACT'])
-        except Exception:
-            pdb.set_trace()
-            raise u.InputError('invalid census tract', row['CENSUS TRACT'])
+        if self.sold_apn_set is not None and apn not in self.sold_apn_set:
+            raise u.InputError('apn not in deeds', apn)
+
+        census_tract = census_tract_id(census_tract_str)
 
         try:
-            property_city = row['PROPERTY CITY']
             assert len(property_city) > 0
         except AssertionError:
-            raise u.InputError('invalid property_city', row['PROPERTY CITY'])
-
-        total_value_calculated = extract_positive_float('TOTAL VALUE CALCULATED')
-        land_square_footage = extract_positive_float('LAND SQUARE FOOTAGE')
-        living_square_feet = extract_positive_float('LIVING SQUARE FEET')
-        effective_year_built = extract_positive_float('EFFECTIVE YEAR BUILT')
-        bedrooms = extract_positive_float('BEDROOMS')
-        total_rooms = extract_positive_float('TOTAL ROOMS')
-        total_baths = extract_positive_float('TOTAL BATHS')
-        fireplace_number = extract_nonnegative_float('FIREPLACE NUMBER')
-        parking_spaces = extract_nonnegative_float('PARKING SPACES')
-        has_pool = 1.0 if row['POOL FLAG'] == 'Y' else 0.0
-        units_number = extract_positive_float('UNITS NUMBER')
+            raise u.InputError('invalid property_city', property_city)
+
+        total_value_calculated = extract_positive_float('TOTAL VALUE CALCULATED', total_value_calculated_str)
+        land_square_footage = extract_positive_float('LAND SQUARE FOOTAGE', land_square_footage_str)
+        living_square_feet = extract_positive_float('LIVING SQUARE FEET', living_square_feet_str)
+        effective_year_built = extract_positive_float('EFFECTIVE YEAR BUILT', effective_year_built_str)
+        bedrooms = extract_positive_float('BEDROOMS', bedrooms_str)
+        total_rooms = extract_positive_float('TOTAL ROOMS', total_rooms_str)
+        total_baths = extract_positive_float('TOTAL BATHS', total_baths_str)
+        fireplace_number = extract_nonnegative_float('FIREPLACE NUMBER', fireplace_number_str)
+        parking_spaces = extract_nonnegative_float('PARKING SPACES', parking_spaces_str)
+        has_pool = 1.0 if pool_flag == 'Y' else 0.0
+        units_number = extract_positive_float('UNITS NUMBER', units_number_str)
 
         try:
-            assert apn not in self.features
+            assert apn not in self.rows
         except Exception:
             print('duplicate apn', apn)
             pdb.set_trace()
 
-        self.features[apn] = {
-            'census_tract': census_tract,
-            'property_city': property_city,
-            'total_value_calculated': total_value_calculated,
-            'land_square_footage': land_square_footage,
-            'living_square_feet': living_square_feet,
-            'effective_year_built': effective_year_built,
-            'bedrooms': bedrooms,
-            'total_rooms': total_rooms,
-            'total_baths': total_baths,
-            'fireplace_number': fireplace_number,
-            'parking_spaces': parking_spaces,
-            'has_pool': has_pool,
-            'units_number': units_number,
-            }
+        features = (
+            census_tract,
+            self.encode_property_city(property_city),
+            total_value_calculated,
+            land_square_footage,
+            living_square_feet,
+            effective_year_built,
+            bedrooms,
+            total_rooms,
+            total_baths,
+            fireplace_number,
+            parking_spaces,
+            has_pool,
+            units_number,
+            )
+        row = self.rows.get(apn)
+        if row is None:
+            self.rows[apn] = len(self.apns)
+            self.apns.append(apn)
+            for (feature_name, _), value in zip(self.feature_dtypes, features):
+                self.features[feature_name].append(value)
+        else:
+            for (feature_name, _), value in zip(self.feature_dtypes, features):
+                self.features[feature_name].values[row] = value
         if debug:
             print('apn', apn)
-            pprint.pprint(self.features[apn])
+            pprint.pprint(features)
         self.accumulated += 1
 
+    def accumulate_chunk(self, columns, counter, error_reasons):
+        '''Accumulate a chunk of parcels, as accumulate() would, by evaluating its checks on NumPy arrays
+
+        columns is a list with an array of str for each column in Parcel.columns.
+        Unlike accumulate(), an invalid APN or census tract is rejected without entering the debugger.
+        '''
+        n_rows = len(columns[0])
+        if n_rows == 0:
+            return
+        columns = dict(zip(self.columns, columns))
+        chunk_filter = ChunkFilter(n_rows, counter, error_reasons)
+        reject = chunk_filter.reject
+
+        reject(
+            columns['PROPERTY INDICATOR CODE'] == self.propn_code_single_family_residential,
+            'not single family residence',
+            )
+        apns, is_valid_apn = chunk_filter.convert_each(
+            u.best_apn,
+            columns['APN FORMATTED'],
+            columns['APN UNFORMATTED'],
+            )
+        reject(is_valid_apn, 'invalid APN')
+        if self.sold_apns is not None:
+            reject(is_member(self.sold_apns, apns), 'apn not in deeds')
+        census_tracts, is_valid_census_tract = chunk_filter.convert(to_int_array, columns['CENSUS TRACT'])
+        reject(is_valid_census_tract, 'invalid census tract')
+        reject(columns['PROPERTY CITY'] != '', 'invalid property_city')
+
+        # convert each numeric column in one pass, attributing each parcel to the first invalid feature
+        values = {}
+        for feature_name, column_name, must_be_positive in self.numeric_features:
+            floats, is_valid = chunk_filter.convert(to_float_array, columns[column_name])
+            reject(is_valid & ((floats > 0.0) if must_be_positive else (floats >= 0.0)), 'invalid %s' % column_name)
+            values[feature_name] = floats
+        has_pool = np.where(columns['POOL FLAG'] == 'Y', 1.0, 0.0)
+
+        is_alive = chunk_filter.is_alive
+        n_alive = int(np.count_nonzero(is_alive))
+        counter['retained'] += n_alive
+        values['census_tract'] = census_tracts[is_alive]
+        property_cities, codes = np.unique(columns['PROPERTY CITY'][is_alive], return_inverse=True)
+        values['property_city'] = np.array(
+            [self.encode_property_city(property_city) for property_city in property_cities.tolist()],
+            dtype=np.int32,
+            )[codes]
+        for feature_name, _, _ in self.numeric_features:
+            values[feature_name] = values[feature_name][is_alive]
+        values['has_pool'] = has_pool[is_alive]
+        n_replaced = self.store(apns[is_alive].tolist(), values)
+        self.duplicate_apns += n_replaced
+        self.accumulated += n_alive
+
+    def merge(self, other):
+        '''Mutate self to include the parcels accumulated by other from a later file'''
+        features = {feature_name: other.features[feature_name].values for feature_name, _ in self.feature_dtypes}
+        features['property_city'] = np.array(
+            [self.encode_property_city(property_city) for property_city in other.property_cities],
+            dtype=np.int32,
+            )[features['property_city']]
+        # as in accumulate, the later parcel replaces the earlier one
+        n_replaced = self.store(other.apns.values.tolist(), features)
+        if n_replaced > 0:
+            self.logger.warning('%d duplicate apns in different taxroll files' % n_replaced)
+            self.duplicate_apns += n_replaced
+        self.accumulated += other.accumulated
+        self.duplicate_apns += other.duplicate_apns
+        self.stalls.update(other.stalls)
+
     def log_summary(self):
         '''summarize data, including num distinct values, mean, and variance'''
         self.logger.info('parcels summary')
-        self.logger.info('created %d SFR parcels' % len(self.features))
+        self.logger.info('created %d SFR parcels' % len(self.rows))
+        if self.duplicate_apns > 0:
+            self.logger.info('replaced %d parcels with duplicate apns' % self.duplicate_apns)
 
         # determine distinct values for each feature
-        distinct_values = collections.defaultdict(set)
-        for apn, features in self.features.items():
-            for feature_name, feature_value in features.items():
-                distinct_values[feature_name].add(feature_value)
-        for feature_name, distinct_value_list in distinct_values.items():
-            self.logger.info('feature %s: %d distinct values' % (feature_name, len(distinct_value_list)))
+        distinct_values = {}
+        for feature_name, _ in self.feature_dtypes:
+            distinct_values[feature_name] = np.unique(self.features[feature_name].values)
+            self.logger.info('feature %s: %d distinct values' % (feature_name, len(distinct_values[feature_name])))
         self.distinct_values = distinct_values
 
     def create_tables(self):
@@ -660,7 +1849,7 @@ class Parcel:
 
         create_stmt = '''CREATE TABLE parcels
         ( apn                    integer NOT NULL
-        , census_tract           text    NOT NULL
+        , census_tract           integer NOT NULL
         , property_city          text    NOT NULL
         , total_value_calculated real NOT NULL
         , land_square_footage    real NOT NULL
@@ -678,83 +1867,103 @@ class Parcel:
         '''
         self.conn.execute(create_stmt)
 
-        # insert each row
-        for apn, features in self.features.items():
-            self.conn.execute(
-                'INSERT INTO parcels VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
-                ((apn,
-                  features['census_tract'],
-                  features['property_city'],
-                  features['total_value_calculated'],
-                  features['land_square_footage'],
-                  features['living_square_feet'],
-                  features['effective_year_built'],
-                  features['bedrooms'],
-                  features['total_rooms'],
-                  features['total_baths'],
-                  features['fireplace_number'],
-                  features['parking_spaces'],
-                  features['has_pool'],
-                  features['units_number'],
-                  )))
+        # insert each row, a chunk of rows at a time
+        def rows():
+            property_cities = np.array(self.property_cities, dtype=object)
+            for start in range(0, len(self.apns), BULK_INSERT_BATCH_SIZE):
+                stop = start + BULK_INSERT_BATCH_SIZE
+                columns = [self.apns.values[start:stop].tolist()]
+                for feature_name, _ in self.feature_dtypes:
+                    values = self.features[feature_name].values[start:stop]
+                    columns.append((property_cities[values] if feature_name == 'property_city' else values).tolist())
+                yield from zip(*columns)
 
+        bulk_insert(self.conn, 'parcels', rows())
 
-def read_taxrolls(conn, config, logger):
-    '''Create table parcels from data in taxroll zip files'''
 
+def accumulate_taxrolls(neighborhood, parcel, path_zip, counter, error_reasons):
+    '''Accumulate the parcels in one zip file'''
     debug = False
+    n_neighborhood_columns = len(Neighborhood.columns)
+    column_names = Neighborhood.columns + Parcel.columns
+    if parcel.engine == 'vectorized':
+        # every parcel goes to the neighborhood; the ones it accepts go to the parcel a chunk at a time
+        for columns in read_archive_chunks(path_zip, column_names, parcel.config, stalls=parcel.stalls):
+            is_accepted = neighborhood.accumulate_chunk(columns[:n_neighborhood_columns], counter, error_reasons)
+            parcel.accumulate_chunk(
+                [column[is_accepted] for column in columns[n_neighborhood_columns:]],
+                counter,
+                error_reasons,
+                )
+        return
+    for row_index, row in enumerate(read_archive_rows(path_zip, column_names, parcel.config, stalls=parcel.stalls)):
+        if debug:
+            print(row_index)
+
+        try:
+            neighborhood.accumulate(row[:n_neighborhood_columns])
+            parcel.accumulate(row[n_neighborhood_columns:])
+            counter['retained'] += 1
+        except u.InputError as err:
+            counter['skipped'] += 1
+            error_reasons[err.reason] += 1
+            continue
+        if debug and parcel.accumulated > 100:
+            break
+
+
+def read_taxrolls_worker(config, code_book, zipfilename, sold_apns=None):
+    '''Return (Neighborhood, Parcel, counter, error_reasons) for one zip file; run in a worker process'''
+    neighborhood = Neighborhood(None, None, code_book)
+    parcel = Parcel(None, config, None, code_book, sold_apns)
     counter = collections.Counter()
     error_reasons = collections.Counter()
-    neighborhood = Neighborhood(conn, logger, 'codes_taxrolls')
-    parcel = Parcel(conn, logger)
-    n_retained = 0
-    n_skipped = 0
-    for zipfilename in config['in_taxrolls']:
-        # inflate the zip files directly because reading the archive members led to unicode issues
-        # and to having to read the entire file into memory
-        if debug:
-            if not zipfilename.endswith('F1.zip'):
-                print('DEBUG: skipping', zipfilename)
-                continue
-        path_zip = os.path.join(config['dir_data'], zipfilename)
-        cp_unzip = subprocess.run([
-            'unzip',
-            '-o',       # overwrite existing inflated file
-            '-dtmp',   # unzip into /tmp in the current directory (which holds the source code)
-            path_zip,
-            ])
+    accumulate_taxrolls(neighborhood, parcel, os.path.join(config['dir_data'], zipfilename), counter, error_reasons)
+    return neighborhood, parcel, counter, error_reasons
 
-        assert cp_unzip.returncode == 0
-        filename = path_zip.split('/')[-1].split('.')[0]
-        path_txt = os.path.join(os.getcwd(), 'tmp', filename + '.txt')
-        # path_txt = os.path.join('tmp', filename + '.txt')
-        with open(path_txt, encoding='latin-1') as csvfile:
-            # NOTE: When reading ... F3.txt, error raised: _csv.Error: field larger than field limit (131072)
-            # ref: https://stackoverflow.com/questions/15063936/csv-error-field-larger-than-field-limit-131072
-            # Hyp: the problem is that the file contains a quoting char in one of the tab-delimited fields
-            reader = csv.DictReader(csvfile, delimiter='\t', quoting=csv.QUOTE_NONE)
-            for row_index, row in enumerate(reader):
-                if debug:
-                    print(row_index)
 
-                try:
-                    neighborhood.accumulate(row)
-                    parcel.accumulate(row)
-                    n_retained += 1
-                except u.InputError as err:
-                    counter['skipped'] += 1
-                    error_reasons[err.reason] += 1
-                    n_skipped += 1
-                    continue
-                if debug and parcel.accumulated > 100:
-                    break
-                continue
-        logger.info('read all deeds from %s' % path_zip)
-        cp_rm = subprocess.run(['rm', path_txt])
-        assert cp_rm.returncode == 0
+def read_taxrolls(conn, config, logger):
+    '''Create table parcels from data in taxroll zip files'''
+
+    debug = False
+    counter = collections.Counter()
+    error_reasons = collections.Counter()
+    code_book = read_code_book(config, 'codes_taxrolls')
+    sold_apns = None
+    if config.get('parcels_sold_only', False):
+        # the stage runs after read_deeds
+        sold_apns = read_sold_apns(conn)
+        logger.info('keeping the features of the parcels with the %d apns in table deeds' % len(sold_apns))
+    worker = functools.partial(read_taxrolls_worker, sold_apns=sold_apns)
+    neighborhood = Neighborhood(conn, logger, code_book)
+    parcel = Parcel(conn, config, logger, code_book, sold_apns)
+    zipfilenames = config['in_taxrolls']
+    if debug:
+        zipfilenames = [zipfilename for zipfilename in zipfilenames if zipfilename.endswith('F1.zip')]
+    checkpoint = config.get('checkpoint', False) or config.get('resume', False)
+    if config.get('workers', 1) > 1 or checkpoint:
+        # each worker accumulates one zip file; the partial results are combined in file order
+        if checkpoint:
+            partials = map_zipfiles_checkpointed(
+                'read_taxrolls', worker, config, code_book, logger, zipfilenames)
+        else:
+            partials = map_zipfiles(worker, config, code_book, zipfilenames)
+        for zipfilename, (neighborhood_file, parcel_file, counter_file, error_reasons_file) in zip(
+                zipfilenames, partials):
+            neighborhood.merge(neighborhood_file)
+            parcel.merge(parcel_file)
+            counter.update(counter_file)
+            error_reasons.update(error_reasons_file)
+            logger.info('read all deeds from %s' % os.path.join(config['dir_data'], zipfilename))
+    else:
+        for zipfilename in zipfilenames:
+            path_zip = os.path.join(config['dir_data'], zipfilename)
+            accumulate_taxrolls(neighborhood, parcel, path_zip, counter, error_reasons)
+            logger.info('read all deeds from %s' % path_zip)
     print('read all taxroll zipfiles')
-    logger.info('retained %d parcels' % n_retained)
-    logger.info('skipped %d parcels' % n_skipped)
+    log_stalls(config, logger, parcel.stalls)
+    logger.info('retained %d parcels' % counter['retained'])
+    logger.info('skipped %d parcels' % counter['skipped'])
     logger.info(' ')
     logger.info('reasons parcel was not saved')
     for reason in error_reasons.keys():
@@ -762,151 +1971,323 @@ def read_taxrolls(conn, config, logger):
 
     # create neighborhood table
     neighborhood.log_summary()
-    neighborhood.create_table()
     parcel.log_summary()
-    parcel.create_tables()
+    with table_writer(conn, config):
+        neighborhood.create_table()
+        parcel.create_tables()
+        create_census_tracts(conn, 'taxrolls', neighborhood.tract_spellings)
+
+
+CensusFeature = collections.namedtuple(
+    'CensusFeature',
+    'name columns dtype conversion_reasons formula is_valid reason',
+    )
+CensusFeature.__doc__ = '''A feature of each census tract, computed from columns of the census file
+
+- name: the column in table census; table transactions has it as census_tract_<name>
+- columns: names of the columns in the census file that the feature is computed from
+- dtype: 'int' or 'float', what each column is converted to
+- conversion_reasons: for each column, why a census tract whose value does not convert is skipped
+- formula: function(*arrays) -> float64 array of the feature, given an array for each column
+- is_valid: None or function(*arrays) -> bool array, False for the census tracts that are skipped
+- reason: why the census tracts for which is_valid is False are skipped
+'''
+
+# mean minutes of the commute times in each column
+CENSUS_MEAN_TRAVEL_TIMES = {
+    'P031003': 2.5,
+    'P031004': 7.0,
+    'P031005': 12.0,
+    'P031006': 17.0,
+    'P031007': 22.0,
+    'P031008': 27.0,
+    'P031009': 32.0,
+    'P031010': 37.0,
+    'P031011': 42.0,
+    'P031012': 47.0,
+    'P031013': 72.5,
+    'P031014': 110.0,  # 90 minutes or more
+    }
+
+
+def mean_commute_time(*counts):
+    '''Return the mean commute time in each census tract, given the count of commuters in each column'''
+    weighted_sum = np.zeros(len(counts[0]), dtype=np.float64)
+    for count, mean_travel_time in zip(counts, CENSUS_MEAN_TRAVEL_TIMES.values()):
+        weighted_sum += count * mean_travel_time
+    return weighted_sum / np.sum(counts, axis=0)
+
+
+# the features in table census, in the order of its columns
+CENSUS_FEATURES = (
+    CensusFeature(
+        'mean_commute_time_minutes',
+        tuple(CENSUS_MEAN_TRAVEL_TIMES),
+        'int',
+        tuple('non-int %s' % column_name for column_name in CENSUS_MEAN_TRAVEL_TIMES),
+        mean_commute_time,
+        lambda *counts: np.sum(counts, axis=0) > 0,
+        'no commuters in census tract',
+        ),
+    CensusFeature(
+        'median_household_income',  # in 1999
+        ('P053001',),
+        'float',
+        ('non-float median household income',),
+        lambda median_household_income: median_household_income,
+        None,
+        None,
+        ),
+    CensusFeature(
+        'fraction_owner_occupied',
+        ('H007001', 'H007002'),  # total occupied, owner occupied
+        'float',
+        ('non-float in total occupied', 'non-float in owner occupied'),
+        lambda total, owner: owner / total,
+        lambda total, owner: total != 0.0,
+        'zero residences occupied',
+        ),
+    )
 
 
 class Census:
+    # the columns in the census file that accumulate_columns() reads, in the order it receives them
+    columns = ('GEO_ID2',) + tuple(dict.fromkeys(
+        column_name
+        for feature in CENSUS_FEATURES
+        for column_name in feature.columns
+        ))
+
     def __init__(self, conn, logger):
         self.conn = conn
         self.logger = logger
 
-        self.features = collections.defaultdict(dict)  # key = census_tract  value = map of features
-        self.mean_travel_times = {
-            'P031003': 2.5,
-            'P031004': 7.0,
-            'P031005': 12.0,
-            'P031006': 17.0,
-            'P031007': 22.0,
-            'P031008': 27.0,
-            'P031009': 32.0,
-            'P031010': 37.0,
-            'P031011': 42.0,
-            'P031012': 47.0,
-            'P031013': 72.5,
-            'P031014': 110.0,  # 90 minutes or more
-        }
+        self.census_tracts = np.zeros(0, dtype=np.int64)  # the census tract ids with usable data
+        self.features = {}  # key = feature name  value = array with the feature of each of self.census_tracts
+        self.tract_spellings = {}  # key = GEO_ID2 in the census file  value = census tract id
 
-    def accumulate(self, row):
-        'assumulate features of each census tract'
-        try:
-            value_str = row['GEO_ID2']
-            census_tract = value_str[4:]
-            assert len(census_tract) == 6
-        except AssertionError:
-            pdb.set_trace()
-            raise u.InputError('invalid census tract', value_str)
+    def accumulate_columns(self, columns, counter, error_reasons):
+        '''Set the features of every census tract from the columns of the census file
 
-        # mean commute times
-        n_in_census_tract = 0
-        weighted_sum = 0.0
-        for column_name, column_mean_travel_time in self.mean_travel_times.items():
-            n_str = row[column_name]
+        columns is a list with an array of str for each column in Census.columns. A census tract is skipped
+        for the first column or check of the features in CENSUS_FEATURES that it fails. If a census tract
+        is in more than one row, the last row that is not skipped wins.
+        '''
+        n_rows = len(columns[0])
+        chunk_filter = ChunkFilter(n_rows, counter, error_reasons)
+        columns_by_name = dict(zip(self.columns, columns))
+
+        census_tracts = np.zeros(n_rows, dtype=np.int64)
+        is_valid_census_tract = np.zeros(n_rows, dtype=bool)
+        for i, value_str in enumerate(columns_by_name['GEO_ID2'].tolist()):
+            census_tract_str = value_str[4:]  # drop the state and county codes
+            if len(census_tract_str) != 6:
+                continue
             try:
-                n = int(n_str)
-            except ValueError:
-                raise u.InputError('non-int %s' % column_name, n_str)
-            n_in_census_tract += n
-            weighted_sum = n * column_mean_travel_time
-        if n_in_census_tract == 0:
-            raise u.InputError('no commuters in census tract', census_tract)
-        mean_commute_time_minutes = weighted_sum / n_in_census_tract
-
-        # median household income
-        try:
-            value_str = row['P053001']  # in 1999
-            median_household_income = float(value_str)
-        except ValueError:
-            raise u.InputError('non-float median household income', value_str)
-        median_household_income = median_household_income
-
-        # fraction of units that are owner occupied
-        try:
-            total_str = row['H007001']
-            total = float(total_str)
-        except ValueError:
-            raise u.InputError('non-float in total occupied', total_str)
-
-        try:
-            owner_str = row['H007002']
-            owner = float(owner_str)
-        except ValueError:
-            raise u.InputError('non-float in owner occupied', owner_str)
-
-        if total == 0.0:
-            raise u.InputError('zero residences occupied', None)
-        else:
-            fraction_owner_occupied = owner / total
-
-        self.features[census_tract]['mean_commute_time_minutes'] = mean_commute_time_minutes
-        self.features[census_tract]['median_household_income'] = median_household_income
-        self.features[census_tract]['fraction_owner_occupied'] = fraction_owner_occupied
+                census_tracts[i] = census_tract_id(census_tract_str)
+            except u.InputError:
+                continue
+            is_valid_census_tract[i] = True
+            self.tract_spellings[value_str] = int(census_tracts[i])
+        chunk_filter.reject(is_valid_census_tract, 'invalid census tract')
+
+        converters = {'int': to_int_array, 'float': to_float_array}
+        converted = {}  # key = (column name, dtype)  value = array
+        for feature in CENSUS_FEATURES:
+            for column_name, conversion_reason in zip(feature.columns, feature.conversion_reasons):
+                key = (column_name, feature.dtype)
+                if key not in converted:
+                    values, is_valid = chunk_filter.convert(converters[feature.dtype], columns_by_name[column_name])
+                    chunk_filter.reject(is_valid, conversion_reason)
+                    converted[key] = values
+            if feature.is_valid is not None:
+                arrays = [converted[(column_name, feature.dtype)] for column_name in feature.columns]
+                chunk_filter.reject(feature.is_valid(*arrays), feature.reason)
+
+        counter['retained'] += int(np.count_nonzero(chunk_filter.is_alive))
+        rows = np.flatnonzero(chunk_filter.is_alive)
+        _, last_reversed = np.unique(census_tracts[rows][::-1], return_index=True)
+        rows = np.sort(rows[len(rows) - 1 - last_reversed])
+        self.census_tracts = census_tracts[rows]
+        for feature in CENSUS_FEATURES:
+            arrays = [converted[(column_name, feature.dtype)][rows] for column_name in feature.columns]
+            self.features[feature.name] = np.asarray(feature.formula(*arrays), dtype=np.float64)
 
     def log_summary(self):
         pdb.set_trace()
-        self.logger.info('found %d census tracts with usable data' % len(self.features))
+        self.logger.info('found %d census tracts with usable data' % len(self.census_tracts))
 
     def create_table(self):
         stmt_drop = '''DROP TABLE IF EXISTS census'''
         self.conn.execute(stmt_drop)
 
         stmt_create = '''CREATE TABLE census
-        ( census_tract              text NOT NULL
-        , mean_commute_time_minutes real NOT NULL
-        , median_household_income   real NOT NULL
-        , fraction_owner_occupied   real NOT NULL
+        ( census_tract              integer NOT NULL
+        %s
         , PRIMARY KEY (census_tract)
         )
-        '''
+        ''' % '\n        '.join(', %-25s real NOT NULL' % feature.name for feature in CENSUS_FEATURES)
         self.conn.execute(stmt_create)
 
-        for census_tract, feature_dict in self.features.items():
-            self.conn.execute(
-                'INSERT into census VALUES (?, ?, ?, ?)', (
-                    census_tract,
-                    feature_dict['mean_commute_time_minutes'],
-                    feature_dict['median_household_income'],
-                    feature_dict['fraction_owner_occupied'],
-                    ),
-                )
+        bulk_insert(
+            self.conn,
+            'census',
+            zip(
+                self.census_tracts.tolist(),
+                *[self.features[feature.name].tolist() for feature in CENSUS_FEATURES]
+                ),
+            )
 
 
 def read_census(conn, config, logger):
     '''Create table census from data in census file'''
-    debug = False
     path = os.path.join(config['dir_data'], config['in_census'])
     census = Census(conn, logger)
-    n_retained = 0
-    n_skipped = 0
+    counter = collections.Counter()
     error_reasons = collections.Counter()
     with open(path) as csvfile:
-        reader = csv.DictReader(csvfile, delimiter='\t')
-        for row_index, row in enumerate(reader):
-            if debug:
-                print(row_index)
-                pprint.pprint(row)
-            if row_index == 0:
-                continue  # skip explanations of column names
-            try:
-                census.accumulate(row)
-                n_retained += 1
-            except u.InputError as err:
-                n_skipped += 1
-                error_reasons[err.reason] += 1
+        reader = csv.reader(csvfile, delimiter='\t')
+        rows = list(u.project(reader, Census.columns))[1:]  # skip explanations of column names
+    columns = rows_to_columns(rows) if len(rows) > 0 else [np.zeros(0, dtype=str) for _ in Census.columns]
+    census.accumulate_columns(columns, counter, error_reasons)
     logger.info('read all census records')
-    logger.info(' retained %d' % n_retained)
-    logger.info(' skipped %d' % n_skipped)
+    logger.info(' retained %d' % counter['retained'])
+    logger.info(' skipped %d' % counter['skipped'])
+    for reason, count in error_reasons.items():
+        logger.info(' reason %s occured %d times' % (reason, count))
 
     # census.log_summary()
-    census.create_table()
+    with table_writer(conn, config):
+        census.create_table()
+        create_census_tracts(conn, 'census', census.tract_spellings)
+
+
+TRANSACTIONS_PARCEL_COLUMNS = (
+    'census_tract',
+    'property_city',
+    'total_value_calculated',
+    'land_square_footage',
+    'living_square_feet',
+    'effective_year_built',
+    'bedrooms',
+    'total_rooms',
+    'total_baths',
+    'fireplace_number',
+    'parking_spaces',
+    'has_pool',
+    'units_number',
+    )
 
 
-def create_transactions(conn, config, logger):
-    '''Join deeds, parcels, neighborhoods, and census to create table transactions
+def create_transactions_by_merge_join(conn, config, logger):
+    '''Create table transactions with the rows and column types of the SQL join in create_transactions
 
-    Create feature just_for_experiments in {0, 1} for a random 80% of the transactions.
+    The parcels, neighborhoods, and census are read into arrays sorted by apn or census tract. The features of
+    each parcel's census tract are gathered through its index in the neighborhoods and census arrays. The deeds
+    are read chunk_size rows at a time, each matched to its parcel with a binary search, and inserted.
+    Memory is proportional to the number of parcels and census tracts, not to the number of deeds.
     '''
+    def read_columns(stmt, dtypes):
+        '''Return a list with an array of each dtype for each column selected'''
+        cursor = conn.cursor()
+        cursor.row_factory = None
+        rows = cursor.execute(stmt).fetchall()
+        columns = list(zip(*rows)) if len(rows) > 0 else [()] * len(dtypes)
+        return [np.array(column, dtype=dtype) for column, dtype in zip(columns, dtypes)]
+
+    parcels = read_columns(
+        'SELECT apn, %s FROM parcels ORDER BY apn' % ', '.join(TRANSACTIONS_PARCEL_COLUMNS),
+        [np.int64, np.int64, object] + [np.float64] * (len(TRANSACTIONS_PARCEL_COLUMNS) - 2),
+        )
+    parcel_apns, parcel_census_tracts = parcels[0], parcels[1]
+    neighborhoods = read_columns(
+        '''SELECT census_tract
+        , fraction_land_square_footage_residential
+        , fraction_land_square_footage_commercial
+        , fraction_land_square_footage_industrial
+        , fraction_land_square_footage_schools
+        , fraction_land_square_footage_parks
+        FROM neighborhoods
+        ORDER BY census_tract
+        ''',
+        [np.int64] + [np.float64] * 5,
+        )
+    census = read_columns(
+        'SELECT census_tract, %s FROM census ORDER BY census_tract' % ', '.join(
+            feature.name for feature in CENSUS_FEATURES),
+        [np.int64] + [np.float64] * len(CENSUS_FEATURES),
+        )
+
+    # gather the census tract features of each parcel; parcels without both are not joined
+    neighborhood_indexes, has_neighborhood = sorted_lookup(neighborhoods[0], parcel_census_tracts)
+    census_indexes, has_census = sorted_lookup(census[0], parcel_census_tracts)
+    is_joinable = has_neighborhood & has_census
+    parcel_columns = (
+        parcels[1:] +
+        [column[neighborhood_indexes] for column in neighborhoods[1:]] +
+        [column[census_indexes] for column in census[1:]]
+        )
+
+    conn.execute(
+        '''CREATE TABLE transactions
+        ( apn                                    INT
+        , sale_date                              NUM
+        , sale_year                              INT
+        , sale_month                             INT
+        , sale_amount                            REAL
+        , census_tract                           INT
+        , property_city                          TEXT
+        , total_value_calculated                 REAL
+        , land_square_footage                    REAL
+        , living_square_feet                     REAL
+        , effective_year_built                   REAL
+        , bedrooms                               REAL
+        , total_rooms                            REAL
+        , total_baths                            REAL
+        , fireplace_number                       REAL
+        , parking_spaces                         REAL
+        , has_pool                               REAL
+        , units_number                           REAL
+        , census_tract_fraction_land_residential REAL
+        , census_tract_fractin_land_commercial   REAL
+        , census_tract_fraction_land_industrial  REAL
+        , census_tract_fraction_land_schools     REAL
+        , census_tract_fraction_land_parks       REAL
+        %s
+        )
+        ''' % '\n        '.join(', census_tract_%-25s REAL' % feature.name for feature in CENSUS_FEATURES)
+        )
+
+    # the deeds are joined in the order of table deeds
+    cursor = conn.cursor()
+    cursor.row_factory = None
+    cursor.execute('SELECT apn, sale_date, sale_year, sale_month, sale_amount FROM deeds')
+    n_joined = 0
+    while True:
+        rows = cursor.fetchmany(config.get('chunk_size', 100000))
+        if len(rows) == 0:
+            break
+        deed_columns = list(zip(*rows))
+        parcel_indexes, has_parcel = sorted_lookup(parcel_apns, np.array(deed_columns[0], dtype=np.int64))
+        is_joined = has_parcel.copy()  # with no parcels, is_joinable is empty
+        is_joined[has_parcel] = is_joinable[parcel_indexes[has_parcel]]
+        joined = np.flatnonzero(is_joined)
+        parcel_indexes = parcel_indexes[is_joined]
+        columns = (
+            [np.array(column, dtype=object)[joined].tolist() for column in deed_columns] +
+            [column[parcel_indexes].tolist() for column in parcel_columns]
+            )
+        conn.executemany(
+            'INSERT INTO transactions VALUES (%s)' % ', '.join('?' * len(columns)),
+            zip(*columns),
+            )
+        n_joined += len(joined)
+    logger.info('joined %d deeds with their parcels and census tracts' % n_joined)
+
+
+@writes_tables
+def create_transactions(conn, config, logger):
+    '''Join deeds, parcels, neighborhoods, and census to create table transactions'''
     debug = True
     def head(table_name, n=3):
         print('head %s' % table_name)
@@ -941,39 +2322,41 @@ def create_transactions(conn, config, logger):
     #     INNER JOIN census on census.census_tract = parcels.census_tract
     #     ''')
     # print('first create executed')
-    conn.execute(
-        '''CREATE TABLE transactions AS
-        SELECT deeds.apn as apn
-        , deeds.sale_date as sale_date
-        , deeds.sale_year as sale_year
-        , deeds.sale_month as sale_month
-        , deeds.sale_amount as sale_amount
-        , parcels.census_tract as census_tract
-        , parcels.property_city as property_city
-        , parcels.total_value_calculated as total_value_calculated
-        , parcels.land_square_footage as land_square_footage
-        , parcels.living_square_feet as living_square_feet
-        , parcels.effective_year_built as effective_year_built
-        , parcels.bedrooms as bedrooms
-        , parcels.total_rooms as total_rooms
-        , parcels.total_baths as total_baths
-        , parcels.fireplace_number as fireplace_number
-        , parcels.parking_spaces as parking_spaces
-        , parcels.has_pool as has_pool
-        , parcels.units_number as units_number
-        , neighborhoods.fraction_land_square_footage_residential as census_tract_fraction_land_residential
-        , neighborhoods.fraction_land_square_footage_commercial as census_tract_fractin_land_commercial
-        , neighborhoods.fraction_land_square_footage_industrial as census_tract_fraction_land_industrial
-        , neighborhoods.fraction_land_square_footage_schools as census_tract_fraction_land_schools
-        , neighborhoods.fraction_land_square_footage_parks as census_tract_fraction_land_parks
-        , census.mean_commute_time_minutes as census_tract_mean_commute_time_minutes
-        , census.median_household_income as census_tract_median_household_income
-        , census.fraction_owner_occupied as census_tract_fraction_owner_occupied
-        FROM deeds
-        INNER JOIN parcels ON parcels.apn = deeds.apn
-        INNER JOIN neighborhoods ON neighborhoods.census_tract = parcels.census_tract
-        INNER JOIN census on census.census_tract = parcels.census_tract
-        ''')
+    if config.get('join_engine', 'sql') == 'merge':
+        create_transactions_by_merge_join(conn, config, logger)
+    else:
+        conn.execute(
+            '''CREATE TABLE transactions AS
+            SELECT deeds.apn as apn
+            , deeds.sale_date as sale_date
+            , deeds.sale_year as sale_year
+            , deeds.sale_month as sale_month
+            , deeds.sale_amount as sale_amount
+            , parcels.census_tract as census_tract
+            , parcels.property_city as property_city
+            , parcels.total_value_calculated as total_value_calculated
+            , parcels.land_square_footage as land_square_footage
+            , parcels.living_square_feet as living_square_feet
+            , parcels.effective_year_built as effective_year_built
+            , parcels.bedrooms as bedrooms
+            , parcels.total_rooms as total_rooms
+            , parcels.total_baths as total_baths
+            , parcels.fireplace_number as fireplace_number
+            , parcels.parking_spaces as parking_spaces
+            , parcels.has_pool as has_pool
+            , parcels.units_number as units_number
+            , neighborhoods.fraction_land_square_footage_residential as census_tract_fraction_land_residential
+            , neighborhoods.fraction_land_square_footage_commercial as census_tract_fractin_land_commercial
+            , neighborhoods.fraction_land_square_footage_industrial as census_tract_fraction_land_industrial
+            , neighborhoods.fraction_land_square_footage_schools as census_tract_fraction_land_schools
+            , neighborhoods.fraction_land_square_footage_parks as census_tract_fraction_land_parks
+            %s
+            FROM deeds
+            INNER JOIN parcels ON parcels.apn = deeds.apn
+            INNER JOIN neighborhoods ON neighborhoods.census_tract = parcels.census_tract
+            INNER JOIN census on census.census_tract = parcels.census_tract
+            ''' % '\n            '.join(
+                ', census.%s as census_tract_%s' % (feature.name, feature.name) for feature in CENSUS_FEATURES))
     conn.execute(
         '''CREATE INDEX transactions_apn ON transactions (apn)'''
         )
@@ -990,14 +2373,22 @@ def create_transactions(conn, config, logger):
     for row in conn.execute('SELECT (SELECT count() FROM transactions) as count, * FROM transactions'):
         print('count transactions = ', row['count'])
         break
+    conn.execute('ALTER TABLE transactions ADD COLUMN in_training real NOT NULL DEFAULT 0.0')
 
+
+@writes_tables
+def split_transactions(conn, config, logger):
+    '''Set transactions.in_training to 1.0 for a random fraction_in_training of the transactions'''
     # split the transactions into in_testing and otherwise (in_training)
     # This program stratifies by transaction.sale_date month
     # It marks a random 80% of the transactions in each month as use_for_experiments
     # After the experiments are finished, the best model will be retrained 
     # A prior version did this work in the module samples.py
     # - It used scikit learn cross_validation.StratisfiedShuffleSplit
-    conn.execute('ALTER TABLE transactions ADD COLUMN in_training real NOT NULL DEFAULT 0.0')
+    conn.execute('UPDATE transactions SET in_training = 0.0')  # in case this stage is run again
+    if config.get('split', 'random') == 'hash':
+        split_transactions_by_hash(conn, config, logger)
+        return
 
     def next_year_month():
         '''yield (year, month) for all the prediction periods'''
@@ -1061,73 +2452,622 @@ def create_transactions(conn, config, logger):
     pass
 
 
-def create_standardize(conn, config, logger):
-    '''determine mean and standard deviation of each numeric column in transactions'''
-    debug = False
-    def summarize(column_name):
-        '''return mean, median, standard deviation'''
-        stmt_select_column = 'SELECT %s FROM transactions' % column_name
-        values = []
-        for row in conn.execute(stmt_select_column):
-            values.append(row[column_name])
-        a = np.array(values)
-        return np.mean(a), np.median(a), np.std(a)
-    
-    conn.execute('DROP TABLE IF EXISTS transactions_standardizers')
-    conn.execute(
-        '''CREATE TABLE transactions_standardizers
-        ( column_name        text NOT NULL
-        , mean               real NOT NULL
-        , median             real NOT NULL
-        , standard_deviation real NOT NULL
-        , PRIMARY KEY (column_name)
-        )
+def mix_64(x):
+    '''Return the splitmix64 finalizer of each uint64 in array x'''
+    x = x ^ (x >> np.uint64(30))
+    x = x * np.uint64(0xbf58476d1ce4e5b9)
+    x = x ^ (x >> np.uint64(27))
+    x = x * np.uint64(0x94d049bb133111eb)
+    return x ^ (x >> np.uint64(31))
+
+
+def hash_transactions(apns, sale_dates, seed):
+    '''Return uint64 array of a seeded hash of each (apn, sale_date); sale_dates are int YYYYMMDD'''
+    golden_gamma = 0x9e3779b97f4a7c15
+    h = mix_64(apns.astype(np.uint64) + np.uint64(seed * golden_gamma % 2 ** 64))
+    return mix_64(h + sale_dates.astype(np.uint64) * np.uint64(golden_gamma))
+
+
+def split_transactions_by_hash(conn, config, logger):
+    '''Set transactions.in_training to 1.0 for fraction_in_training of the transactions in each month
+
+    The transactions in a month are ranked by a hash of (apn, sale_date) seeded with random_seed, and the
+    first fraction_in_training * n of them are in training, rounded up or down at random with a hash of the
+    month, so that the split does not depend on the order of the rows. As in split_transactions, only the
+    months from date_census_became_known through date_last_transaction are split.
+    '''
+    rows = conn.execute(
+        '''SELECT rowid
+        , apn
+        , CAST(strftime('%Y%m%d', sale_date) AS integer) AS sale_date_number
+        , sale_year * 12 + sale_month - 1 AS sale_month_number
+        FROM transactions
         '''
+        ).fetchall()
+    rowids, apns, sale_dates, months = [np.array(column, dtype=np.int64).reshape(-1) for column in (
+        zip(*rows) if len(rows) > 0 else ([], [], [], []))]
+    hashes = hash_transactions(apns, sale_dates, config['random_seed'])
+
+    # rank each transaction within its month: by month, then hash, with the apn and date breaking ties
+    order = np.lexsort((sale_dates, apns, hashes, months))
+    months_sorted = months[order]
+    is_first = np.ones(len(order), dtype=bool)
+    is_first[1:] = months_sorted[1:] != months_sorted[:-1]
+    starts = np.flatnonzero(is_first)
+    counts = np.diff(np.append(starts, len(order)))
+    ranks = np.arange(len(order)) - np.repeat(starts, counts)
+    # the fractional part of the number in training is rounded up with that probability, using a hash of the month
+    n_in_training_real = config['fraction_in_training'] * counts
+    n_in_training = np.floor(n_in_training_real).astype(np.int64)
+    month_hashes = hash_transactions(
+        months_sorted[starts],
+        np.zeros(len(starts), dtype=np.int64),
+        config['random_seed'],
+        )
+    draws = (month_hashes >> np.uint64(11)) * 2.0 ** -53
+    n_in_training += draws < n_in_training_real - n_in_training
+    is_in_training_sorted = ranks < np.repeat(n_in_training, counts)
+
+    date_census_became_known, err1 = u.as_date(config['date_census_became_known'])
+    last_date, err1 = u.as_date(config['date_last_transaction'])
+    first_month = date_census_became_known.year * 12 + date_census_became_known.month - 1
+    last_month = last_date.year * 12 + last_date.month - 1
+    is_in_training_sorted &= (months_sorted >= first_month) & (months_sorted <= last_month)
+
+    conn.execute('CREATE TEMP TABLE transactions_in_training (id integer PRIMARY KEY)')
+    rowids_in_training = rowids[order][is_in_training_sorted].tolist()
+    bulk_insert(conn, 'transactions_in_training', ((rowid,) for rowid in rowids_in_training))
+    conn.execute('''UPDATE transactions SET in_training = 1.0
+        WHERE rowid IN (SELECT id FROM transactions_in_training)''')
+    conn.execute('DROP TABLE transactions_in_training')
+
+    for month, start, count in zip(months_sorted[starts].tolist(), starts.tolist(), counts.tolist()):
+        if first_month <= month <= last_month:
+            n = int(is_in_training_sorted[start:start + count].sum())
+            logger.info(
+                'transactions for %4d %2d: in_training %5d not in training %5d',
+                month // 12,
+                month % 12 + 1,
+                n,
+                count - n,
+                )
+    all_n_in_training = int(is_in_training_sorted.sum())
+    logger.info(
+        'transactions for all periods: in_training %d not in training %d',
+        all_n_in_training,
+        len(order) - all_n_in_training,
         )
 
+
+class Moments:
+    '''Running count, mean, and sum of squared deviations of each column, updated a batch of rows at a time
+
+    The batch moments are combined with the running ones as in Welford's method, generalized to batches by
+    Chan, Golub, and LeVeque, so that no column is held in memory.
+    '''
+    def __init__(self, n_columns):
+        self.n = 0
+        self.mean = np.zeros(n_columns)
+        self.m2 = np.zeros(n_columns)
+
+    def update(self, values):
+        '''Include the rows of 2-D array values'''
+        n_batch = len(values)
+        if n_batch == 0:
+            return
+        mean_batch = values.mean(axis=0)
+        m2_batch = ((values - mean_batch) ** 2).sum(axis=0)
+        n = self.n + n_batch
+        delta = mean_batch - self.mean
+        self.mean = self.mean + delta * (n_batch / n)
+        self.m2 = self.m2 + m2_batch + delta ** 2 * (self.n * n_batch / n)
+        self.n = n
+
+    def standard_deviation(self):
+        '''Return the population standard deviation of each column, as np.std does'''
+        return np.sqrt(self.m2 / self.n)
+
+
+class QuantileSketch:
+    '''Bounded-memory summary of each column from which its quantiles are estimated
+
+    Level i holds values that each stand for 2 ** i of the values seen. When a level reaches capacity values,
+    they are sorted and every other one is promoted to the next level, alternating which ones between
+    compactions. So each level holds fewer than capacity values and the error in the rank of an estimate is
+    about log2(n / capacity) / capacity of n. Until the first compaction, the estimates are exact.
+    '''
+    def __init__(self, n_columns, capacity=4096):
+        self.n_columns = n_columns
+        self.capacity = capacity
+        self.levels = []  # 2-D arrays, one row per value
+        self.n_compactions = 0
+
+    def update(self, values):
+        '''Include the rows of 2-D array values'''
+        level = 0
+        while len(values) > 0:
+            if level == len(self.levels):
+                self.levels.append(np.empty((0, self.n_columns)))
+            values = np.concatenate((self.levels[level], values))
+            if len(values) < self.capacity:
+                self.levels[level] = values
+                return
+            values = np.sort(values, axis=0)
+            offset = self.n_compactions % 2
+            self.n_compactions += 1
+            self.levels[level] = values[len(values) - len(values) % 2:]  # an odd value out stays
+            values = values[offset:len(values) - len(values) % 2:2]
+            level += 1
+
+    def median(self):
+        '''Return the estimated median of each column'''
+        if len(self.levels) == 0:
+            return np.full(self.n_columns, np.nan)
+        if self.n_compactions == 0:
+            return np.median(self.levels[0], axis=0)
+        values = np.concatenate(self.levels)
+        weights = np.concatenate([
+            np.full(len(values_level), 2.0 ** level)
+            for level, values_level in enumerate(self.levels)
+            ])
+        order = np.argsort(values, axis=0)
+        cumulative_weights = np.cumsum(weights[order], axis=0)
+        index = np.argmax(cumulative_weights >= cumulative_weights[-1] / 2.0, axis=0)
+        rows = np.take_along_axis(order, index[np.newaxis, :], axis=0)
+        return np.take_along_axis(values, rows, axis=0)[0]
+
+
+class ColumnSummaries:
+    '''The mean, median, and standard deviation of each column of the rows in the batches seen
+
+    If exact, the columns are kept and summarized with NumPy; otherwise the mean and standard deviation are
+    running moments and the median is estimated with a QuantileSketch.
+    '''
+    def __init__(self, n_columns, exact):
+        self.n_columns = n_columns
+        self.exact = exact
+        if exact:
+            self.batches = []
+        else:
+            self.moments = Moments(n_columns)
+            self.sketch = QuantileSketch(n_columns)
+
+    def update(self, values):
+        '''Include the rows of 2-D array values'''
+        if self.exact:
+            self.batches.append(values)
+        else:
+            self.moments.update(values)
+            self.sketch.update(values)
+
+    def summarize(self):
+        '''Return (n, means, medians, standard deviations), which are NaN if there were no rows'''
+        n = sum(len(values) for values in self.batches) if self.exact else self.moments.n
+        if n == 0:
+            nans = np.full(self.n_columns, np.nan)
+            return 0, nans, nans.copy(), nans.copy()
+        if self.exact:
+            a = np.concatenate(self.batches)
+            return len(a), np.mean(a, axis=0), np.median(a, axis=0), np.std(a, axis=0)
+        return self.moments.n, self.moments.mean, self.sketch.median(), self.moments.standard_deviation()
+
+
+@writes_tables
+def create_standardize(conn, config, logger):
+    '''determine mean, median, and standard deviation of each numeric column in transactions
+
+    All columns are summarized in one scan, for all the transactions and for those in training.
+    '''
+    debug = False
+    exact = config.get('standardize_exact', False)
+    table_names = ('transactions_standardizers', 'transactions_training_standardizers')
+    for table_name in table_names:
+        conn.execute('DROP TABLE IF EXISTS %s' % table_name)
+        conn.execute(
+            '''CREATE TABLE %s
+            ( column_name        text NOT NULL
+            , mean               real NOT NULL
+            , median             real NOT NULL
+            , standard_deviation real NOT NULL
+            , PRIMARY KEY (column_name)
+            )
+            ''' % table_name
+            )
+
     if debug:
         stmt_master = "SELECT * FROM sqlite_master"
         for table_info in conn.execute(stmt_master):
             print(table_info['tbl_name'], table_info['name'], table_info['type'])
     stmt_transactions = "pragma table_info('transactions')"
-    for info in conn.execute(stmt_transactions):
-        if debug and False:
-            column_id, column_name, column_type, column_notnull, column_default, column_pk = info
-            print(column_id, column_name, column_type, column_notnull, column_default, column_pk)
-        if info['type'] == 'REAL':  # all features have type REAL
-            mean, median, std = summarize(info['name'])
-            stmt_insert = 'INSERT INTO transactions_standardizers VALUES ("%s", %f, %f, %f)' % (
-                info['name'],
-                mean,
-                median,
-                std,
+    column_names = [
+        info['name']
+        for info in conn.execute(stmt_transactions)
+        if info['type'] == 'REAL'  # all features have type REAL
+        ]
+
+    summaries = [ColumnSummaries(len(column_names), exact) for table_name in table_names]
+    cursor = conn.cursor()
+    cursor.row_factory = None
+    cursor.execute('SELECT in_training, %s FROM transactions' % ', '.join(column_names))
+    while True:
+        rows = cursor.fetchmany(config.get('chunk_size', 100000))
+        if len(rows) == 0:
+            break
+        a = np.array(rows, dtype=np.float64)
+        summaries[0].update(a[:, 1:])
+        summaries[1].update(a[a[:, 0] == 1.0, 1:])
+
+    for table_name, summary in zip(table_names, summaries):
+        n, means, medians, standard_deviations = summary.summarize()
+        logger.info('%s: %d transactions' % (table_name, n))
+        if n == 0:
+            continue
+        bulk_insert(
+            conn, table_name,
+            zip(column_names, means.tolist(), medians.tolist(), standard_deviations.tolist()),
+            )
+        if debug:
+            for row in zip(column_names, means, medians, standard_deviations):
+                print(table_name, row)
+
+
+def feature_vectors_dir(config):
+    '''Return the path of the directory that export_feature_vectors writes'''
+    return os.path.join(config['dir_working'], config.get('out_feature_vectors', 'feature_vectors'))
+
+
+def export_feature_vectors(conn, config, logger):
+    '''Write the transactions as arrays in .npy files that can be memory mapped, with a manifest
+
+    The directory config['out_feature_vectors'] within dir_working holds
+    - features.npy: float32, one row per transaction, one column per REAL column of transactions other than
+      sale_amount and in_training, standardized with the mean and standard deviation in transactions_standardizers
+    - sale_amount.npy: float64, the target
+    - in_training.npy: bool
+    - apn.npy: int64 and sale_date.npy: datetime64[D], the key of each transaction
+    - manifest.json: the feature names, the standardizers, and the file, dtype, and shape of each array
+    The transactions are in (apn, sale_date) order. Read the directory with load_feature_vectors().
+    If there are no transactions, nothing is exported. Raise ValueError if a feature has no standardizer.
+    '''
+    dir_out = feature_vectors_dir(config)
+    n_rows = conn.execute('SELECT count(*) FROM transactions').fetchone()[0]
+    if n_rows == 0:
+        logger.warning('no transactions to export to %s' % dir_out)
+        return
+    standardizers = {
+        row['column_name']: (row['mean'], row['standard_deviation'])
+        for row in conn.execute('SELECT * FROM transactions_standardizers')
+        }
+    feature_names = [
+        info['name']
+        for info in conn.execute("pragma table_info('transactions')")
+        if info['type'] == 'REAL' and info['name'] not in ('sale_amount', 'in_training')
+        ]
+    missing = [feature_name for feature_name in feature_names if feature_name not in standardizers]
+    if len(missing) > 0:
+        raise ValueError('no standardizer in transactions_standardizers for: %s' % ', '.join(missing))
+    means = np.array([standardizers[feature_name][0] for feature_name in feature_names])
+    standard_deviations = np.array([standardizers[feature_name][1] for feature_name in feature_names])
+    scales = np.where(standard_deviations > 0.0, standard_deviations, 1.0)  # constant features become 0
+
+    dir_tmp = dir_out + '.tmp-%d' % os.getpid()
+    shutil.rmtree(dir_tmp, ignore_errors=True)
+    os.makedirs(dir_tmp)
+    arrays = {
+        'features': ('float32', (n_rows, len(feature_names))),
+        'sale_amount': ('float64', (n_rows,)),
+        'in_training': ('bool', (n_rows,)),
+        'apn': ('int64', (n_rows,)),
+        'sale_date': ('datetime64[D]', (n_rows,)),
+        }
+    memmaps = {
+        name: np.lib.format.open_memmap(os.path.join(dir_tmp, name + '.npy'), mode='w+', dtype=dtype, shape=shape)
+        for name, (dtype, shape) in arrays.items()
+        }
+
+    cursor = conn.cursor()
+    cursor.row_factory = None
+    cursor.execute(
+        '''SELECT apn
+        , CAST(julianday(sale_date) - 2440587.5 AS integer)
+        , sale_amount
+        , in_training
+        , %s
+        FROM transactions
+        ORDER BY apn, sale_date
+        ''' % ', '.join(feature_names)
+        )
+    start = 0
+    while True:
+        rows = cursor.fetchmany(config.get('chunk_size', 100000))
+        if len(rows) == 0:
+            break
+        stop = start + len(rows)
+        a = np.array(rows, dtype=np.float64)
+        memmaps['apn'][start:stop] = np.array([row[0] for row in rows], dtype=np.int64)  # exact, unlike float64
+        memmaps['sale_date'][start:stop] = a[:, 1].astype(np.int64).astype('datetime64[D]')
+        memmaps['sale_amount'][start:stop] = a[:, 2]
+        memmaps['in_training'][start:stop] = a[:, 3] == 1.0
+        memmaps['features'][start:stop] = (a[:, 4:] - means) / scales
+        start = stop
+    for memmap in memmaps.values():
+        memmap.flush()
+    del memmaps
+
+    manifest = {
+        'n_rows': n_rows,
+        'feature_names': feature_names,
+        'standardizers': {
+            feature_name: {'mean': mean, 'standard_deviation': standard_deviation}
+            for feature_name, mean, standard_deviation in zip(
+                feature_names, means.tolist(), standard_deviations.tolist())
+            },
+        'arrays': {
+            name: {'file': name + '.npy', 'dtype': dtype, 'shape': list(shape)}
+            for name, (dtype, shape) in arrays.items()
+            },
+        }
+    with open(os.path.join(dir_tmp, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=1)
+    shutil.rmtree(dir_out, ignore_errors=True)
+    os.rename(dir_tmp, dir_out)
+    logger.info('exported %d transactions with %d features to %s' % (n_rows, len(feature_names), dir_out))
+
+
+def load_feature_vectors(dir_out):
+    '''Return (manifest, dict of memory-mapped arrays) written by export_feature_vectors'''
+    with open(os.path.join(dir_out, 'manifest.json')) as f:
+        manifest = json.load(f)
+    arrays = {
+        name: np.load(os.path.join(dir_out, array['file']), mmap_mode='r')
+        for name, array in manifest['arrays'].items()
+        }
+    return manifest, arrays
+
+
+Stage = collections.namedtuple(
+    'Stage',
+    'name function upstream input_keys config_keys outputs',
+    )
+Stage.__doc__ = '''A step in the ETL
+
+- name: str
+- function: function(conn, config, logger)
+- upstream: names of the stages whose outputs this stage reads
+- input_keys: config keys of the paths within dir_data to the files this stage reads
+- config_keys: other config keys whose values affect the outputs
+- outputs: names of the tables this stage creates; stage_files() names the files it writes elsewhere
+'''
+
+STAGES = (
+    Stage('read_codes_deeds', read_codes_deeds, (), ('in_codes_deeds',), (), ('codes_deeds',)),
+    Stage('read_codes_taxrolls', read_codes_taxrolls, (), ('in_codes_taxrolls',), (), ('codes_taxrolls',)),
+    Stage(
+        'read_deeds', read_deeds,
+        ('read_codes_deeds',),
+        ('in_deeds',),
+        ('date_census_became_known', 'max_sale_amount'),
+        ('deeds',),
+        ),
+    Stage(
+        'read_taxrolls', read_taxrolls,
+        ('read_codes_taxrolls',),  # and read_deeds, if config['parcels_sold_only']
+        ('in_taxrolls',),
+        ('parcels_sold_only',),
+        ('neighborhoods', 'parcels', 'census_tracts'),
+        ),
+    Stage('read_census', read_census, (), ('in_census',), (), ('census', 'census_tracts')),
+    Stage(
+        'create_transactions', create_transactions,
+        ('read_deeds', 'read_taxrolls', 'read_census'),
+        (),
+        ('join_engine',),
+        ('transactions',),
+        ),
+    Stage(
+        'split_transactions', split_transactions,
+        ('create_transactions',),
+        (),
+        ('date_census_became_known', 'date_last_transaction', 'fraction_in_training', 'random_seed', 'split'),
+        ('transactions',),
+        ),
+    Stage(
+        'create_standardize', create_standardize,
+        ('split_transactions',),
+        (),
+        ('standardize_exact', 'chunk_size'),  # chunk_size determines where the median sketch compacts
+        ('transactions_standardizers', 'transactions_training_standardizers'),
+        ),
+    Stage(
+        'export_feature_vectors', export_feature_vectors,
+        ('create_standardize',),
+        (),
+        ('out_feature_vectors',),
+        (),
+        ),
+    )
+
+
+def stage_files(stage, config):
+    '''Return the paths of the files outside the database that the stage must have written to be up to date'''
+    if stage.name == 'export_feature_vectors':
+        return [os.path.join(feature_vectors_dir(config), 'manifest.json')]
+    return []
+
+
+def configured_stages(config):
+    '''Return STAGES, with read_deeds upstream of read_taxrolls if config['parcels_sold_only']'''
+    if not config.get('parcels_sold_only', False):
+        return STAGES
+    return tuple(
+        stage._replace(upstream=stage.upstream + ('read_deeds',)) if stage.name == 'read_taxrolls' else stage
+        for stage in STAGES
+        )
+
+
+def code_version():
+    '''Return a hash of the source code'''
+    sha256 = hashlib.sha256()
+    for path in (__file__, u.__file__):
+        with open(path, 'rb') as f:
+            sha256.update(f.read())
+    return sha256.hexdigest()
+
+
+def stage_fingerprint(stage, config, upstream_fingerprints, version):
+    '''Return a hash of everything that determines the outputs of a stage
+
+    The fingerprints of the upstream stages are included, so that a change invalidates the downstream stages.
+    '''
+    inputs = []
+    for input_key in stage.input_keys:
+        filenames = config[input_key]
+        for filename in (filenames if isinstance(filenames, list) else [filenames]):
+            path = os.path.join(config['dir_data'], filename)
+            stat = os.stat(path)
+            inputs.append([path, stat.st_size, stat.st_mtime_ns])
+    description = {
+        'stage': stage.name,
+        'code': version,
+        'inputs': inputs,
+        'config': {config_key: config.get(config_key) for config_key in stage.config_keys},
+        'upstream': [upstream_fingerprints[name] for name in stage.upstream],
+        }
+    return hashlib.sha256(json.dumps(description, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def set_writer_lock(lock, log_queue=None):
+    '''Initialize a stage process'''
+    global writer_lock
+    global stage_log_queue
+    writer_lock = lock
+    stage_log_queue = log_queue
+
+
+def run_stage_worker(config, stage_name, logger_name):
+    '''Run one stage in a stage process and return its wall time in seconds'''
+    logger = logging.getLogger(logger_name)
+    if not logger.handlers:  # the process was spawned, not forked
+        logger = u.make_logger(logger_name, config, stage_log_queue)
+    stage = {stage.name: stage for stage in configured_stages(config)}[stage_name]
+    conn = connect(config)
+    start = time.time()
+    stage.function(conn, config, logger)
+    conn.commit()
+    conn.close()
+    u.report_rate_limits(logger)  # a stage process does not run the atexit functions
+    return time.time() - start
+
+
+def critical_path(stages, wall_times):
+    '''Return (names, seconds) of the chain of dependent stages with the longest total wall time'''
+    finish = {}
+    chain = {}
+    for stage in stages:  # stages are in topological order
+        before = max(stage.upstream, key=lambda name: finish[name], default=None)
+        finish[stage.name] = wall_times.get(stage.name, 0.0) + (0.0 if before is None else finish[before])
+        chain[stage.name] = [stage.name] if before is None else chain[before] + [stage.name]
+    last = max(finish, key=lambda name: finish[name])
+    return chain[last], finish[last]
+
+
+def stage_fingerprints(config, version=None):
+    '''Return dict of the fingerprint of each stage'''
+    version = code_version() if version is None else version
+    fingerprints = {}
+    for stage in configured_stages(config):
+        fingerprints[stage.name] = stage_fingerprint(stage, config, fingerprints, version)
+    return fingerprints
+
+
+def run_stages(conn, config, logger):
+    '''Run the stages, skipping those that are up to date if config['incremental']
+
+    Table etl_stages records the fingerprint of each stage that completed. If config['stage_workers'] > 1,
+    each stage runs in a process of its own as soon as its upstream stages have completed.
+    '''
+    global writer_lock
+    conn.execute(
+        '''CREATE TABLE IF NOT EXISTS etl_stages
+        ( stage       text NOT NULL
+        , fingerprint text NOT NULL
+        , completed   text NOT NULL
+        , PRIMARY KEY (stage)
+        )
+        '''
+        )
+    completed = {row['stage']: row['fingerprint'] for row in conn.execute('SELECT * FROM etl_stages')}
+    tables = {row['name'] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    stages = configured_stages(config)
+    fingerprints = stage_fingerprints(config)
+    pending = []
+    for stage in stages:
+        if (config.get('incremental', True) and
+                completed.get(stage.name) == fingerprints[stage.name] and
+                all(output in tables for output in stage.outputs) and
+                all(os.path.exists(path) for path in stage_files(stage, config))):
+            logger.info('stage %s is up to date' % stage.name)
+            continue
+        pending.append(stage)
+    for stage in pending:
+        conn.execute('DELETE FROM etl_stages WHERE stage = ?', (stage.name,))
+    conn.commit()
+
+    def record(stage, wall_time):
+        with table_writer(conn, config):
+            conn.execute(
+                'INSERT INTO etl_stages VALUES (?, ?, ?)',
+                (stage.name, fingerprints[stage.name], datetime.datetime.now().isoformat()),
                 )
-            conn.execute(stmt_insert)
-            if debug:
-                print(info['name'], mean, median, std)
-    pass
-        
-    
+        wall_times[stage.name] = wall_time
+        logger.info('stage %s completed in %.1f seconds' % (stage.name, wall_time))
+
+    start = time.time()
+    wall_times = {}
+    stage_workers = config.get('stage_workers', 1)
+    if stage_workers == 1:
+        for stage in pending:
+            logger.info('stage %s starting' % stage.name)
+            stage_start = time.time()
+            stage.function(conn, config, logger)
+            conn.commit()
+            record(stage, time.time() - stage_start)
+    else:
+        writer_lock = multiprocessing.Lock()
+        running = {}
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=stage_workers,
+                initializer=set_writer_lock,
+                initargs=(writer_lock, u.logging_queue(logger)),
+                ) as executor:
+            while pending or running:
+                waiting = {stage.name for stage in pending} | {stage.name for stage in running.values()}
+                ready = [stage for stage in pending if waiting.isdisjoint(stage.upstream)]
+                for stage in ready:
+                    logger.info('stage %s starting' % stage.name)
+                    future = executor.submit(run_stage_worker, dict(config), stage.name, logger.name)
+                    running[future] = stage
+                    pending.remove(stage)
+                done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    record(running.pop(future), future.result())
+        writer_lock = None
+
+    logger.info('ran %d stages in %.1f seconds' % (len(wall_times), time.time() - start))
+    if wall_times:
+        names, seconds = critical_path(stages, wall_times)
+        logger.info('critical path %s: %.1f seconds' % (' -> '.join(names), seconds))
+
+
 def main(argv):
     config = u.parse_invocation_arguments(argv)
     logger = u.make_logger(argv[0], config)
     u.log_config(argv[0], config, logger)
 
-    # for date and datetime fields, see https://docs.python.org/3/library/sqlite3.html#default-adapters-and-converters
-    conn = sqlite3.connect(
-        os.path.join(config['dir_working'], config['out_db']),
-        detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES,
-        )
-    conn.row_factory = sqlite3.Row
+    conn = connect(config)
 
     if True:
-        read_codes_deeds(conn, config, logger)
-        read_codes_taxrolls(conn, config, logger)
-        read_deeds(conn, config, logger)
-        read_taxrolls(conn, config, logger)
-        read_census(conn, config, logger)
-        create_transactions(conn, config, logger)
-        create_standardize(conn, config, logger)
+        run_stages(conn, config, logger)
     if True:
         pass
     if False:
@@ -1137,5 +3077,898 @@ def main(argv):
     conn.close()
 
 
+def make_test_code_book(table_name, codes):
+    '''Return CodeBook with the (code_table, value, description) codes, for the tests'''
+    code_book = CodeBook(table_name)
+    for code in codes:
+        code_book.add(*code)
+    return code_book
+
+
+def make_test_data_dir(dir_root):
+    '''Return config with dir_data holding an empty file for each input of the stages, for the tests'''
+    config = {
+        'dir_data': os.path.join(dir_root, 'data'),
+        'dir_working': os.path.join(dir_root, 'working'),
+        'in_codes_deeds': 'codes_deeds.csv',
+        'in_codes_taxrolls': 'codes_taxrolls.csv',
+        'in_deeds': ['CAC06037D1.zip', 'CAC06037D2.zip'],
+        'in_taxrolls': ['CAC06037T1.zip'],
+        'in_census': 'census.csv',
+        }
+    os.makedirs(config['dir_data'])
+    os.makedirs(config['dir_working'])
+    filenames = ['codes_deeds.csv', 'codes_taxrolls.csv', 'census.csv'] + config['in_deeds'] + config['in_taxrolls']
+    for filename in filenames:
+        with open(os.path.join(config['dir_data'], filename), 'w') as f:
+            f.write(filename)
+    return config
+
+
+def make_test_deed():
+    '''Return a Deed with the codes of the deeds files, for the tests'''
+    code_book = make_test_code_book('codes_deeds', (
+        ('PROPN', '10', 'Single Family Residence / Townhouse'),
+        ('DEEDC', 'G', 'GRANT DEED'),
+        ('PRICATCODE', 'A', 'ARMS LENGTH TRANSACTION'),
+        ('TRNTP', '1', 'RESALE'),
+        ('TRNTP', '3', 'SUBDIVISION/NEW CONSTRUCTION'),
+        ('SCODE', 'F', 'SALE PRICE (FULL)'),
+        ))
+    config = {'date_census_became_known': '2003-01-01', 'max_sale_amount': 85000000.0}
+    return Deed(None, config, None, code_book)
+
+
+def deed_row(sale_date='20060102', apn='1234567890', sale_amount='300000', transaction_type_code='1'):
+    '''Return a row with the values of the columns in Deed.columns, for the tests'''
+    return ('10', 'G', 'A', '', '1', transaction_type_code, 'F', sale_date, '', apn, sale_amount)
+
+
+class TestTableWriter(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.config = {'dir_working': self.dir.name, 'out_db': 'test.sqlite3'}
+        self.conn = connect(self.config)
+        self.conn.execute('CREATE TABLE t (x integer)')
+        self.conn.commit()
+        self.pragmas = self.read_pragmas()
+        # bulk_insert writes BULK_INSERT_BATCH_SIZE rows at a time
+        self.addCleanup(globals().__setitem__, 'BULK_INSERT_BATCH_SIZE', BULK_INSERT_BATCH_SIZE)
+        globals()['BULK_INSERT_BATCH_SIZE'] = 3
+
+    def tearDown(self):
+        self.conn.close()
+        self.dir.cleanup()
+
+    def read_pragmas(self):
+        return {name: self.conn.execute('PRAGMA %s' % name).fetchone()[0] for name in BULK_LOAD_PRAGMAS}
+
+    def count_committed(self):
+        other = connect(self.config)
+        try:
+            return other.execute('SELECT count(*) FROM t').fetchone()[0]
+        finally:
+            other.close()
+
+    def test_commit(self):
+        with table_writer(self.conn, self.config):
+            self.assertEqual(self.read_pragmas()['synchronous'], 0)  # OFF
+            self.assertEqual(self.read_pragmas()['journal_mode'], 'memory')
+            bulk_insert(self.conn, 't', ((i,) for i in range(10)))
+        self.assertEqual(self.read_pragmas(), self.pragmas)
+        self.assertEqual(self.count_committed(), 10)
+        self.assertEqual([row[0] for row in self.conn.execute('SELECT x FROM t')], list(range(10)))
+
+    def test_rollback(self):
+        with self.assertRaises(ValueError):
+            with table_writer(self.conn, self.config):
+                bulk_insert(self.conn, 't', ((i,) for i in range(10)))
+                raise ValueError('stage failed')
+        self.assertEqual(self.read_pragmas(), self.pragmas)
+        self.assertEqual(self.count_committed(), 0)
+
+    def test_configured_pragmas(self):
+        config = dict(self.config, bulk_load_pragmas={'synchronous': 'NORMAL'})
+        with table_writer(self.conn, config):
+            self.assertEqual(self.read_pragmas()['synchronous'], 1)  # NORMAL
+            self.assertEqual(self.read_pragmas()['journal_mode'], self.pragmas['journal_mode'])
+        self.assertEqual(self.read_pragmas(), self.pragmas)
+
+
+class TestCodeBook(unittest.TestCase):
+    def setUp(self):
+        self.code_book = make_test_code_book('codes_deeds', (
+            ('PROPN', '10', 'Single Family Residence / Townhouse'),
+            ('PROPN', '10', 'Single Family Residence / Townhouse'),  # a duplicate
+            ('PROPN', '11', 'Condominium (residential)'),
+            ('PROPN', '12', 'Condominium (residential)'),  # a conflict in the description
+            ('PROPN', '13', 'Commercial'),
+            ('PROPN', '13', 'Retail'),  # a conflict in the value
+            ('TRNTP', '10', 'RESALE'),
+            ))
+
+    def test_lookup(self):
+        self.assertEqual(self.code_book.lookup('PROPN', 'Single Family Residence / Townhouse'), '10')
+        self.assertEqual(self.code_book.lookup('TRNTP', 'RESALE'), '10')
+        self.assertEqual(self.code_book.lookup('PROPN', 'Commercial'), '13')
+        self.assertEqual(self.code_book.describe('PROPN', '11'), 'Condominium (residential)')
+        self.assertRaises(u.NotFoundError, self.code_book.lookup, 'PROPN', 'RESALE')
+        self.assertRaises(u.NotFoundError, self.code_book.describe, 'TRNTP', '11')
+
+    def test_conflicts(self):
+        self.assertEqual(self.code_book.n_duplicates, 1)
+        self.assertEqual(self.code_book.conflicts, [
+            ('PROPN', '12', 'Condominium (residential)'),
+            ('PROPN', '13', 'Retail'),
+            ])
+        self.assertRaises(u.NotUnique, self.code_book.lookup, 'PROPN', 'Condominium (residential)')
+        self.assertRaises(u.NotUnique, self.code_book.describe, 'PROPN', '13')
+        self.assertEqual(self.code_book.describe('PROPN', '12'), 'Condominium (residential)')
+
+
+class TestSaleKey(unittest.TestCase):
+    def test_round_trip(self):
+        apns = [0, 5, 1234567890, MAX_APN - 1]
+        sale_dates = [datetime.date(1970, 1, 1), datetime.date(2006, 1, 2), datetime.date(4840, 1, 1)]
+        for apn in apns:
+            for sale_date in sale_dates:
+                unpacked_apns, unpacked_sale_dates = unpack_sale_keys(np.array([sale_key(apn, sale_date)]))
+                self.assertEqual(unpacked_apns.tolist(), [apn])
+                self.assertEqual(unpacked_sale_dates.tolist(), [sale_date])
+
+    def test_array_matches_scalar(self):
+        apns = np.array([5, 1234567890], dtype=np.int64)
+        sale_dates = np.array(['2006-01-02', '2008-12-31'], dtype='datetime64[D]')
+        self.assertEqual(
+            sale_key_array(apns, sale_dates).tolist(),
+            [sale_key(apn, sale_date) for apn, sale_date in zip(apns.tolist(), sale_dates.tolist())],
+            )
+
+    def test_date_beyond_key_is_invalid(self):
+        deed = make_test_deed()
+        with self.assertRaises(u.InputError) as context:
+            deed.accumulate(deed_row(sale_date='99991231'))
+        self.assertEqual(context.exception.reason, 'invalid SALE DATE')
+        counter = collections.Counter()
+        error_reasons = collections.Counter()
+        columns = [np.array(column) for column in zip(deed_row(sale_date='99991231'), deed_row())]
+        deed.accumulate_chunk(columns, counter, error_reasons)
+        self.assertEqual(error_reasons, collections.Counter({'invalid SALE DATE': 1}))
+        self.assertEqual(counter['accumulated'], 1)
+
+    def test_date_before_1970_is_before_census(self):
+        deed = make_test_deed()
+        with self.assertRaises(u.InputError) as context:
+            deed.accumulate(deed_row(sale_date='19650704'))
+        self.assertEqual(context.exception.reason, 'sale date before date census became known')
+        error_reasons = collections.Counter()
+        columns = [np.array([value]) for value in deed_row(sale_date='19650704')]
+        deed.accumulate_chunk(columns, collections.Counter(), error_reasons)
+        self.assertEqual(error_reasons, collections.Counter({'sale date before date census became known': 1}))
+
+
+class TestToArrays(unittest.TestCase):
+    def test_to_int_array(self):
+        ints, is_valid = to_int_array(np.array(['12', '', 'x', '99999999999999999999', ' 3']))
+        self.assertEqual(is_valid.tolist(), [True, False, False, False, True])
+        self.assertEqual(ints[is_valid].tolist(), [12, 3])
+
+    def test_to_int_as_float_array(self):
+        floats, is_valid = to_int_as_float_array(np.array(['12', '', '1.5', '99999999999999999999']))
+        self.assertEqual(is_valid.tolist(), [True, False, False, True])
+        self.assertEqual(floats[is_valid].tolist(), [12.0, 1e20])
+
+    def test_to_float_array(self):
+        floats, is_valid = to_float_array(np.array(['1.5', '', 'x', '99999999999999999999']))
+        self.assertEqual(is_valid.tolist(), [True, False, False, True])
+        self.assertEqual(floats[is_valid].tolist(), [1.5, 1e20])
+
+    def test_huge_transaction_type_code(self):
+        deed = make_test_deed()
+        with self.assertRaises(u.InputError) as context:
+            deed.accumulate(deed_row(transaction_type_code='99999999999999999999'))
+        self.assertEqual(context.exception.reason, 'deed not resale nor new construction')
+        error_reasons = collections.Counter()
+        columns = [np.array([value]) for value in deed_row(transaction_type_code='99999999999999999999')]
+        deed.accumulate_chunk(columns, collections.Counter(), error_reasons)
+        self.assertEqual(error_reasons, collections.Counter({'deed not resale nor new construction': 1}))
+
+
+def accumulate_each(accumulate, rows, accepted):
+    '''Return (counter, error_reasons) from accumulate(row) for each row, counted as the scalar engines count'''
+    counter = collections.Counter()
+    error_reasons = collections.Counter()
+    for row in rows:
+        try:
+            accumulate(row)
+            counter[accepted] += 1
+        except u.InputError as err:
+            counter['skipped'] += 1
+            error_reasons[err.reason] += 1
+    return counter, error_reasons
+
+
+def replace_column(row, columns, column_name, value):
+    '''Return the row with value in the named column, for the tests'''
+    row = list(row)
+    row[columns.index(column_name)] = value
+    return tuple(row)
+
+
+class TestDeedEngines(unittest.TestCase):
+    def rows(self):
+        def deed_row_with(column_name, value):
+            return replace_column(deed_row(), Deed.columns, column_name, value)
+
+        return [
+            deed_row(),
+            deed_row(),  # a duplicate
+            deed_row(sale_amount='310000'),  # a multiple deed sale amount
+            deed_row(apn='1234567891', sale_date='20060100', transaction_type_code='03'),
+            deed_row(apn='1234567892', sale_date='2007-05-06'),
+            deed_row_with('PROPERTY INDICATOR CODE', '11'),
+            deed_row_with('DOCUMENT TYPE CODE', 'Q'),
+            deed_row_with('PRI CAT CODE', 'B'),
+            deed_row_with('MULTI APN FLAG CODE', 'M'),
+            deed_row_with('MULTI APN COUNT', '2'),
+            deed_row(transaction_type_code='x'),
+            deed_row(transaction_type_code='2'),
+            deed_row_with('SALE CODE', 'X'),
+            deed_row(sale_date='20060230'),
+            deed_row(sale_date='20061300'),
+            deed_row(sale_date='20060000'),
+            deed_row(sale_date=''),
+            deed_row(sale_date='20020101'),
+            deed_row(sale_date='19650704'),
+            deed_row(sale_date='99991231'),
+            deed_row(apn=''),
+            deed_row(apn=str(MAX_APN)),
+            deed_row(sale_amount='x'),
+            deed_row(sale_amount='0'),
+            deed_row(sale_amount='1e9'),
+            ]
+
+    def test_chunk_matches_scalar(self):
+        deed_scalar = make_test_deed()
+        counter_scalar, error_reasons_scalar = accumulate_each(deed_scalar.accumulate, self.rows(), 'accumulated')
+        deed_chunk = make_test_deed()
+        counter_chunk = collections.Counter()
+        error_reasons_chunk = collections.Counter()
+        rows = self.rows()
+        for start in range(0, len(rows), 7):
+            deed_chunk.accumulate_chunk(rows_to_columns(rows[start:start + 7]), counter_chunk, error_reasons_chunk)
+        self.assertEqual(counter_chunk, counter_scalar)
+        self.assertEqual(error_reasons_chunk, error_reasons_scalar)
+        self.assertEqual(counter_scalar, collections.Counter({'accumulated': 5, 'skipped': 20}))
+        self.assertEqual(len(error_reasons_scalar), 13)
+        self.assertEqual(deed_chunk.sale_keys.values.tolist(), deed_scalar.sale_keys.values.tolist())
+        self.assertEqual(deed_chunk.sale_amounts.values.tolist(), deed_scalar.sale_amounts.values.tolist())
+        self.assertEqual(deed_chunk.sale_date_day_0_converted_to_1, 1)
+        self.assertEqual(deed_scalar.sale_date_day_0_converted_to_1, 1)
+        self.assertEqual(deed_chunk.dedupe(), 1)
+        self.assertEqual(deed_scalar.dedupe(), 1)
+        self.assertEqual(deed_chunk.sale_keys.values.tolist(), deed_scalar.sale_keys.values.tolist())
+        self.assertEqual(len(deed_chunk.sale_keys), 3)
+
+
+class TestFirstSaleAmounts(unittest.TestCase):
+    def test_first_deed_of_each_key(self):
+        keys = np.array([5, 3, 5, 3, 7, 5, 3], dtype=np.int64)
+        sale_amounts = np.array([1.0, 2.0, 1.0, 9.0, 4.0, 8.0, 2.0])
+        indexes, n_rejected = first_sale_amounts(keys, sale_amounts)
+        self.assertEqual(indexes.tolist(), [0, 1, 4])
+        self.assertEqual(n_rejected, 2)
+
+    def test_empty(self):
+        indexes, n_rejected = first_sale_amounts(np.zeros(0, dtype=np.int64), np.zeros(0))
+        self.assertEqual(indexes.tolist(), [])
+        self.assertEqual(n_rejected, 0)
+
+
+class TestToDateArray(unittest.TestCase):
+    def test_matches_as_date(self):
+        values = [
+            '20060102', '20060100', '20060230', '2006-03-04', '2006010x', '', '00000101', '20041301',
+            '20061300', '20060000', '00000100',
+            ]
+        dates, is_valid, is_day_0 = to_date_array(np.array(values))
+        for i, value in enumerate(values):
+            try:
+                date, e = u.as_date(value)
+            except Exception:
+                self.assertFalse(is_valid[i], value)
+                self.assertFalse(is_day_0[i], value)
+                continue
+            self.assertTrue(is_valid[i], value)
+            self.assertEqual(dates[i].tolist(), date)
+            self.assertEqual(bool(is_day_0[i]), e is not None)
+
+
+class TestChunkFilter(unittest.TestCase):
+    def test_first_reason(self):
+        counter = collections.Counter()
+        error_reasons = collections.Counter()
+        chunk_filter = ChunkFilter(4, counter, error_reasons)
+        chunk_filter.reject(np.array([True, False, True, True]), 'first')
+        chunk_filter.reject(np.array([True, False, False, True]), 'second')
+        self.assertEqual(chunk_filter.is_alive.tolist(), [True, False, False, True])
+        self.assertEqual(error_reasons, collections.Counter({'first': 1, 'second': 1}))
+        self.assertEqual(counter, collections.Counter({'skipped': 2}))
+
+    def test_convert_live_records_only(self):
+        chunk_filter = ChunkFilter(3, collections.Counter(), collections.Counter())
+        chunk_filter.reject(np.array([True, False, True]), 'dead')
+        ints, is_valid = chunk_filter.convert(to_int_array, np.array(['1', 'x', 'y']))
+        self.assertEqual(ints.tolist(), [1, 0, 0])
+        self.assertEqual(is_valid.tolist(), [True, False, False])
+        values, is_valid = chunk_filter.convert_each(int, np.array(['1', '2', 'y']))
+        self.assertEqual(values.tolist(), [1, 0, 0])
+        self.assertEqual(is_valid.tolist(), [True, False, False])
+
+
+def make_test_taxrolls_code_book():
+    '''Return CodeBook with the PROPN and LUSEI codes that Neighborhood and Parcel look up, for the tests'''
+    propn_descriptions = (
+        'Single Family Residence / Townhouse',
+        'Condominium (residential)',
+        'Commercial',
+        'Duplex, Triplex, Quadplex',
+        'Apartment',
+        'Hotel, Motel',
+        'Commercial (condominium)',
+        'Retail',
+        'Service (general public)',
+        'Office Building',
+        'Warehouse',
+        'Financial Institution',
+        'Hospital (medical complex, clinic)',
+        'Parking',
+        'Amusement-Recreation',
+        'Industrial',
+        'Industrial Light',
+        'Industrial Heavy',
+        'Transport',
+        'Utilities',
+        'Agricultural',
+        'Vacant',
+        'Exempt',
+        )
+    lusei_descriptions = (
+        'SCHOOL',
+        'NURSERY SCHOOL',
+        'HIGH SCHOOL',
+        'PRIVATE SCHOOL',
+        'VOCATIONAL/TRADE SCHOOL',
+        'SECONDARY EDUCATIONAL SCHOOL',
+        'PUBLIC SCHOOL',
+        'PARK',
+        )
+    return make_test_code_book(
+        'codes_taxrolls',
+        [('PROPN', str(10 + i), description) for i, description in enumerate(propn_descriptions)] +
+        [('LUSEI', str(100 + i), description) for i, description in enumerate(lusei_descriptions)],
+        )
+
+
+def parcel_row(apn='1234567890', census_tract='101110', property_city='PASADENA'):
+    '''Return a row with the values of the columns in Parcel.columns, for the tests'''
+    return (
+        '10', '', apn, census_tract, property_city,
+        '500000', '6000', '1500', '1950', '3', '7', '2', '1', '2', 'Y', '1',
+        )
+
+
+class TestParcelEngines(unittest.TestCase):
+    def rows(self):
+        def parcel_row_with(apn, column_name, value):
+            return replace_column(parcel_row(apn=apn), Parcel.columns, column_name, value)
+
+        return [
+            parcel_row(apn='1'),
+            parcel_row(apn='2', census_tract='0101110', property_city='ALHAMBRA'),
+            parcel_row_with('3', 'POOL FLAG', 'N'),
+            parcel_row_with('4', 'FIREPLACE NUMBER', '0'),
+            parcel_row_with('5', 'PROPERTY INDICATOR CODE', '11'),
+            parcel_row(apn='6', census_tract='x'),
+            parcel_row(apn='7', property_city=''),
+            parcel_row_with('8', 'TOTAL VALUE CALCULATED', '0'),
+            parcel_row_with('9', 'LAND SQUARE FOOTAGE', 'x'),
+            parcel_row_with('10', 'EFFECTIVE YEAR BUILT', ''),
+            parcel_row_with('11', 'FIREPLACE NUMBER', '-1'),
+            parcel_row_with('12', 'UNITS NUMBER', '-1'),
+            parcel_row(apn='13', census_tract='99999999999999999999'),
+            ]
+
+    def assert_chunk_matches_scalar(self, config, sold_apns):
+        code_book = make_test_taxrolls_code_book()
+        parcel_scalar = Parcel(None, config, None, code_book, sold_apns)
+        counter_scalar, error_reasons_scalar = accumulate_each(parcel_scalar.accumulate, self.rows(), 'retained')
+        parcel_chunk = Parcel(None, dict(config, taxrolls_engine='vectorized'), None, code_book, sold_apns)
+        counter_chunk = collections.Counter()
+        error_reasons_chunk = collections.Counter()
+        rows = self.rows()
+        for start in range(0, len(rows), 5):
+            parcel_chunk.accumulate_chunk(rows_to_columns(rows[start:start + 5]), counter_chunk, error_reasons_chunk)
+        self.assertEqual(counter_chunk, counter_scalar)
+        self.assertEqual(error_reasons_chunk, error_reasons_scalar)
+        self.assertEqual(parcel_chunk.apns.values.tolist(), parcel_scalar.apns.values.tolist())
+        # the codes of the property cities depend on the order they are seen; the cities do not
+        self.assertEqual(
+            [parcel_chunk.property_cities[code] for code in parcel_chunk.features['property_city'].values.tolist()],
+            [parcel_scalar.property_cities[code] for code in parcel_scalar.features['property_city'].values.tolist()],
+            )
+        for feature_name, _ in Parcel.feature_dtypes:
+            if feature_name == 'property_city':
+                continue
+            self.assertEqual(
+                parcel_chunk.features[feature_name].values.tolist(),
+                parcel_scalar.features[feature_name].values.tolist(),
+                feature_name,
+                )
+        return counter_scalar, error_reasons_scalar
+
+    def test_chunk_matches_scalar(self):
+        counter, error_reasons = self.assert_chunk_matches_scalar({}, None)
+        self.assertEqual(counter, collections.Counter({'retained': 4, 'skipped': 9}))
+        self.assertEqual(error_reasons['invalid census tract'], 2)
+        self.assertEqual(len(error_reasons), 8)
+
+    def test_chunk_matches_scalar_sold_only(self):
+        sold_apns = np.array([2, 3, 5, 7], dtype=np.int64)
+        counter, error_reasons = self.assert_chunk_matches_scalar({}, sold_apns)
+        self.assertEqual(counter, collections.Counter({'retained': 2, 'skipped': 11}))
+        self.assertEqual(error_reasons['apn not in deeds'], 9)
+
+
+class TestSortedLookup(unittest.TestCase):
+    def test_lookup(self):
+        sorted_values = np.array([2, 3, 5, 7], dtype=np.int64)
+        indexes, is_found = sorted_lookup(sorted_values, np.array([7, 1, 5, 8, 2, 4], dtype=np.int64))
+        self.assertEqual(is_found.tolist(), [True, False, True, False, True, False])
+        self.assertEqual(indexes.tolist(), [3, 0, 2, 0, 0, 0])
+        self.assertEqual(is_member(sorted_values, np.array([3, 6], dtype=np.int64)).tolist(), [True, False])
+
+    def test_empty(self):
+        indexes, is_found = sorted_lookup(np.zeros(0, dtype=np.int64), np.array([1, 2], dtype=np.int64))
+        self.assertEqual(indexes.tolist(), [0, 0])
+        self.assertEqual(is_found.tolist(), [False, False])
+        self.assertEqual(is_member(np.array([1], dtype=np.int64), np.zeros(0, dtype=np.int64)).tolist(), [])
+
+
+class TestNeighborhoodEngines(unittest.TestCase):
+    # the codes of make_test_taxrolls_code_book()
+    rows = [
+        ('101110', '10', '0', '6000'),  # Single Family Residence / Townhouse
+        ('0101110', '12', '0', '2000'),  # Commercial, in the same tract as spelled differently
+        ('101110', '18', '100', '5000'),  # Service (general public) that is a SCHOOL
+        ('101200', '18', '5', '4000'),  # Service (general public) that is not
+        ('101200', '24', '107', '3000'),  # Amusement-Recreation that is a PARK
+        ('101200', '26', '99999999999999999999', '1000'),  # Industrial Light
+        ('101300', '32', '106', '700'),  # Exempt that is a PUBLIC SCHOOL
+        ('', '10', '0', '1'),
+        ('x', '10', '0', '1'),
+        ('101400', '0', '0', '1'),
+        ('101400', '10', '999', '1'),
+        ]
+
+    def test_chunk_matches_scalar(self):
+        code_book = make_test_taxrolls_code_book()
+        neighborhood_scalar = Neighborhood(None, None, code_book)
+        is_accepted_scalar = []
+        error_reasons_scalar = collections.Counter()
+        for row in self.rows:
+            try:
+                neighborhood_scalar.accumulate(row)
+                is_accepted_scalar.append(True)
+            except u.InputError as err:
+                is_accepted_scalar.append(False)
+                error_reasons_scalar[err.reason] += 1
+        neighborhood_chunk = Neighborhood(None, None, code_book)
+        counter = collections.Counter()
+        error_reasons_chunk = collections.Counter()
+        is_accepted_chunk = np.concatenate([
+            neighborhood_chunk.accumulate_chunk(
+                rows_to_columns(self.rows[start:start + 4]),
+                counter,
+                error_reasons_chunk,
+                )
+            for start in range(0, len(self.rows), 4)
+            ])
+        self.assertEqual(is_accepted_chunk.tolist(), is_accepted_scalar)
+        self.assertEqual(error_reasons_chunk, error_reasons_scalar)
+        self.assertEqual(counter['skipped'], 4)
+        self.assertEqual(neighborhood_chunk.tract_spellings, neighborhood_scalar.tract_spellings)
+        n = len(neighborhood_scalar.census_tracts)
+        self.assertEqual(neighborhood_chunk.census_tracts.values.tolist(), [101110, 101200, 101300, 101400])
+        self.assertEqual(neighborhood_scalar.census_tracts.values.tolist(), [101110, 101200, 101300, 101400])
+        self.assertEqual(neighborhood_chunk.parcel_count[:n].tolist(), neighborhood_scalar.parcel_count[:n].tolist())
+        self.assertEqual(
+            neighborhood_chunk.parcel_land_square_footage[:n].tolist(),
+            neighborhood_scalar.parcel_land_square_footage[:n].tolist(),
+            )
+        # the columns are residential, commercial, industrial, schools, parks, and other
+        self.assertEqual(neighborhood_scalar.parcel_count[:n].tolist(), [
+            [1, 1, 0, 1, 0, 0],
+            [0, 0, 1, 0, 1, 1],
+            [0, 0, 0, 1, 0, 0],
+            [0, 0, 0, 0, 0, 0],
+            ])
+        self.assertEqual(neighborhood_scalar.parcel_land_square_footage[1].tolist(), [0, 0, 1000, 0, 3000, 4000])
+
+
+class TestCriticalPath(unittest.TestCase):
+    def test_longest_chain(self):
+        wall_times = {
+            'read_codes_deeds': 1.0,
+            'read_codes_taxrolls': 2.0,
+            'read_deeds': 10.0,
+            'read_taxrolls': 5.0,
+            'read_census': 20.0,
+            'create_transactions': 3.0,
+            'split_transactions': 1.0,
+            'create_standardize': 1.0,
+            'export_feature_vectors': 1.0,
+            }
+        names, seconds = critical_path(STAGES, wall_times)
+        self.assertEqual(names, ['read_census', 'create_transactions', 'split_transactions',
+                                 'create_standardize', 'export_feature_vectors'])
+        self.assertEqual(seconds, 26.0)
+
+    def test_configured_upstream(self):
+        # with parcels_sold_only, read_taxrolls waits for read_deeds
+        wall_times = {'read_codes_deeds': 1.0, 'read_deeds': 10.0, 'read_taxrolls': 5.0, 'read_census': 12.0}
+        names, seconds = critical_path(configured_stages({'parcels_sold_only': True}), wall_times)
+        self.assertEqual(names[:3], ['read_codes_deeds', 'read_deeds', 'read_taxrolls'])
+        self.assertEqual(seconds, 16.0)
+
+
+class TestMoments(unittest.TestCase):
+    def test_matches_numpy(self):
+        rng = np.random.default_rng(1)
+        a = np.column_stack((rng.normal(1e6, 10.0, 1000), rng.exponential(3.0, 1000), np.full(1000, 7.0)))
+        moments = Moments(3)
+        for start, stop in ((0, 1), (1, 1), (1, 300), (300, 301), (301, 1000)):
+            moments.update(a[start:stop])
+        self.assertEqual(moments.n, 1000)
+        np.testing.assert_allclose(moments.mean, np.mean(a, axis=0), rtol=1e-12)
+        np.testing.assert_allclose(moments.standard_deviation(), np.std(a, axis=0), rtol=1e-9, atol=1e-12)
+
+
+class TestQuantileSketch(unittest.TestCase):
+    def test_exact_before_compaction(self):
+        a = np.arange(15.0).reshape(5, 3)
+        sketch = QuantileSketch(3, capacity=8)
+        sketch.update(a[:2])
+        sketch.update(a[2:])
+        self.assertEqual(sketch.n_compactions, 0)
+        self.assertEqual(sketch.median().tolist(), np.median(a, axis=0).tolist())
+
+    def test_rank_error(self):
+        rng = np.random.default_rng(2)
+        n = 20000
+        capacity = 64
+        a = np.column_stack((rng.normal(0.0, 1.0, n), rng.exponential(1.0, n), np.arange(n, dtype=np.float64)))
+        sketch = QuantileSketch(3, capacity)
+        batch_sizes = (1, 100, 37, 1000)
+        start = 0
+        while start < n:
+            size = batch_sizes[start % len(batch_sizes)]
+            sketch.update(a[start:start + size])
+            start += size
+        self.assertGreater(sketch.n_compactions, 0)
+        ranks = np.mean(a < sketch.median(), axis=0)
+        max_rank_error = np.log2(n / capacity) / capacity
+        self.assertTrue(np.all(np.abs(ranks - 0.5) <= max_rank_error), ranks)
+
+    def test_empty(self):
+        self.assertTrue(np.all(np.isnan(QuantileSketch(2).median())))
+
+
+class TestColumnSummaries(unittest.TestCase):
+    def test_no_rows(self):
+        for exact in (True, False):
+            summaries = ColumnSummaries(2, exact)
+            n, means, medians, standard_deviations = summaries.summarize()
+            self.assertEqual(n, 0)
+            for summary in (means, medians, standard_deviations):
+                self.assertEqual(summary.shape, (2,))
+                self.assertTrue(np.all(np.isnan(summary)))
+            summaries.update(np.zeros((0, 2)))
+            self.assertEqual(summaries.summarize()[0], 0)
+
+    def test_exact_matches_sketch(self):
+        a = np.arange(20.0).reshape(10, 2)
+        summaries_exact = ColumnSummaries(2, True)
+        summaries_sketch = ColumnSummaries(2, False)
+        for summaries in (summaries_exact, summaries_sketch):
+            summaries.update(a[:3])
+            summaries.update(a[3:])
+        for summary_exact, summary_sketch in zip(summaries_exact.summarize(), summaries_sketch.summarize()):
+            np.testing.assert_allclose(summary_exact, summary_sketch)
+
+
+class TestExportFeatureVectors(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.config = {'dir_working': self.dir.name}
+        self.conn = sqlite3.connect(':memory:')
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute(
+            '''CREATE TABLE transactions
+            (apn integer, sale_date text, sale_amount REAL, in_training REAL, a REAL, b REAL)
+            '''
+            )
+        self.conn.execute(
+            '''CREATE TABLE transactions_standardizers
+            (column_name text, mean real, median real, standard_deviation real)
+            '''
+            )
+        self.logger = logging.getLogger('etl.py TestExportFeatureVectors')
+
+    def tearDown(self):
+        self.conn.close()
+        self.dir.cleanup()
+
+    def add_transactions(self):
+        self.conn.execute('INSERT INTO transactions VALUES (6, "2006-01-03", 400000.0, 1.0, 3.0, 5.0)')
+        self.conn.execute('INSERT INTO transactions VALUES (5, "2006-01-02", 300000.0, 0.0, 1.0, 5.0)')
+
+    def test_export(self):
+        self.add_transactions()
+        self.conn.execute('INSERT INTO transactions_standardizers VALUES ("a", 2.0, 2.0, 1.0)')
+        self.conn.execute('INSERT INTO transactions_standardizers VALUES ("b", 5.0, 5.0, 0.0)')
+        export_feature_vectors(self.conn, self.config, self.logger)
+        manifest, arrays = load_feature_vectors(feature_vectors_dir(self.config))
+        self.assertEqual(manifest['feature_names'], ['a', 'b'])
+        self.assertEqual(arrays['apn'].tolist(), [5, 6])
+        self.assertEqual(arrays['features'].tolist(), [[-1.0, 0.0], [1.0, 0.0]])
+        self.assertEqual(arrays['in_training'].tolist(), [False, True])
+        self.assertEqual(arrays['sale_date'].astype(str).tolist(), ['2006-01-02', '2006-01-03'])
+
+    def test_no_transactions(self):
+        with self.assertLogs(self.logger, logging.WARNING):
+            export_feature_vectors(self.conn, self.config, self.logger)
+        self.assertFalse(os.path.exists(feature_vectors_dir(self.config)))
+
+    def test_missing_standardizer(self):
+        self.add_transactions()
+        self.conn.execute('INSERT INTO transactions_standardizers VALUES ("a", 2.0, 2.0, 1.0)')
+        with self.assertRaisesRegex(ValueError, 'b'):
+            export_feature_vectors(self.conn, self.config, self.logger)
+        self.assertFalse(os.path.exists(feature_vectors_dir(self.config)))
+
+
+class TestCensus(unittest.TestCase):
+    def census_row(self, geo_id2='0603101110', **values):
+        '''Return a row with the values of the columns in Census.columns'''
+        row = dict.fromkeys(Census.columns, '10')
+        row['GEO_ID2'] = geo_id2
+        row.update(values)
+        return tuple(row[column_name] for column_name in Census.columns)
+
+    def test_reasons(self):
+        rows = [
+            self.census_row(),
+            self.census_row(geo_id2='06031011'),
+            self.census_row(geo_id2='0603101111', P031005='x'),
+            self.census_row(geo_id2='0603101112', **dict.fromkeys(CENSUS_MEAN_TRAVEL_TIMES, '0')),
+            self.census_row(geo_id2='0603101113', P053001=''),
+            self.census_row(geo_id2='0603101114', H007001='x'),
+            self.census_row(geo_id2='0603101115', H007002='x'),
+            self.census_row(geo_id2='0603101116', H007001='0'),
+            ]
+        census = Census(None, None)
+        counter = collections.Counter()
+        error_reasons = collections.Counter()
+        census.accumulate_columns(rows_to_columns(rows), counter, error_reasons)
+        self.assertEqual(error_reasons, collections.Counter({
+            'invalid census tract': 1,
+            'non-int P031005': 1,
+            'no commuters in census tract': 1,
+            'non-float median household income': 1,
+            'non-float in total occupied': 1,
+            'non-float in owner occupied': 1,
+            'zero residences occupied': 1,
+            }))
+        self.assertEqual(counter['retained'], 1)
+        self.assertEqual(census.census_tracts.tolist(), [101110])
+        self.assertEqual(census.features['fraction_owner_occupied'].tolist(), [1.0])
+
+
+class TestCheckpoints(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.config = dict(make_test_data_dir(self.dir.name), resume=True)
+        self.logger = logging.getLogger('etl.py TestCheckpoints')
+        self.calls = []
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def worker(self, config, code_book, zipfilename):
+        self.calls.append(zipfilename)
+        return (zipfilename, len(self.calls))
+
+    def read_deeds(self):
+        return list(map_zipfiles_checkpointed(
+            'read_deeds', self.worker, self.config, None, self.logger, self.config['in_deeds']))
+
+    def test_resume(self):
+        partials = self.read_deeds()
+        self.assertEqual(partials, [('CAC06037D1.zip', 1), ('CAC06037D2.zip', 2)])
+        self.assertEqual(self.read_deeds(), partials)
+        self.assertEqual(len(self.calls), 2)
+
+    def test_changed_archive(self):
+        self.read_deeds()
+        with open(os.path.join(self.config['dir_data'], 'CAC06037D2.zip'), 'a') as f:
+            f.write('more')
+        self.assertEqual(self.read_deeds(), [('CAC06037D1.zip', 1), ('CAC06037D2.zip', 3)])
+
+    def test_format_version_bump(self):
+        self.read_deeds()
+        self.assertEqual(read_checkpoint(self.config, 'read_deeds', 'CAC06037D1.zip'), ('CAC06037D1.zip', 1))
+        version = CHECKPOINT_FORMAT_VERSIONS['read_deeds']
+        self.addCleanup(CHECKPOINT_FORMAT_VERSIONS.__setitem__, 'read_deeds', version)
+        CHECKPOINT_FORMAT_VERSIONS['read_deeds'] = version + 1
+        self.assertIsNone(read_checkpoint(self.config, 'read_deeds', 'CAC06037D1.zip'))
+        self.assertEqual(self.read_deeds(), [('CAC06037D1.zip', 3), ('CAC06037D2.zip', 4)])
+        # the stale checkpoints were replaced
+        self.assertEqual(read_checkpoint(self.config, 'read_deeds', 'CAC06037D1.zip'), ('CAC06037D1.zip', 3))
+
+
+class TestParseCache(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path_zip = os.path.join(self.dir.name, 'a.zip')
+        self.config = {'dir_working': self.dir.name, 'parse_cache': True, 'chunk_size': 2}
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def write_zip(self, lines, mtime_ns=None):
+        '''Write the zip file, stored so that its size depends only on the length of the lines'''
+        with zipfile.ZipFile(self.path_zip, 'w', zipfile.ZIP_STORED) as archive:
+            archive.writestr(zipfile.ZipInfo('a.txt', date_time=(2000, 1, 1, 0, 0, 0)), ''.join(lines))
+        if mtime_ns is not None:
+            os.utime(self.path_zip, ns=(mtime_ns, mtime_ns))
+
+    def read(self):
+        return [
+            [column.tolist() for column in columns]
+            for columns in read_archive_chunks(self.path_zip, ('B', 'A'), self.config)
+            ]
+
+    def test_cache(self):
+        self.write_zip(['A\tB\r\n', '1\t2\r\n', '3\t4\r\n', '5\t6\r\n'])
+        chunks = [[['2', '4'], ['1', '3']], [['6'], ['5']]]
+        self.assertEqual(self.read(), chunks)
+        cache_dir, _ = parse_cache_dir(self.config, self.path_zip, ('B', 'A'))
+        self.assertEqual(
+            [[column.tolist() for column in columns] for columns in read_parse_cache(cache_dir)],
+            chunks,
+            )
+        self.assertEqual(self.read(), chunks)
+
+    def test_invalidated(self):
+        mtime_ns = 10 ** 18
+        self.write_zip(['A\tB\r\n', '1\t2\r\n'], mtime_ns)
+        self.assertEqual(self.read(), [[['2'], ['1']]])
+        # with the same size and mtime, the cache is used, unless the content is hashed
+        self.write_zip(['A\tB\r\n', '7\t8\r\n'], mtime_ns)
+        self.assertEqual(self.read(), [[['2'], ['1']]])
+        self.config['parse_cache_hash_content'] = True
+        self.assertEqual(self.read(), [[['8'], ['7']]])
+        del self.config['parse_cache_hash_content']
+        # a changed mtime or size invalidates the cache
+        self.write_zip(['A\tB\r\n', '9\t0\r\n'], mtime_ns + 1)
+        self.assertEqual(self.read(), [[['0'], ['9']]])
+        self.write_zip(['A\tB\r\n', '9\t10\r\n'], mtime_ns + 1)
+        self.assertEqual(self.read(), [[['10'], ['9']]])
+
+
+class TestRunStages(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.config = dict(make_test_data_dir(self.dir.name), max_sale_amount=1.0)
+        self.conn = sqlite3.connect(':memory:')
+        self.conn.row_factory = sqlite3.Row
+        self.logger = logging.getLogger('etl.py TestRunStages')
+        self.calls = []
+
+        def stage_function(table_name):
+            def function(conn, config, logger):
+                self.calls.append(table_name)
+                conn.execute('DROP TABLE IF EXISTS %s' % table_name)
+                conn.execute('CREATE TABLE %s (x)' % table_name)
+            return function
+
+        # run_stages runs the stages in STAGES
+        self.addCleanup(globals().__setitem__, 'STAGES', STAGES)
+        globals()['STAGES'] = (
+            Stage('a', stage_function('a'), (), ('in_codes_deeds',), ('max_sale_amount',), ('a',)),
+            Stage('b', stage_function('b'), ('a',), (), (), ('b',)),
+            Stage('c', stage_function('c'), (), ('in_census',), (), ('c',)),
+            )
+
+    def tearDown(self):
+        self.conn.close()
+        self.dir.cleanup()
+
+    def run_stages(self):
+        self.calls = []
+        run_stages(self.conn, self.config, self.logger)
+        return self.calls
+
+    def test_unchanged(self):
+        self.assertEqual(self.run_stages(), ['a', 'b', 'c'])
+        self.assertEqual(self.run_stages(), [])
+        self.assertEqual(self.run_stages(), [])
+        self.config['incremental'] = False
+        self.assertEqual(self.run_stages(), ['a', 'b', 'c'])
+
+    def test_changed(self):
+        self.run_stages()
+        self.config['max_sale_amount'] = 2.0
+        self.assertEqual(self.run_stages(), ['a', 'b'])
+        with open(os.path.join(self.config['dir_data'], 'census.csv'), 'a') as f:
+            f.write('more')
+        self.assertEqual(self.run_stages(), ['c'])
+        self.conn.execute('DROP TABLE b')
+        self.assertEqual(self.run_stages(), ['b'])
+
+    def test_fingerprints(self):
+        fingerprints = stage_fingerprints(self.config)
+        self.assertEqual(stage_fingerprints(self.config), fingerprints)
+        changed = stage_fingerprints(dict(self.config, max_sale_amount=2.0))
+        self.assertEqual([name for name in fingerprints if changed[name] != fingerprints[name]], ['a', 'b'])
+        changed = stage_fingerprints(self.config, 'another version')
+        self.assertTrue(all(changed[name] != fingerprints[name] for name in fingerprints))
+
+
+class TestCreateTransactionsByMergeJoin(unittest.TestCase):
+    def setUp(self):
+        self.conn = sqlite3.connect(':memory:')
+        self.conn.execute('CREATE TABLE deeds (apn, sale_date, sale_year, sale_month, sale_day, sale_amount)')
+        self.conn.execute('CREATE TABLE parcels (apn, %s)' % ', '.join(TRANSACTIONS_PARCEL_COLUMNS))
+        self.conn.execute(
+            '''CREATE TABLE neighborhoods
+            ( census_tract
+            , fraction_land_square_footage_residential
+            , fraction_land_square_footage_commercial
+            , fraction_land_square_footage_industrial
+            , fraction_land_square_footage_schools
+            , fraction_land_square_footage_parks
+            , fraction_land_square_footage_other
+            )
+            '''
+            )
+        self.conn.execute('CREATE TABLE census (census_tract, %s)' % ', '.join(
+            feature.name for feature in CENSUS_FEATURES))
+        self.conn.execute('INSERT INTO deeds VALUES (5, "2006-01-02", 2006, 1, 2, 300000.0)')
+        self.conn.execute('INSERT INTO deeds VALUES (6, "2006-01-03", 2006, 1, 3, 400000.0)')
+        self.conn.execute('INSERT INTO neighborhoods VALUES (101110, 0.5, 0.1, 0.1, 0.1, 0.1, 0.1)')
+        self.conn.execute('INSERT INTO census VALUES (101110, %s)' % ', '.join('1.0' for _ in CENSUS_FEATURES))
+        self.logger = logging.getLogger('etl.py TestCreateTransactionsByMergeJoin')
+
+    def tearDown(self):
+        self.conn.close()
+
+    def transactions(self):
+        return self.conn.execute('SELECT apn, sale_amount, census_tract, property_city FROM transactions').fetchall()
+
+    def test_no_parcels(self):
+        create_transactions_by_merge_join(self.conn, {}, self.logger)
+        self.assertEqual(self.transactions(), [])
+
+    def test_join(self):
+        self.conn.execute('INSERT INTO parcels VALUES (6, 101110, "PASADENA", %s)' % ', '.join(
+            '1.0' for _ in TRANSACTIONS_PARCEL_COLUMNS[2:]))
+        self.conn.execute('INSERT INTO parcels VALUES (7, 999999, "PASADENA", %s)' % ', '.join(
+            '1.0' for _ in TRANSACTIONS_PARCEL_COLUMNS[2:]))
+        create_transactions_by_merge_join(self.conn, {}, self.logger)
+        self.assertEqual(self.transactions(), [(6, 400000.0, 101110, 'PASADENA')])
+
+
 if __name__ == '__main__':
     main(sys.argv)
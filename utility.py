@@ -1,14 +1,27 @@
 '''utility functions and classes
 '''
+import atexit
 import collections
 import datetime
+import io
+import itertools
 import json
 import logging
-from typing import Dict, List, Union
+import logging.handlers
+import multiprocessing
+import numpy as np
+import operator
+from typing import Dict, Iterable, Iterator, List, Sequence, Tuple, Union
 import os
 import pdb
+import pickle
+import queue
 import sys
+import tempfile
+import threading
+import time
 import unittest
+import zipfile
 
 
 class Error(Exception):
@@ -60,6 +73,102 @@ def as_date(s: str) -> (datetime.date, Union[None, str]):
         return (datetime.date(year, month, day), None)
 
 
+def chunks(iterable: Iterable, size: int) -> Iterator[List]:
+    '''Yield successive lists of up to size items from iterable'''
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if len(chunk) == 0:
+            return
+        yield chunk
+
+
+class GrowableArray:
+    '''A 1-D NumPy array to which values are appended, doubling its capacity as needed'''
+    def __init__(self, dtype, capacity: int = 1024):
+        self.array = np.empty(capacity, dtype=dtype)
+        self.n = 0
+
+    def __len__(self) -> int:
+        return self.n
+
+    def _reserve(self, n: int):
+        if n > len(self.array):
+            array = np.empty(max(n, 2 * len(self.array)), dtype=self.array.dtype)
+            array[:self.n] = self.array[:self.n]
+            self.array = array
+
+    def append(self, value):
+        '''Append one value'''
+        self._reserve(self.n + 1)
+        self.array[self.n] = value
+        self.n += 1
+
+    def extend(self, values):
+        '''Append each value in an array or sequence'''
+        n = self.n + len(values)
+        self._reserve(n)
+        self.array[self.n:n] = values
+        self.n = n
+
+    @property
+    def values(self) -> np.ndarray:
+        '''Return the values appended so far, as a view that shares their memory'''
+        return self.array[:self.n]
+
+    def __getstate__(self):
+        return {'array': self.values.copy(), 'n': self.n}  # without the unused capacity
+
+
+def prefetch(iterable: Iterable, depth: int, stalls: collections.Counter = None) -> Iterator:
+    '''Yield the items of iterable, which a reader thread produces up to depth items ahead
+
+    If supplied, stalls['producer'] accumulates the seconds the reader thread waited for room in the queue
+    and stalls['consumer'] the seconds the caller waited for an item.
+    An exception raised by iterable is raised again in the caller.
+    '''
+    stalls = collections.Counter() if stalls is None else stalls
+    items = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def put(message):
+        start = time.perf_counter()
+        while not stop.is_set():
+            try:
+                items.put(message, timeout=0.1)
+                break
+            except queue.Full:
+                pass
+        stalls['producer'] += time.perf_counter() - start
+
+    def produce():
+        try:
+            for item in iterable:
+                if stop.is_set():
+                    return
+                put((False, item))
+        except BaseException as err:
+            put((True, err))
+            return
+        put((True, None))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            start = time.perf_counter()
+            is_last, item = items.get()
+            stalls['consumer'] += time.perf_counter() - start
+            if is_last:
+                if item is not None:
+                    raise item
+                return
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
 def best_apn(formatted: str, unformatted: str) -> int:
     '''return as int, the best of the APN values, or raise ValueError if neither is usable.'''
     # attempt to use the unformatted value
@@ -85,6 +194,53 @@ def best_apn(formatted: str, unformatted: str) -> int:
     raise ValueError
 
 
+def open_zip_member(path: str, encoding: str = 'latin-1') -> io.TextIOWrapper:
+    '''Return a text stream that inflates the only member of a zip archive as it is read
+
+    The member is never written to disk nor read entirely into memory.
+    Decoding with latin-1 cannot fail, as every byte is a valid character.
+    Lines are not translated (newline=''), as the csv module expects.
+    '''
+    with zipfile.ZipFile(path) as archive:
+        names = archive.namelist()
+        if len(names) != 1:
+            raise InputError('zip file does not contain exactly one member', (path, names))
+        # the member stays readable after the archive is closed
+        member = archive.open(names[0])
+    return io.TextIOWrapper(member, encoding=encoding, newline='')
+
+
+def project(rows: Iterable[List[str]], column_names: Sequence[str]) -> Iterator[Tuple]:
+    '''Yield, for each row after the header row, a tuple with the values of the named columns
+
+    The column indexes are resolved once from the header row, so that the rows, such as those
+    from csv.reader, can be decoded without building a dict for each one.
+    As with csv.DictReader, empty rows are skipped and missing trailing values are None.
+    '''
+    rows = iter(rows)
+    header = next(rows)
+    indexes = []
+    for column_name in column_names:
+        try:
+            indexes.append(header.index(column_name))
+        except ValueError:
+            raise InputError('missing column', column_name)
+    if len(indexes) == 1:
+        index = indexes[0]
+
+        def get(row):
+            return (row[index],)
+    else:
+        get = operator.itemgetter(*indexes)
+    n_columns = len(header)
+    for row in rows:
+        if len(row) < n_columns:
+            if len(row) == 0:
+                continue
+            row = row + [None] * (n_columns - len(row))
+        yield get(row)
+
+
 def parse_invocation_arguments(argv: List[str]) -> Dict[str, any]:
     '''Parse invocation aguments
 
@@ -129,7 +285,56 @@ def parse_invocation_arguments(argv: List[str]) -> Dict[str, any]:
     return result
 
 
-def make_logger(module_name, config):
+class RateLimitFilter(logging.Filter):
+    '''Drop the records from a high-volume logging call that exceed its rate
+
+    Only the records below WARNING logged with extra={'rate_limit': True} are limited. Each such logging call,
+    identified by its file and line, may log up to rate records per second, with bursts of up to rate records.
+    The next record that a call logs after some were dropped notes how many, and report() logs the counts
+    that remain.
+    '''
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+        self.tokens = {}  # key = (pathname, lineno)  value = (tokens, time)
+        self.dropped = collections.Counter()  # key = (pathname, lineno)
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or not getattr(record, 'rate_limit', False):
+            return True
+        key = (record.pathname, record.lineno)
+        now = time.monotonic()
+        tokens, last = self.tokens.get(key, (self.rate, now))
+        tokens = min(self.rate, tokens + (now - last) * self.rate)
+        if tokens < 1.0:
+            self.tokens[key] = (tokens, now)
+            self.dropped[key] += 1
+            return False
+        self.tokens[key] = (tokens - 1.0, now)
+        if key in self.dropped:
+            n_dropped = self.dropped.pop(key)
+            record.msg = '%s [dropped %d earlier messages from this line]' % (record.getMessage(), n_dropped)
+            record.args = None
+        return True
+
+    def report(self, logger):
+        '''Log the number of records still dropped from each logging call'''
+        for (pathname, lineno), n in sorted(self.dropped.items()):
+            logger.info('dropped %d messages from %s line %d' % (n, pathname, lineno))
+        self.dropped.clear()
+
+
+def report_rate_limits(logger):
+    '''Log the number of records still dropped by each RateLimitFilter of logger
+
+    Call it before a process other than the main one finishes, as those processes do not run atexit functions.
+    '''
+    for log_filter in logger.filters:
+        if isinstance(log_filter, RateLimitFilter):
+            log_filter.report(logger)
+
+
+def make_logger(module_name, config, log_queue=None):
     '''Setup logging to print and write to files
 
     CONFIG KEYS USED
@@ -137,6 +342,15 @@ def make_logger(module_name, config):
     - logging_level:    one of DEBUG INFO WARNING ERROR CRITICAL
     - logging_stderr:   optional; if True, write log messages to stderr
     - logging_stdout:   optional: if True, write log messages to stdout
+    - logging_queue:    optional; if True, the logger puts the records on a queue and one listener thread
+                        writes them to the files and streams, so that logging does not wait for the I/O;
+                        processes forked later log to the same queue; default False
+    - logging_rate_limit: optional number of records per second that each logging call with
+                        extra={'rate_limit': True}, such as a summary line per census tract, may log
+                        below WARNING; default no limit
+
+    If log_queue is supplied, the records are put on it for a listener in another process, as with
+    logging_queue; pass it logging_queue(logger) from that process.
     '''
     logger = logging.getLogger(module_name)
     level = config['logging_level'].upper()
@@ -148,22 +362,56 @@ def make_logger(module_name, config):
         logging.CRITICAL if level == 'CRITICAL' else
         None
         )
+    rate_limit_filter = None
+    if config.get('logging_rate_limit') is not None:
+        rate_limit_filter = RateLimitFilter(config['logging_rate_limit'])
+        logger.addFilter(rate_limit_filter)
+    if log_queue is not None:
+        logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    else:
+        add_handlers(logger, config)
+    if rate_limit_filter is not None:
+        # registered after the listener is, so that the report is logged before the listener stops
+        atexit.register(report_rate_limits, logger)
+    return logger
+
+
+def add_handlers(logger, config):
+    '''Add the handlers that make_logger sets up to logger, through a queue if config['logging_queue']'''
+    handlers = []
     formatter_long = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
     formatter_short = logging.Formatter('%(levelname)s %(message)s')
     if config.get('logging_stderr', False):
         handler = logging.StreamHandler(stream=sys.stderr)
         handler.setFormatter(formatter_short)
-        logger.addHandler(handler)
+        handlers.append(handler)
     if config.get('logging_stdout', False):
         handler = logging.StreamHandler(stream=sys.stdout)
         handler.setFormatter(formatter_short)
-        logger.addHandler(handler)
+        handlers.append(handler)
     if 'logging_filename' in config:
         path = os.path.join(config['dir_working'], config['logging_filename'])
         handler = logging.FileHandler(path)
         handler.setFormatter(formatter_long)
-        logger.addHandler(handler)
-    return logger
+        handlers.append(handler)
+    if config.get('logging_queue', False):
+        # a multiprocessing queue, so that forked processes can log to it as well
+        log_queue = multiprocessing.Queue(-1)
+        listener = logging.handlers.QueueListener(log_queue, *handlers)
+        listener.start()
+        atexit.register(listener.stop)
+        logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    else:
+        for handler in handlers:
+            logger.addHandler(handler)
+
+
+def logging_queue(logger):
+    '''Return the queue that logger puts its records on, or None if it does not log through a queue'''
+    for handler in logger.handlers:
+        if isinstance(handler, logging.handlers.QueueHandler):
+            return handler.queue
+    return None
 
 
 def log_config(module_name: str, config: Dict, logger) -> None:
@@ -210,6 +458,61 @@ class TestAsDate(unittest.TestCase):
         self.assertEqual(d.day, 1)
 
 
+class TestChunks(unittest.TestCase):
+    def test(self):
+        self.assertEqual(list(chunks(range(5), 2)), [[0, 1], [2, 3], [4]])
+        self.assertEqual(list(chunks([], 2)), [])
+
+
+class TestGrowableArray(unittest.TestCase):
+    def test(self):
+        a = GrowableArray(np.int64, capacity=2)
+        a.append(1)
+        a.extend([2, 3, 4])
+        a.extend(np.arange(5, 10))
+        self.assertEqual(a.values.tolist(), list(range(1, 10)))
+        a.values[0] = 0
+        self.assertEqual(a.values[0], 0)
+
+    def test_pickle(self):
+        a = GrowableArray(np.float64)
+        a.extend([1.5, 2.5])
+        b = pickle.loads(pickle.dumps(a))
+        self.assertEqual(len(b.array), 2)
+        self.assertEqual(b.values.tolist(), [1.5, 2.5])
+
+
+class TestPrefetch(unittest.TestCase):
+    def test(self):
+        stalls = collections.Counter()
+        self.assertEqual(list(prefetch(range(100), 3, stalls)), list(range(100)))
+        self.assertEqual(set(stalls), {'producer', 'consumer'})
+
+    def test_exception(self):
+        def items():
+            yield 1
+            yield 2
+            raise InputError('bad item', 3)
+        n_threads = threading.active_count()
+        received = []
+        with self.assertRaises(InputError) as context:
+            for item in prefetch(items(), 1):
+                received.append(item)
+        self.assertEqual(received, [1, 2])
+        self.assertEqual(context.exception.reason, 'bad item')
+        # the reader thread was joined
+        self.assertEqual(threading.active_count(), n_threads)
+
+    def test_stop_early(self):
+        n_threads = threading.active_count()
+        items = prefetch(itertools.count(), 2)
+        for item in items:
+            if item == 10:
+                break
+        items.close()
+        self.assertEqual(threading.active_count(), n_threads)
+
+
 class TestMakeLogger(unittest.TestCase):
     def test(self):
         config = {
@@ -224,6 +527,114 @@ class TestMakeLogger(unittest.TestCase):
         logger.error('error message')
         logger.critical('critical message')
 
+    def test_queue(self):
+        with tempfile.TemporaryDirectory() as dir_working:
+            config = {
+                'dir_working': dir_working,
+                'logging_filename': 'log.txt',
+                'logging_level': 'info',
+                'logging_queue': True,
+                }
+            logger = make_logger('utility.py test_queue', config)
+            self.assertIsNotNone(logging_queue(logger))
+            logger.info('info message')
+            # the listener thread writes the record
+            path = os.path.join(dir_working, 'log.txt')
+            for _ in range(100):
+                with open(path) as f:
+                    if 'info message' in f.read():
+                        break
+                time.sleep(0.01)
+            else:
+                self.fail('message not written')
+
+
+class TestRateLimitFilter(unittest.TestCase):
+    def test(self):
+        logger = logging.getLogger('utility.py TestRateLimitFilter')
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+        records = []
+        handler = logging.Handler()
+        handler.emit = lambda record: records.append(record.getMessage())
+        logger.addHandler(handler)
+        rate_limit_filter = RateLimitFilter(3)
+        logger.addFilter(rate_limit_filter)
+        for i in range(10):
+            logger.info('summary %d' % i, extra={'rate_limit': True})
+        logger.info('not limited')
+        logger.warning('warning', extra={'rate_limit': True})
+        self.assertEqual(records, ['summary 0', 'summary 1', 'summary 2', 'not limited', 'warning'])
+        report_rate_limits(logger)
+        self.assertEqual(len(records), 6)
+        self.assertTrue(records[5].startswith('dropped 7 messages'))
+
+    def test_note_after_refill(self):
+        logger = logging.getLogger('utility.py TestRateLimitFilter.test_note_after_refill')
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+        records = []
+        handler = logging.Handler()
+        handler.emit = lambda record: records.append(record.getMessage())
+        logger.addHandler(handler)
+        rate_limit_filter = RateLimitFilter(2)
+        logger.addFilter(rate_limit_filter)
+
+        def log(i):
+            logger.info('summary %d', i, extra={'rate_limit': True})
+
+        def other(i):
+            logger.info('other %d', i, extra={'rate_limit': True})
+
+        for i in range(5):
+            log(i)
+            other(i)
+        self.assertEqual(records, ['summary 0', 'other 0', 'summary 1', 'other 1'])
+        self.assertEqual(sorted(rate_limit_filter.dropped.values()), [3, 3])
+        # as if a second had passed, so that each call may log again
+        for key, (tokens, last) in list(rate_limit_filter.tokens.items()):
+            rate_limit_filter.tokens[key] = (tokens, last - 1.0)
+        log(5)
+        self.assertEqual(records[-1], 'summary 5 [dropped 3 earlier messages from this line]')
+        report_rate_limits(logger)
+        self.assertEqual(len(records), 6)
+        self.assertTrue(records[-1].startswith('dropped 3 messages'))
+        self.assertEqual(rate_limit_filter.dropped, collections.Counter())
+
+
+class TestOpenZipMember(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'a.zip')
+        content = 'A\tB\r\n1\t"caf\xe9\r\n'
+        with zipfile.ZipFile(self.path, 'w', zipfile.ZIP_DEFLATED) as archive:
+            archive.writestr('a.txt', content.encode('latin-1'))
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_read(self):
+        with open_zip_member(self.path) as f:
+            lines = list(f)
+        self.assertEqual(lines, ['A\tB\r\n', '1\t"caf\xe9\r\n'])
+
+    def test_not_one_member(self):
+        with zipfile.ZipFile(self.path, 'a') as archive:
+            archive.writestr('b.txt', b'')
+        with self.assertRaises(InputError):
+            open_zip_member(self.path)
+
+
+class TestProject(unittest.TestCase):
+    def test_project(self):
+        rows = [['a', 'b', 'c'], ['1', '2', '3'], [], ['4']]
+        self.assertEqual(list(project(rows, ['c', 'a'])), [('3', '1'), (None, '4')])
+        self.assertEqual(list(project(rows, ['b'])), [('2',), (None,)])
+
+    def test_missing_column(self):
+        with self.assertRaises(InputError):
+            list(project([['a']], ['b']))
+
 
 class TestParseInvocationArguments(unittest.TestCase):
     def setUp(self):